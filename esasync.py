@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+'''asyncio Elasticsearch client with AWS SigV4 signing over a shared connection pool'''
+
+import asyncio
+from contextlib import nullcontext
+import json
+import os
+import time
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.exceptions import ConnectionTimeout
+
+from esaws import MSEARCH_MAX_BYTES, MSEARCH_MAX_QUERIES, NDJSON_HEADERS
+from esaws import most_fields_query, zot_index_name
+from esaws import search_body, search_request, create_index_request, delete_index_request
+from esaws import msearch_batches, msearch_request, msearch_results
+from esaws import search_many_bodies, search_many_results
+from esaws import report_search_error, report_create_index_error, report_delete_index_error
+from escache import canonical_key
+from escodec import DEFAULT_SERIALIZER
+from eslatency import current_call
+from estransport import canonical_query, shared_credential_cache
+
+
+def raise_transport_error(status, raw_data):
+    '''Raise the same TransportError subclass the sync transport raises for an error response'''
+    error_message, additional_info = raw_data, None
+    try:
+        if raw_data:
+            additional_info = json.loads(raw_data)
+            error_message = additional_info.get('error', error_message)
+            if isinstance(error_message, dict) and 'type' in error_message:
+                error_message = error_message['type']
+    except (ValueError, TypeError, AttributeError):
+        pass
+    raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error_message, additional_info)
+
+
+class AsyncAWSTransport:
+    '''
+    Sends SigV4-signed requests over one aiohttp session, whose connector keeps up to
+    maxsize connections open.  Share one transport among clients to share the pool.
+    Bodies are encoded and responses parsed with serializer (see escodec.py), and
+    the phases of a measured call are timed as by AWSSignedConnection.
+    '''
+
+    def __init__(self, host, port=443, region='us-east-1', credentials=None, use_ssl=True,
+                 maxsize=100, timeout=10, service='es', serializer=None):
+        if aiohttp is None:
+            raise ImportError("AsyncAWSTransport requires aiohttp (pip install aiohttp)")
+        if credentials is None:
+            credentials = shared_credential_cache()
+        self.credentials = credentials
+        self.serializer = serializer if serializer else DEFAULT_SERIALIZER
+        self.signer = credentials.signer(region, service)
+        scheme = 'https' if use_ssl else 'http'
+        self.base_url = '%s://%s:%s' % (scheme, host, port)
+        self.host_header = host if port in (80, 443) else '%s:%s' % (host, port)
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.session = None
+
+    def get_session(self):
+        '''Get the aiohttp session, creating it (inside the running loop) on first use'''
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.maxsize),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def perform_request(self, method, path, params=None, body=None, headers=None):
+        '''
+        Sign and send one request, returning the decoded JSON response (or a bool for HEAD).
+        Raises the same exceptions as the sync Elasticsearch transport.
+        '''
+        call = current_call()
+        if call is not None:
+            call.handed_off = time.perf_counter()
+        query = canonical_query(params)
+        url = '%s?%s' % (path, query) if query else path
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif body is not None and not isinstance(body, bytes):
+            body = self.serializer.dumps_bytes(body)
+        if call is not None:
+            call.sending(body)
+        headers = dict({'content-type' : 'application/json'}, **(headers or {}))
+        sign_start = time.perf_counter()
+        headers.update(self.signer.sign(self.credentials.current(), method, self.host_header,
+                                         path, query, body))
+        send_start = time.perf_counter()
+        if call is not None:
+            call.add('sign', send_start - sign_start)
+        try:
+            async with self.get_session().request(method, URL(self.base_url + url, encoded=True),
+                                                  data=body, headers=headers) as response:
+                status = response.status
+                raw_data = await response.read()
+                if call is not None:
+                    call.received(raw_data, send_start, response.headers.get('content-length'))
+        except asyncio.TimeoutError as ex:
+            raise ConnectionTimeout('TIMEOUT', str(ex), ex)
+        except aiohttp.ClientError as ex:
+            raise ESConnectionError('N/A', str(ex), ex)
+        if method == 'HEAD':
+            return 200 <= status < 300
+        if not 200 <= status < 300:
+            raise_transport_error(status, raw_data.decode('utf-8', 'replace'))
+        if not raw_data:
+            return {}
+        result = self.serializer.loads(raw_data)
+        if call is not None:
+            call.since('parse', call.received_at)
+            call.received_at = None
+            if isinstance(result, dict) and 'took' in result:
+                call.add('server', result['took'] / 1000.0)
+        return result
+
+    async def close(self):
+        '''Close the session and its pooled connections'''
+        if self.session is not None:
+            await self.session.close()
+
+
+def get_async_transport(use_boto=True, maxsize=100, serializer=None):
+    '''Get an async transport for one AWS ES domain (determined by hostname), as in get_elasticsearch_client'''
+    hostname = os.environ.get('AWS_ELASTICSEARCH_HOST')
+    region = os.environ.get('AWS_DEFAULT_REGION')
+    if region is None:
+        region = 'us-east-1'
+    return AsyncAWSTransport(hostname, 443, region, shared_credential_cache(use_boto), maxsize=maxsize,
+                             serializer=serializer)
+
+
+NOT_MEASURED = nullcontext()
+
+
+class AsyncElasticsearchClient:
+    '''
+    asyncio client for searching one Elasticsearch index and type.  Its methods are
+    coroutine versions of ElasticsearchClient's, built on the same requests and reports.
+    '''
+
+    def __init__(self, zot_id, use_boto=True, doc_type='kb_document', transport=None, maxsize=100,
+                 cache=None, single_flight=None, metrics=None, shared=False):
+        '''
+        Save the transport (shared if given), index, and type, and optionally
+        a SearchCache, an AsyncSingleFlight, and a RequestMetrics, as in ElasticsearchClient.
+        If shared is set, every query is filtered by zot_id, as in ElasticsearchClient.
+        '''
+        self.use_boto = use_boto
+        self.transport = transport if transport else get_async_transport(use_boto, maxsize)
+        self.zot_id = zot_id
+        self.index_name = zot_index_name(zot_id)
+        self.doc_type = doc_type
+        self.cache = cache
+        self.single_flight = single_flight
+        self.metrics = metrics
+        self.shared = shared
+        self.serializer = self.transport.serializer
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        '''Close the transport'''
+        await self.transport.close()
+
+    def measure(self, operation):
+        '''
+        Context manager measuring one call of operation (yielding its CallTimer) if metrics
+        are enabled, or doing nothing (yielding None) if not.
+        '''
+        return self.metrics.call(operation) if self.metrics is not None else NOT_MEASURED
+
+    async def perform_request(self, method, path, params=None, body=None, headers=None):
+        '''Send one request (e.g. from search_request) through the transport'''
+        return await self.transport.perform_request(method, path, params=params, body=body,
+                                                    headers=headers)
+
+    async def info(self):
+        '''Get info about the Elasticsearch cluster'''
+        return await self.perform_request('GET', '/')
+
+    async def search_index(self, qstring, offset=0, max_size=10, query_builder=most_fields_query,
+                           lean=False):
+        '''Search the index using all the parameters, as in ElasticsearchClient.search_index'''
+        build_start = time.perf_counter()
+        body = search_body(qstring, query_builder, self.zot_id if self.shared else None, lean)
+        if self.cache is not None:
+            key = self.cache.key(self.index_name, body, offset, max_size)
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+        with self.measure('search') as call:
+            try:
+                request = search_request(self.index_name, self.doc_type, body, offset, max_size)
+                if call is not None:
+                    call.since('build', build_start)
+                if self.single_flight is not None:
+                    flight_key = canonical_key(self.index_name, body, offset, max_size)
+                    results = await self.single_flight.do(flight_key, self.perform_request, *request)
+                else:
+                    results = await self.perform_request(*request)
+            except (TypeError, TransportError) as ex:
+                report_search_error(ex, 'AsyncElasticsearchClient.search_index')
+                return None
+        if self.cache is not None:
+            self.cache.put(key, results)
+        return results
+
+    def invalidate_cache(self, index_name=None):
+        '''Forget cached search results for an index (self.index_name by default)'''
+        if self.cache is not None:
+            self.cache.invalidate(self.index_name if index_name is None else index_name)
+
+    async def search_many(self, queries, offset=0, max_size=10, min_score=0.0,
+                          max_queries=MSEARCH_MAX_QUERIES, max_bytes=MSEARCH_MAX_BYTES, lean=False):
+        '''Run many query bodies in _msearch batches, as in ElasticsearchClient.search_many'''
+        queries, sent = search_many_bodies(queries, self.zot_id if self.shared else None, lean)
+        results = []
+        for count, body in msearch_batches(self.index_name, self.doc_type, sent, offset,
+                                           max_size, max_queries, max_bytes, self.serializer):
+            with self.measure('msearch'):
+                try:
+                    response = await self.perform_request(*msearch_request(body), headers=NDJSON_HEADERS)
+                    results += msearch_results(response, 'AsyncElasticsearchClient.search_many')
+                except TransportError as ex:
+                    report_search_error(ex, 'AsyncElasticsearchClient.search_many')
+                    results += [None] * count
+        return search_many_results(self.index_name, queries, results, min_score, lean)
+
+    async def create_index(self, index_name=None, type_mappings=None):
+        '''Create an index (self.index_name by default)'''
+        if index_name is None:
+            index_name = self.index_name
+        try:
+            result = await self.perform_request(*create_index_request(index_name, type_mappings))
+            return result['acknowledged'] and result['shards_acknowledged']
+        except TransportError as ex:
+            report_create_index_error(ex, 'AsyncElasticsearchClient.create_index')
+        finally:
+            self.invalidate_cache(index_name)
+        return False
+
+    async def delete_index(self, index_name=None, **kwargs):
+        '''Delete an index (self.index_name by default)'''
+        if index_name is None:
+            index_name = self.index_name
+        try:
+            result = await self.perform_request(*delete_index_request(index_name, **kwargs))
+            return result['acknowledged']
+        except TransportError as ex:
+            report_delete_index_error(ex, 'AsyncElasticsearchClient.delete_index')
+        finally:
+            self.invalidate_cache(index_name)
+        return False
@@ -3,22 +3,38 @@
 '''Elasticsearch with boto3'''
 
 import argparse
+from array import array
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+import gzip
+import heapq
+import itertools
+import json
 import os
-import pdb
+import queue
+import random
+import re
+import threading
 import time
+import unicodedata
+import uuid
 #from dateutil.parser import parse as parse_date
 
 import boto3
 import botocore
 # import requests
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
-from requests_aws4auth import AWS4Auth
 
 from elasticsearch import Elasticsearch
-from elasticsearch import RequestsHttpConnection
+from elasticsearch.exceptions import ConnectionTimeout, NotFoundError
 from elasticsearch.exceptions import TransportError
 
+from escache import SearchCache, canonical_key
+from escodec import DEFAULT_SERIALIZER, JSON_LIBRARIES, get_serializer
+from eslatency import RequestMetrics, measured_call
+from esresilience import ResilientTransport
+from estransport import AWSSignedConnection, shared_credential_cache
+
 
 
 def match_query(qstring):
@@ -94,6 +110,67 @@ def wildcard_query(qstring, property_name='content'):
         }
     }
 
+SUBSTRING_NGRAM_SIZE = 3
+
+# Letters that asciifolding maps to ASCII but that have no Unicode decomposition
+ASCII_FOLDINGS = str.maketrans({'ß' : 'ss', 'æ' : 'ae', 'œ' : 'oe', 'ø' : 'o', 'đ' : 'd',
+                                'ð' : 'd', 'ł' : 'l', 'þ' : 'th', 'ı' : 'i'})
+
+def fold_ngram_text(text):
+    '''Lowercase and ASCII-fold text as the substring_ngram analyzer does (lowercase, asciifolding)'''
+    decomposed = unicodedata.normalize('NFKD', text.lower().translate(ASCII_FOLDINGS))
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def substring_query(qstring, property_name='content.ngram', ngram_size=SUBSTRING_NGRAM_SIZE):
+    '''Prepare a substring query on the n-gram subfield of a field (e.g. "content.ngram").
+    Unlike wildcard_query, it needs no scan of the term dictionary: the qstring is split into
+    the same n-grams as the indexed text, and a phrase query on them matches only where they
+    are contiguous, i.e. where qstring is a substring (even one spanning words, e.g. "ton off").
+    NOTE: Matching is case- and accent-insensitive.
+    NOTE: A qstring shorter than ngram_size becomes a prefix query on the (few) n-gram terms.
+    '''
+    if len(qstring) < ngram_size:
+        return {
+            'query' : {
+                'prefix' : {
+                    property_name : fold_ngram_text(qstring)
+                }
+            }
+        }
+    return {
+        'query' : {
+            'match_phrase' : {
+                property_name : qstring
+            }
+        }
+    }
+
+QUERY_BUILDERS = {
+    'match_query' : match_query,
+    'most_fields_query' : most_fields_query,
+    'match_phrase_query' : match_phrase_query,
+    'query_string_query' : query_string_query,
+    'wildcard_query' : wildcard_query,
+    'substring_query' : substring_query,
+}
+
+def compare_query_builders(es_client, qstring, builder_names, repeat=10):
+    '''
+    Benchmark query builders against each other by running the same qstring through each
+    of them repeat times.  Prints the mean client and server (took) times and total hits.
+    '''
+    print("%-20s %10s %10s %8s" % ('builder', 'client ms', 'server ms', 'hits'))
+    for name in builder_names:
+        client_ms, server_ms, total = 0.0, 0.0, 0
+        for _ in range(repeat):
+            beg_time = time.time()
+            results = es_client.search_index(qstring, query_builder=QUERY_BUILDERS[name], verbose=0)
+            client_ms += 1000.0 * (time.time() - beg_time)
+            if results:
+                server_ms += results['took']
+                total = results['hits']['total']
+        print("%-20s %10.2f %10.2f %8d" % (name, client_ms / repeat, server_ms / repeat, total))
+
 def get_aws_es_service_client(service_name='es'):
     '''Get client for the AWS Elasticsearch domain service'''
     return boto3.client(service_name)
@@ -122,36 +199,34 @@ def try_aws_es_service_client(args):
     return aws_es_service_client
 
 
-def get_aws_auth(hostname, region, use_boto=True):
-    '''Get http_aoth for AWS clients'''
-    if use_boto:
-        try:
-            return BotoAWSRequestsAuth(aws_host=hostname, aws_region=region, aws_service='es')
-        except TypeError as ex:
-            print("No AWS credentials in ~/.aws/credentials ?", ex)
-    else:
-        access_key = os.environ.get('AWS_ACCESS_KEY_ID')
-        secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-        try:
-            return AWS4Auth(access_key, secret_key, region, 'es')
-        except TypeError as ex:
-            print("No AWS credentials exported to ENV ?", ex)
-    return None
-
-def get_elasticsearch_client(use_boto=True):
-    '''Get Elasticsearch client for one AWS ES domain (determined by hostname)'''
-    hostname = os.environ.get('AWS_ELASTICSEARCH_HOST')
+def get_elasticsearch_client(use_boto=True, maxsize=10, hostname=None, port=443, use_ssl=True,
+                             credentials=None, max_retries=3, http_compress=False, serializer=None):
+    '''
+    Get Elasticsearch client for one AWS ES domain (determined by hostname, by default
+    from ENV).  Requests are SigV4-signed, with credentials from a CredentialCache (by default
+    the shared one), and sent over a pool of up to maxsize persistent connections.
+    Pass max_retries=0 when a ResilientTransport (esresilience.py) handles retries.
+    With http_compress, large request bodies and all responses are gzipped.  JSON is
+    encoded and parsed by serializer (see escodec.py), by default the fastest installed.
+    '''
+    if hostname is None:
+        hostname = os.environ.get('AWS_ELASTICSEARCH_HOST')
     region = os.environ.get('AWS_DEFAULT_REGION')
     if region is None:
-        # import pdb; pdb.set_trace()
         region = 'us-east-1'
-    aws_auth = get_aws_auth(hostname, region, use_boto)
+    if credentials is None:
+        credentials = shared_credential_cache(use_boto)
     return Elasticsearch(
-        hosts=[{'host': hostname, 'port': 443}],
-        http_auth=aws_auth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection
+        hosts=[{'host': hostname, 'port': port}],
+        region=region,
+        credentials=credentials,
+        maxsize=maxsize,
+        max_retries=max_retries,
+        use_ssl=use_ssl,
+        verify_certs=use_ssl,
+        http_compress=http_compress,
+        serializer=serializer if serializer else DEFAULT_SERIALIZER,
+        connection_class=AWSSignedConnection
     )
 
 
@@ -175,13 +250,79 @@ def truncate(string, maxlen=MAXLEN):
 
 ESResult = namedtuple('ESResult', 'hit_score doc_id entry_id')
 
-def extract_scores_and_ids(index_name, qstring, results, min_score):
+
+class CompactResults:
+    '''
+    Hits decoded into parallel arrays of scores (doubles), doc_ids, and entry_ids,
+    with no object per hit.  Iterating or indexing yields ESResult tuples on demand.
+    '''
+    __slots__ = ('scores', 'doc_ids', 'entry_ids')
+
+    def __init__(self, scores=None, doc_ids=None, entry_ids=None):
+        self.scores = scores if scores is not None else array('d')
+        self.doc_ids = doc_ids if doc_ids is not None else []
+        self.entry_ids = entry_ids if entry_ids is not None else []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, pos):
+        return ESResult(self.scores[pos], self.doc_ids[pos], self.entry_ids[pos])
+
+    def __iter__(self):
+        return map(ESResult, self.scores, self.doc_ids, self.entry_ids)
+
+
+def hit_doc_id(hit):
+    '''kb_document_id of a hit, from its stored fields (lean searches) or its _source'''
+    fields = hit.get('fields')
+    return fields['kb_document_id'][0] if fields is not None else hit['_source']['kb_document_id']
+
+MALFORMED_HIT_ERRORS = (KeyError, IndexError, TypeError)
+
+def extract_compact_hits(hits, min_score):
+    '''Decode hits one at a time into a CompactResults, skipping (and reporting) malformed ones'''
+    compact, skipped = CompactResults(), 0
+    for hit in hits:
+        try:
+            score, doc_id, entry_id = hit['_score'], hit_doc_id(hit), hit['_id']
+            if min_score is not None and score < min_score:
+                continue
+            compact.scores.append(score)
+        except MALFORMED_HIT_ERRORS:
+            skipped += 1
+            continue
+        compact.doc_ids.append(doc_id)
+        compact.entry_ids.append(entry_id)
+    if skipped:
+        print("extract_compact: skipped %d malformed hits of %d" % (skipped, len(hits)))
+    return compact
+
+def extract_compact(results, min_score):
+    '''
+    Decode the hits of results into (CompactResults, max_score, sum_score).
+    A hit without a _score, _id, or kb_document_id is skipped, not the whole page.
+    '''
+    hits = results['hits'].get('hits', ())
+    try:
+        if min_score is not None:
+            hits = [hit for hit in hits if hit['_score'] >= min_score]
+        scores = array('d', [hit['_score'] for hit in hits])
+        compact = CompactResults(scores, [hit_doc_id(hit) for hit in hits], [hit['_id'] for hit in hits])
+    except MALFORMED_HIT_ERRORS:
+        compact = extract_compact_hits(results['hits'].get('hits', ()), min_score)
+    return compact, results['hits'].get('max_score'), sum(compact.scores, 0.0)
+
+def extract_scores_and_ids(index_name, qstring, results, min_score, compact=False):
     '''
     Convert raw Elasticsearch results into simple tuples.
+    If compact is set, the results are decoded into CompactResults instead of a list.
     '''
-    es_results, max_score, sum_score = [], 0.0, 0.0
+    es_results, max_score, sum_score = CompactResults() if compact else [], 0.0, 0.0
     if results:
         try:
+            if compact:
+                return extract_compact(results, min_score)
             max_score = results['hits']['max_score']
             for hit in results['hits']['hits']:
                 score = hit['_score']
@@ -224,10 +365,182 @@ def print_hits(results, min_score=0.0, maxlen=MAXLEN, verbose=1):
         print("---- NO RESULTS ----")
 
 
+###############################################################################
+# Profiling: searches run with "profile": true return, per shard, a tree of timed
+# query components (e.g. one TermQuery per field and term) and the collectors.
+
+PROFILE_TOP_CLAUSES = 10
+PROFILE_FIELD_PATTERN = re.compile(r'([\w.]+):')
+
+ProfileNode = namedtuple('ProfileNode', 'shard depth type description nanos self_nanos breakdown')
+
+def profile_nodes(results):
+    '''
+    Flatten the query trees of a profiled search into ProfileNodes, depth first.
+    A node's self_nanos is its time less its children's.
+    '''
+    nodes = []
+    def visit(shard, node, depth):
+        '''Add a node and its descendants'''
+        children = node.get('children', [])
+        child_nanos = sum(child['time_in_nanos'] for child in children)
+        nodes.append(ProfileNode(shard, depth, node['type'], node['description'], node['time_in_nanos'],
+                                 max(node['time_in_nanos'] - child_nanos, 0), node.get('breakdown', {})))
+        for child in children:
+            visit(shard, child, depth + 1)
+    for shard in results.get('profile', {}).get('shards', []):
+        for search in shard['searches']:
+            for node in search['query']:
+                visit(shard['id'], node, 0)
+    return nodes
+
+def profile_collectors(results):
+    '''Get (shard, depth, name, reason, nanos) for every collector of a profiled search'''
+    collectors = []
+    def visit(shard, collector, depth):
+        '''Add a collector and its children'''
+        collectors.append((shard, depth, collector['name'], collector['reason'], collector['time_in_nanos']))
+        for child in collector.get('children', []):
+            visit(shard, child, depth + 1)
+    for shard in results.get('profile', {}).get('shards', []):
+        for search in shard['searches']:
+            for collector in search['collector']:
+                visit(shard['id'], collector, 0)
+    return collectors
+
+def clause_fields(description):
+    '''Get the sorted field names (e.g. content, content.raw) a clause description mentions'''
+    return ','.join(sorted(set(PROFILE_FIELD_PATTERN.findall(description))))
+
+def print_profile(results, maxlen=MAXLEN):
+    '''Print the query tree and collectors of a profiled search, shard by shard, in ms'''
+    if not results or 'profile' not in results:
+        print("---- NO PROFILE ----")
+        return
+    shard = None
+    for node in profile_nodes(results):
+        if node.shard != shard:
+            shard = node.shard
+            print('-' * maxlen)
+            print('Shard %s' % shard)
+        print('%9.3f ms %9.3f self  %s%s  %s' % (node.nanos / 1e6, node.self_nanos / 1e6, '  ' * node.depth,
+                                                node.type, truncate(node.description, maxlen // 2)))
+    for shard, depth, name, reason, nanos in profile_collectors(results):
+        print('%9.3f ms collector  %s%s (%s) [%s]' % (nanos / 1e6, '  ' * depth, name, reason, shard))
+    print('=' * maxlen)
+
+
+class ProfileAggregator:
+    '''
+    Accumulates profiled searches and reports the clauses (query type and fields) with
+    the most self time, how that time breaks down (e.g. score, next_doc, build_scorer),
+    and the time in each collector.
+    '''
+
+    def __init__(self):
+        self.searches = 0
+        self.clauses = {}
+        self.breakdowns = {}
+        self.collectors = {}
+
+    def add(self, results):
+        '''Add the profile of one search'''
+        if not results or 'profile' not in results:
+            return
+        self.searches += 1
+        for node in profile_nodes(results):
+            key = (node.type, clause_fields(node.description))
+            count, nanos, self_nanos = self.clauses.get(key, (0, 0, 0))
+            self.clauses[key] = (count + 1, nanos + node.nanos, self_nanos + node.self_nanos)
+            breakdown = self.breakdowns.setdefault(key, {})
+            for component, component_nanos in node.breakdown.items():
+                if not component.endswith('_count'):
+                    breakdown[component] = breakdown.get(component, 0) + component_nanos
+        for _, _, name, reason, nanos in profile_collectors(results):
+            count, total = self.collectors.get((name, reason), (0, 0))
+            self.collectors[(name, reason)] = (count + 1, total + nanos)
+
+    def hottest(self, top=PROFILE_TOP_CLAUSES):
+        '''Get the top clauses by total self time as (type, fields, count, nanos, self_nanos)'''
+        ranked = sorted(self.clauses.items(), key=lambda item: item[1][2], reverse=True)
+        return [key + val for key, val in ranked[:top]]
+
+    def report(self, top=PROFILE_TOP_CLAUSES, maxlen=MAXLEN):
+        '''Print the hottest clauses and the collectors'''
+        print('=' * maxlen)
+        print('Hottest clauses over %d profiled searches (ms)' % self.searches)
+        print('%10s %10s %6s  %-28s %s' % ('self', 'total', 'count', 'type', 'fields'))
+        for clause_type, fields, count, nanos, self_nanos in self.hottest(top):
+            print('%10.3f %10.3f %6d  %-28s %s' % (self_nanos / 1e6, nanos / 1e6, count, clause_type, fields))
+            components = sorted(self.breakdowns[(clause_type, fields)].items(),
+                                key=lambda item: item[1], reverse=True)
+            print('%29s %s' % ('', ', '.join('%s %.3f' % (component, nanos / 1e6)
+                                             for component, nanos in components[:4] if nanos)))
+        print('-' * maxlen)
+        for (name, reason), (count, nanos) in sorted(self.collectors.items(), key=lambda item: -item[1][1]):
+            print('%10.3f %17d  collector %s (%s)' % (nanos / 1e6, count, name, reason))
+        print('=' * maxlen)
+
+
 def zot_index_name(zot_id):
-    '''get Elasticsearch index name from zot_id'''
+    '''
+    get Elasticsearch index name from zot_id.
+    NOTE: Once built by rebuild_index, this name is an alias for a versioned index.
+    '''
     return "zot{}".format(zot_id)
 
+###############################################################################
+# Shared tenancy: instead of one index per zot_id, tenants share a few physical indices
+# (zots0 ... zots7).  Each entry is tagged with its zot_id and routed by it, so a
+# tenant's entries live on one shard, and zot<ID> becomes a filtered, routed alias,
+# so that ElasticsearchClient(zot_id) searches only that tenant's entries unchanged.
+
+SHARED_INDEX_PREFIX = 'zots'
+SHARED_INDEX_COUNT = 8
+
+def shared_index_name(zot_id, count=SHARED_INDEX_COUNT):
+    '''get the name of the shared index that holds zot_id's entries'''
+    return "{}{}".format(SHARED_INDEX_PREFIX, zot_id % count)
+
+def tenant_routing(zot_id):
+    '''get the _routing value for a tenant's entries'''
+    return str(zot_id)
+
+def tenant_filter(zot_id):
+    '''get the filter matching only a tenant's entries'''
+    return {'term' : {'zot_id' : zot_id}}
+
+def tenant_query(body, zot_id):
+    '''Restrict a search body (e.g. from most_fields_query) to one tenant with a non-scoring filter'''
+    tenant_body = dict(body)
+    tenant_body['query'] = {'bool' : {'must' : body.get('query', {'match_all' : {}}),
+                                      'filter' : tenant_filter(zot_id)}}
+    return tenant_body
+
+def tenant_query_builder(query_builder, zot_id):
+    '''Wrap a query builder so that every query it builds is restricted to one tenant'''
+    def build_tenant_query(qstring):
+        '''Build the query and add the tenant filter'''
+        return tenant_query(query_builder(qstring), zot_id)
+    build_tenant_query.__name__ = query_builder.__name__
+    return build_tenant_query
+
+def tenant_alias_action(zot_id, index_name):
+    '''get the update_aliases action making zot<ID> a filtered, routed alias into a shared index'''
+    return {'add' : {'index' : index_name, 'alias' : zot_index_name(zot_id),
+                     'filter' : tenant_filter(zot_id), 'routing' : tenant_routing(zot_id)}}
+
+def versioned_index_name(alias, version):
+    '''get the name of one physical version of an aliased index, e.g. zot7777777_v3'''
+    return "{}_v{}".format(alias, version)
+
+def index_version(alias, index_name):
+    '''get the version number of a physical index name, or None if it is not a version of alias'''
+    prefix = "{}_v".format(alias)
+    if index_name.startswith(prefix) and index_name[len(prefix):].isdigit():
+        return int(index_name[len(prefix):])
+    return None
+
 
 def kb_document_mappings():
     '''Default type mappings for kb_documents'''
@@ -247,108 +560,748 @@ def kb_document_mappings():
                             "index" : "not_analyzed",
                             "analyzer" : "case_sensitive_text",
                             "store" : True,
+                        },
+                        "ngram" : {
+                            "type" : "text",
+                            "analyzer" : "substring_ngram",
                         }
                     },
                 },
                 "kb_document_id" : {
                     "store" : True,
                     "type" : "string"
+                },
+                "kb_entry_id" : {
+                    "type" : "keyword"
+                },
+                "zot_id" : {
+                    "type" : "keyword"
+                },
+                "suggest" : {
+                    "type" : "completion",
+                    "analyzer" : "simple",
+                    "max_input_length" : 50,
+                    "contexts" : [
+                        {"name" : "zot_id", "type" : "category", "path" : "zot_id"}
+                    ]
                 }
             }
         }
     }
 
 
-def create_index(elastic_search, index_name, type_mappings=None):
+def create_index_body(type_mappings=None):
     '''
     1)  For keywords: case-insensitive keywords with default AND operators (intersection),
         light stemming. (query analyzed the same way).
     2)  For phrases: with default semantic fuzziness of 1, not_analyzed,
         and possibly with n-grams (query also not_analyzed).
+    3)  For substrings: content.ngram indexes lowercased, ascii-folded n-grams
+        (see substring_query).
     '''
     if type_mappings is None:
         type_mappings = kb_document_mappings()
-    return elastic_search.indices.create(
-        index=index_name,
-        body={
-            "settings" : {
-                "analysis" : {
-                    "analyzer" : {
-                        "case_sensitive_text" : {
-                            "kb_document" : "custom",
-                            "tokenizer" : "standard",
-                            "filter" : ["my_english_stemmer"] # ["standard", "my_stemmer"]
-                        }
-                    },
-                    "normalizer": {
-                        "lower_ascii_normalizer": {
-                            "type": "custom",
-                            "filter":  ["lowercase", "asciifolding"]
-                        }
+    return {
+        "settings" : {
+            "analysis" : {
+                "analyzer" : {
+                    "case_sensitive_text" : {
+                        "kb_document" : "custom",
+                        "tokenizer" : "standard",
+                        "filter" : ["my_english_stemmer"] # ["standard", "my_stemmer"]
                     },
-                    "filter" : {
-                        "my_english_stemmer" : {
-                            "type" : "stemmer",
-                            "name" : "light_english"
-                        }
+                    "substring_ngram" : {
+                        "type" : "custom",
+                        "tokenizer" : "substring_ngram",
+                        "filter" : ["lowercase", "asciifolding"]
+                    }
+                },
+                "tokenizer" : {
+                    # All characters are kept, so grams span spaces (and bigrams match)
+                    "substring_ngram" : {
+                        "type" : "ngram",
+                        "min_gram" : SUBSTRING_NGRAM_SIZE,
+                        "max_gram" : SUBSTRING_NGRAM_SIZE
+                    }
+                },
+                "normalizer": {
+                    "lower_ascii_normalizer": {
+                        "type": "custom",
+                        "filter":  ["lowercase", "asciifolding"]
+                    }
+                },
+                "filter" : {
+                    "my_english_stemmer" : {
+                        "type" : "stemmer",
+                        "name" : "light_english"
                     }
                 }
-            },
-            "mappings" : kb_document_mappings(),
+            }
+        },
+        "mappings" : type_mappings,
+    }
+
+def create_index(elastic_search, index_name, type_mappings=None):
+    '''Create an index with the settings and mappings from create_index_body'''
+    return elastic_search.indices.create(index=index_name, body=create_index_body(type_mappings))
+
+
+###############################################################################
+# Requests and error reports shared by ElasticsearchClient and AsyncElasticsearchClient
+# (esasync.py), so that the sync and async clients cannot drift apart.
+# Each *_request function returns the (method, path, params, body) of one request.
+
+def search_request(index_name, doc_type, body, offset=0, max_size=10):
+    '''Request to search one index and type'''
+    return 'POST', '/%s/%s/_search' % (index_name, doc_type), {'from' : offset, 'size' : max_size}, body
+
+# Lean searches return only what extract_scores_and_ids needs: each hit's _score, _id,
+# and stored kb_document_id, without _source (and its big content).  A filter_path to
+# also drop each hit's _index and _type would cost the client more CPU to URL-encode
+# than it saves in parsing.
+LEAN_STORED_FIELDS = ['kb_document_id']
+
+def lean_search_body(body):
+    '''Copy of a search body that fetches only the stored kb_document_id of each hit'''
+    return dict(body, _source=False, stored_fields=LEAN_STORED_FIELDS)
+
+def search_body(qstring, query_builder=most_fields_query, zot_id=None, lean=False):
+    '''
+    Body for a search of qstring, filtered to zot_id's entries if given (for a tenant
+    in a shared index), and lean (see lean_search_body) if set.
+    '''
+    body = query_builder(qstring)
+    if zot_id is not None:
+        body = tenant_query(body, zot_id)
+    return lean_search_body(body) if lean else body
+
+# Unique per entry, and a keyword with doc values: sorting on _id instead would load
+# its fielddata onto the heap.  Indexes made before kb_entry_id existed can pass '_id'.
+SEARCH_AFTER_TIEBREAKER = 'kb_entry_id'
+
+def search_after_request(index_name, doc_type, body, page_size, search_after=None,
+                         sort=None, preference=None, tiebreaker=SEARCH_AFTER_TIEBREAKER):
+    '''
+    Request for one page of a search_after cursor.  The sort must end with a unique
+    tiebreaker field; by default hits are sorted by _score, then by the tiebreaker.
+    A preference string keeps all pages on the same shard copies, so scores stay stable.
+    '''
+    page_body = dict(body)
+    page_body['sort'] = sort if sort else [{'_score' : 'desc'}, {tiebreaker : 'asc'}]
+    if search_after is not None:
+        page_body['search_after'] = search_after
+    method, path, params, page_body = search_request(index_name, doc_type, page_body, 0, page_size)
+    if preference:
+        params['preference'] = preference
+    return method, path, params, page_body
+
+def create_index_request(index_name, type_mappings=None):
+    '''Request to create an index'''
+    return 'PUT', '/%s' % index_name, None, create_index_body(type_mappings)
+
+def delete_index_request(index_name, **params):
+    '''Request to delete an index'''
+    return 'DELETE', '/%s' % index_name, params or None, None
+
+def exception_error(ex):
+    '''Get the error type (e.g. index_not_found_exception) of a TransportError as a string'''
+    return str(getattr(ex, 'error', ex))
+
+def report_search_error(ex, caller='ElasticsearchClient.search_index'):
+    '''Print a search exception (quietly if the index is not found)'''
+    if 'index_not_found_exception' in exception_error(ex):
+        print("%s: Ignoring index_not_found_exception" % caller)
+    else:
+        print("%s: Unexpected exception:" % caller, ex)
+
+def report_create_index_error(ex, caller='ElasticsearchClient.create_index'):
+    '''Print a create index exception (quietly if the index already exists)'''
+    if "index_already_exists_exception" in exception_error(ex):
+        print("%s: Ignoring index_already_exists_exception" % caller)
+    else:
+        print("%s: exception:" % caller, ex)
+
+def report_delete_index_error(ex, caller='ElasticsearchClient.delete_index'):
+    '''Print a delete index exception (quietly if the index is not found)'''
+    if "index_not_found_exception" in exception_error(ex):
+        print("%s: Ignoring index_not_found_exception" % caller)
+    else:
+        print("%s: exception:" % caller, ex)
+
+MSEARCH_MAX_QUERIES = 100
+MSEARCH_MAX_BYTES = 1024 * 1024
+NDJSON_HEADERS = {'content-type' : 'application/x-ndjson'}
+
+def msearch_request(ndjson_body):
+    '''Request for a batch of searches, already encoded as _msearch NDJSON bytes'''
+    return 'POST', '/_msearch', None, ndjson_body
+
+def msearch_batches(index_name, doc_type, queries, offset=0, max_size=10,
+                    max_queries=MSEARCH_MAX_QUERIES, max_bytes=MSEARCH_MAX_BYTES, serializer=None):
+    '''
+    Encode query bodies as _msearch NDJSON, split into batches of at most max_queries
+    searches and (unless a single search is larger) at most max_bytes bytes.
+    Queries that do not set their own from and size get offset and max_size.
+    Yields (number_of_searches, NDJSON bytes) for each batch.
+    '''
+    dumps = (serializer if serializer else DEFAULT_SERIALIZER).dumps_bytes
+    header = dumps({'index' : index_name, 'type' : doc_type}) + b'\n'
+    def search_lines():
+        '''Header and body lines for each search'''
+        for query in queries:
+            body = dict(query)
+            body.setdefault('from', offset)
+            body.setdefault('size', max_size)
+            yield b''.join((header, dumps(body), b'\n'))
+    for batch in chunk_bulk_lines(search_lines(), max_queries, max_bytes):
+        yield len(batch), b''.join(batch)
+
+def msearch_results(response, caller='ElasticsearchClient.search_many'):
+    '''Get the search results from an _msearch response, with None for each failed search'''
+    results = []
+    for pos, sub_response in enumerate(response['responses']):
+        if 'error' in sub_response:
+            print("%s: search %d failed with status %s: %s"
+                  % (caller, pos, sub_response.get('status'), sub_response['error']))
+            results.append(None)
+        else:
+            results.append(sub_response)
+    return results
+
+def search_many_bodies(queries, zot_id=None, lean=False):
+    '''
+    Get the query bodies of a search_many, filtered to zot_id's entries if given,
+    and the bodies to send for them, lean if set.  Returns (queries, sent).
+    '''
+    queries = list(queries)
+    if zot_id is not None:
+        queries = [tenant_query(query, zot_id) for query in queries]
+    return queries, [lean_search_body(query) for query in queries] if lean else queries
+
+def search_many_results(index_name, queries, results, min_score=0.0, compact=False):
+    '''
+    Get the extract_scores_and_ids of each query's results (None if it failed), in query order.
+    A query is only encoded for the report of its missing results.
+    '''
+    return [extract_scores_and_ids(index_name, None if result else truncate(json.dumps(query)),
+                                   result, min_score, compact)
+            for query, result in zip(queries, results)]
+
+SUGGEST_NAME = 'entry_suggest'
+SUGGEST_CACHE_ENTRIES = 1024
+SUGGEST_CACHE_TTL = 30.0
+
+Suggestion = namedtuple('Suggestion', 'text score doc_id entry_id')
+
+def suggest_request(index_name, prefix, size=5, fuzzy=False, zot_id=None):
+    '''
+    Request for completion suggestions (from the suggest field's FST) for a prefix.
+    Suggesters ignore alias filters, so in a shared index pass zot_id to suggest
+    only that tenant's entries.
+    '''
+    completion = {'field' : 'suggest', 'size' : size, 'skip_duplicates' : True}
+    if fuzzy:
+        completion['fuzzy'] = {'fuzziness' : 'AUTO'}
+    if zot_id is not None:
+        completion['contexts'] = {'zot_id' : [tenant_routing(zot_id)]}
+    body = {
+        '_source' : ['kb_document_id'],
+        'suggest' : {
+            SUGGEST_NAME : {
+                'prefix' : prefix,
+                'completion' : completion
+            }
         }
-    )
+    }
+    return 'POST', '/%s/_search' % index_name, None, body
 
+def suggestions_from(response):
+    '''Convert a completion suggester response into a list of Suggestion tuples'''
+    return [Suggestion(option['text'], option['_score'],
+                       option.get('_source', {}).get('kb_document_id'), option['_id'])
+            for entry in response['suggest'][SUGGEST_NAME]
+            for option in entry['options']]
+
+
+###############################################################################
+# Bulk indexing: actions are generated, serialized, and sent in bounded chunks,
+# so memory use stays flat no matter how many entries are indexed.
+
+BULK_MAX_DOCS = 1000
+BULK_MAX_BYTES = 5 * 1024 * 1024
+BULK_MAX_PRINTED_ERRORS = 10
+BULK_MAX_RETRIES = 8
+BULK_QUEUE_CHUNKS_PER_WORKER = 2
+BULK_LOAD_SETTINGS = {'refresh_interval' : '-1', 'number_of_replicas' : 0}
+
+BulkResult = namedtuple('BulkResult', 'indexed failed')
+
+def make_entry_hashes(index_name, doc, doc_type='kb_document', zot_id=None):
+    '''
+    Generate one (action, source) pair per entry of a kb_document.
+    A doc is a dict with an 'id' and a list of 'entries', each with an 'id' and 'content'.
+    For a shared index, pass zot_id to tag each entry with its tenant and route it.
+    '''
+    kb_document_id = doc['id']
+    for entry in doc['entries']:
+        action = {'index' : {'_index' : index_name, '_type' : doc_type, '_id' : entry['id']}}
+        source = {'content' : entry['content'], 'kb_document_id' : kb_document_id,
+                  'kb_entry_id' : entry['id'],
+                  'suggest' : {'input' : [entry['content']]}}
+        if zot_id is not None:
+            action['index']['_routing'] = tenant_routing(zot_id)
+            source['zot_id'] = zot_id
+        yield action, source
+
+def open_ndjson(path, mode='rt'):
+    '''Open a JSON lines file for text I/O, gzip-compressed if its name ends with .gz'''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def read_docs_jsonl(paths):
+    '''
+    Lazily read kb_documents, one JSON object per line, from one or more files
+    (such as those written by ElasticsearchClient.export_index).
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with open_ndjson(path) as docs_file:
+            for line in docs_file:
+                if line.strip():
+                    yield json.loads(line)
+
+def bulk_action_lines(actions, serializer=None):
+    '''
+    Lazily serialize (action, source) pairs into NDJSON bytes for the _bulk API,
+    encoding each straight to bytes with the serializer's dumps_bytes.
+    '''
+    dumps = (serializer if serializer else DEFAULT_SERIALIZER).dumps_bytes
+    for action, source in actions:
+        yield b''.join((dumps(action), b'\n', dumps(source), b'\n'))
+
+def chunk_bulk_lines(lines, max_docs=BULK_MAX_DOCS, max_bytes=BULK_MAX_BYTES):
+    '''
+    Group serialized actions into chunks of at most max_docs actions and (unless
+    a single action is larger) at most max_bytes bytes.  Yields lists of lines.
+    '''
+    chunk, chunk_bytes = [], 0
+    for line in lines:
+        if chunk and (len(chunk) >= max_docs or chunk_bytes + len(line) > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(line)
+        chunk_bytes += len(line)
+    if chunk:
+        yield chunk
+
+def parse_bulk_response(result, max_printed=BULK_MAX_PRINTED_ERRORS):
+    '''
+    Count indexed and failed items in a _bulk response, printing the first few errors.
+    Items rejected with status 429 (queue full) are neither indexed nor failed; their
+    positions in the request are returned so that they can be retried.
+    Returns (BulkResult, rejected_positions).
+    '''
+    indexed, failed, rejected = 0, 0, []
+    for pos, item in enumerate(result['items']):
+        op_result = next(iter(item.values()))
+        status = op_result.get('status', 500)
+        if status == 429:
+            rejected.append(pos)
+        elif 'error' in op_result or not 200 <= status < 300:
+            failed += 1
+            if failed <= max_printed:
+                print("Bulk item %s failed with status %s: %s"
+                      % (op_result.get('_id'), status, op_result.get('error')))
+        else:
+            indexed += 1
+    return BulkResult(indexed, failed), rejected
+
+
+class BulkThrottle:
+    '''
+    Adaptive delay shared by all bulk senders: it doubles (up to max_delay) each time
+    the cluster rejects work with a 429, and halves back toward zero on each success.
+    '''
+
+    def __init__(self, min_delay=0.05, max_delay=30.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.rejections = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''Sleep for the current delay (with jitter) before sending a request'''
+        delay = self.delay
+        if delay > 0.0:
+            time.sleep(random.uniform(0.5, 1.0) * delay)
+
+    def reject(self):
+        '''Slow down after a 429 rejection'''
+        with self.lock:
+            self.rejections += 1
+            self.delay = min(self.max_delay, max(self.min_delay, 2.0 * self.delay))
+
+    def accept(self):
+        '''Speed back up after an accepted request'''
+        with self.lock:
+            self.delay = self.delay / 2.0 if self.delay > self.min_delay else 0.0
+
+
+###############################################################################
+# Export: sliced scrolls stream every entry of an index to JSON lines files, one
+# kb_document with a single entry per line, so read_docs_jsonl can load them back.
+
+EXPORT_PAGE_SIZE = 1000
+EXPORT_SCROLL = '2m'
+
+ExportResult = namedtuple('ExportResult', 'exported seconds paths')
+
+def slice_path(path, slice_id, slices):
+    '''Get the file path for one slice of an export, e.g. zot1.ndjson.gz -> zot1.2.ndjson.gz'''
+    if slices <= 1:
+        return path
+    dirname, basename = os.path.split(path)
+    name, dot, extensions = basename.partition('.')
+    return os.path.join(dirname, '%s.%d%s%s' % (name, slice_id, dot, extensions))
+
+def export_doc(hit):
+    '''Convert one hit into a kb_document with a single entry'''
+    source = hit['_source']
+    return {'id' : source.get('kb_document_id'),
+            'entries' : [{'id' : hit['_id'], 'content' : source.get('content')}]}
+
+def export_line(hit):
+    '''Serialize one hit as a kb_document line with a single entry'''
+    return json.dumps(export_doc(hit)) + '\n'
+
+
+###############################################################################
+# Federated search: one query fans out to many zot indices at once, and the hits are
+# merged by score normalized per index as in print_hits, hit_score / (1 + max_score),
+# so that indices with different score scales can be compared.
+
+FEDERATED_TIMEOUT = 2.0
+FEDERATED_DEADLINE = 5.0
+FEDERATED_WORKERS = 16
+
+FederatedHit = namedtuple('FederatedHit', 'norm_score hit_score zot_id doc_id entry_id')
+FederatedResult = namedtuple('FederatedResult', 'hits responded timed_out failed')
+
+def federated_hits(zot_id, results):
+    '''Convert the results from one zot index into FederatedHits'''
+    max_score = results['hits']['max_score'] or 0.0
+    return [FederatedHit(hit['_score'] / (1.0 + max_score), hit['_score'], zot_id,
+                         hit['_source'].get('kb_document_id'), hit['_id'])
+            for hit in results['hits']['hits'] if hit.get('_score') is not None]
+
+class TopHits:
+    '''
+    Keeps the size best FederatedHits by normalized score in a min-heap, so merging
+    n hits costs O(n log size).  Among equal scores, hits added first are kept.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.heap = []
+        self.order = itertools.count()
+
+    def add(self, hits):
+        '''Merge in some hits'''
+        for hit in hits:
+            item = (hit.norm_score, -next(self.order), hit)
+            if len(self.heap) < self.size:
+                heapq.heappush(self.heap, item)
+            elif item > self.heap[0]:
+                heapq.heapreplace(self.heap, item)
+
+    def best(self):
+        '''Get the kept hits, best first'''
+        return [item[2] for item in sorted(self.heap, reverse=True)]
+
+
+NOT_MEASURED = nullcontext()
 
 class ElasticsearchClient:
     '''Client for searching one Elasticsearch index and type'''
 
-    def __init__(self, zot_id, use_boto=True, doc_type='kb_document'):
-        '''Save the client, index, and type'''
+    def __init__(self, zot_id, use_boto=True, doc_type='kb_document', maxsize=10, cache=None,
+                 single_flight=None, client=None, metrics=None, shared=False, resilience=None):
+        '''
+        Save the client (shared if given, e.g. from get_elasticsearch_client), index, and type.
+        Pass a SearchCache (which may be shared by clients) to cache search results,
+        a SingleFlight (also shareable) to coalesce identical concurrent searches,
+        and a RequestMetrics (also shareable) to measure the phases of each request.
+        If shared is set, the tenant's entries live in a shared index (see shared_index_name):
+        they are indexed with its zot_id and routing, and every query is filtered by it.
+        Pass a ResilientTransport (esresilience.py) to retry, circuit-break, and hedge the
+        requests sent by perform_request; the transport's own retries are then turned off.
+        '''
         self.use_boto = use_boto
-        self.client = get_elasticsearch_client(use_boto)
+        self.resilience = resilience
+        self.client = client if client else get_elasticsearch_client(
+            use_boto, maxsize, max_retries=0 if resilience is not None else 3)
         self.zot_id = zot_id
         self.index_name = zot_index_name(zot_id)
         self.doc_type = doc_type
+        self.cache = cache
+        self.single_flight = single_flight
+        self.metrics = metrics
+        self.shared = shared
+        serializer = self.client.transport.serializer
+        self.serializer = serializer if hasattr(serializer, 'dumps_bytes') else DEFAULT_SERIALIZER
+        self.suggest_cache = SearchCache(SUGGEST_CACHE_ENTRIES, SUGGEST_CACHE_TTL)
 
     def show_info(self):
         '''Print info about the Elasticsearch client'''
         print("Elasticsearch client from %s credentials" % ['ENV', 'BOTO'][self.use_boto])
         print("Elasticsearch client info:", self.client.info(), "\n")
+        print("Connection pool stats:", self.pool_stats(), "\n")
+        if self.cache is not None:
+            print("Search cache stats:", self.cache.stats(), "\n")
+        if self.single_flight is not None:
+            print("Single-flight stats:", self.single_flight.stats(), "\n")
+        if self.metrics is not None:
+            print("Request metrics:", self.metrics.to_json(), "\n")
+        if self.resilience is not None:
+            print("Resilience stats:", self.resilience.stats(), "\n")
 
-    def search_index(self, qstring, offset=0, max_size=10):
-        '''Search the index using all the parameters.'''
-        print('Searching index %s, type %s (offset %d, max_size %d) for: "%s"'
-              % (self.index_name, self.doc_type, offset, max_size, qstring))
-        try:
-            results = self.client.search(index=self.index_name,
-                                         doc_type=self.doc_type,
-                                         from_=offset,
-                                         size=max_size,
-                                         body=most_fields_query(qstring)
-                                        )
-        except (TypeError, TransportError) as ex:
-            # Log index_already_exists_exception
-            if 'index_not_found_exception' in ex.error:
-                print("ElasticsearchClient.search_index: Ignoring index_not_found_exception")
-            else:
-                print("ElasticsearchClient.search_index: Unexpected exception:", ex)
-            return None
+    def pool_stats(self):
+        '''Get connection pool stats (hits, misses, open connections) summed over all hosts'''
+        totals = {}
+        for connection in self.client.transport.connection_pool.connections:
+            for key, val in connection.pool_stats().items():
+                totals[key] = totals.get(key, 0) + val
+        return totals
+
+    def measure(self, operation):
+        '''
+        Context manager measuring one call of operation (yielding its CallTimer) if metrics
+        are enabled, or doing nothing (yielding None) if not.
+        '''
+        return self.metrics.call(operation) if self.metrics is not None else NOT_MEASURED
+
+    def perform_request(self, method, path, params=None, body=None, headers=None):
+        '''
+        Send one request (e.g. from search_request) through the client's transport,
+        by way of the resilience layer if there is one.
+        '''
+        if self.resilience is not None:
+            return self.resilience.perform(self.send_request, method, path, params, body, headers)
+        return self.send_request(method, path, params, body, headers)
+
+    def send_request(self, method, path, params=None, body=None, headers=None):
+        '''Send one request through the client's transport'''
+        return measured_call(self.client.transport.perform_request, method, path, headers=headers,
+                             params=params, body=body)
+
+    def search_index(self, qstring, offset=0, max_size=10, query_builder=most_fields_query, verbose=1,
+                     profile=False, lean=False):
+        '''
+        Search the index using all the parameters.
+        If profile is set, the search is profiled (and not cached); see print_profile.
+        If lean is set, hits carry only _score, _id, and fields.kb_document_id, which is
+        all extract_scores_and_ids needs (with compact=True, say), but print_hits cannot show.
+        '''
+        if verbose > 0:
+            print('Searching index %s, type %s (offset %d, max_size %d) for: "%s"'
+                  % (self.index_name, self.doc_type, offset, max_size, qstring))
+        build_start = time.perf_counter()
+        body = search_body(qstring, query_builder, self.zot_id if self.shared else None, lean)
+        if profile:
+            body = dict(body, profile=True)
+        elif self.cache is not None:
+            key = self.cache.key(self.index_name, body, offset, max_size)
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+        with self.measure('search') as call:
+            try:
+                request = search_request(self.index_name, self.doc_type, body, offset, max_size)
+                if call is not None:
+                    call.since('build', build_start)
+                if self.single_flight is not None:
+                    flight_key = canonical_key(self.index_name, body, offset, max_size)
+                    results = self.single_flight.do(flight_key, self.perform_request, *request)
+                else:
+                    results = self.perform_request(*request)
+            except (TypeError, TransportError) as ex:
+                report_search_error(ex)
+                return None
+        if self.cache is not None and not profile:
+            self.cache.put(key, results)
         return results
 
+    def profile_queries(self, qstrings, query_builder=most_fields_query, max_size=10, verbose=0):
+        '''
+        Profile a search for each query string, printing each profile if verbose,
+        and return a ProfileAggregator of them all (see ProfileAggregator.report).
+        '''
+        aggregator = ProfileAggregator()
+        for qstring in qstrings:
+            results = self.search_index(qstring, max_size=max_size, query_builder=query_builder,
+                                        verbose=verbose, profile=True)
+            if verbose > 0:
+                print_profile(results)
+            aggregator.add(results)
+        return aggregator
+
+    def invalidate_cache(self, index_name=None):
+        '''Forget cached search results and suggestions for an index (self.index_name by default)'''
+        if index_name is None:
+            index_name = self.index_name
+        if self.cache is not None:
+            self.cache.invalidate(index_name)
+        self.suggest_cache.invalidate(index_name)
+
+    def suggest(self, prefix, size=5, fuzzy=False):
+        '''
+        Get type-ahead Suggestion tuples for a prefix from the completion suggester,
+        which looks prefixes up in an in-memory FST instead of running a query.
+        Answers are cached per (lowercased) prefix, since keystrokes repeat prefixes often.
+        '''
+        key = self.suggest_cache.key(self.index_name, {'prefix' : prefix.lower(), 'fuzzy' : fuzzy}, 0, size)
+        suggestions = self.suggest_cache.get(key)
+        if suggestions is not None:
+            return suggestions
+        with self.measure('suggest'):
+            try:
+                response = self.perform_request(*suggest_request(self.index_name, prefix, size, fuzzy,
+                                                                 self.zot_id if self.shared else None))
+            except TransportError as ex:
+                report_search_error(ex, 'ElasticsearchClient.suggest')
+                return []
+        suggestions = suggestions_from(response)
+        self.suggest_cache.put(key, suggestions)
+        return suggestions
+
+    def iter_hits(self, qstring, page_size=100, query_builder=most_fields_query, sort=None,
+                  max_hits=None, prefetch=True, tiebreaker=SEARCH_AFTER_TIEBREAKER):
+        '''
+        Lazily yield every hit (or the first max_hits) for a query, one page at a time,
+        using search_after instead of from/size, so deep pages cost no more than the first
+        and max_result_window does not apply.  While the caller handles one page, the next
+        is fetched in the background (unless prefetch is False), so memory use is bounded
+        by two pages.  See search_after_request for the sort and tiebreaker.
+        A page that fails is reported and its TransportError raised, rather than
+        silently ending the hits early.
+        '''
+        body = search_body(qstring, query_builder, self.zot_id if self.shared else None)
+        preference = uuid.uuid4().hex
+        def fetch(search_after):
+            '''Get one page of hits'''
+            with self.measure('search_after'):
+                return self.perform_request(*search_after_request(
+                    self.index_name, self.doc_type, body, page_size, search_after, sort, preference,
+                    tiebreaker))
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            pending = executor.submit(fetch, None) if prefetch else None
+            search_after, count = None, 0
+            while True:
+                try:
+                    results = pending.result() if prefetch else fetch(search_after)
+                except TransportError as ex:
+                    report_search_error(ex, 'ElasticsearchClient.iter_hits')
+                    raise
+                hits = results['hits']['hits']
+                if hits:
+                    search_after = hits[-1]['sort']
+                more = len(hits) == page_size and (max_hits is None or count + len(hits) < max_hits)
+                if prefetch and more:
+                    pending = executor.submit(fetch, search_after)
+                for hit in hits:
+                    if max_hits is not None and count >= max_hits:
+                        return
+                    count += 1
+                    yield hit
+                if not more:
+                    return
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def search_many(self, queries, offset=0, max_size=10, min_score=0.0,
+                    max_queries=MSEARCH_MAX_QUERIES, max_bytes=MSEARCH_MAX_BYTES, lean=False):
+        '''
+        Run many query bodies (e.g. from most_fields_query) against the index in as few
+        _msearch round trips as the size limits allow.  Returns, in query order, the
+        (es_results, max_score, sum_score) of extract_scores_and_ids for each query;
+        a query that fails (alone or with its batch) gets empty results.
+        If lean is set, only the fields needed are fetched, and es_results are CompactResults.
+        '''
+        queries, sent = search_many_bodies(queries, self.zot_id if self.shared else None, lean)
+        results = []
+        for count, body in msearch_batches(self.index_name, self.doc_type, sent, offset,
+                                           max_size, max_queries, max_bytes, self.serializer):
+            with self.measure('msearch'):
+                try:
+                    response = self.perform_request(*msearch_request(body), headers=NDJSON_HEADERS)
+                    results += msearch_results(response)
+                except TransportError as ex:
+                    report_search_error(ex, 'ElasticsearchClient.search_many')
+                    results += [None] * count
+        return search_many_results(self.index_name, queries, results, min_score, lean)
+
+    def search_federated(self, zot_ids, qstring, size=10, query_builder=most_fields_query,
+                         timeout=FEDERATED_TIMEOUT, deadline=FEDERATED_DEADLINE,
+                         workers=FEDERATED_WORKERS):
+        '''
+        Search the indices of many zot_ids concurrently, over this client's connection pool,
+        and merge their hits into the size best by normalized score (see TopHits).
+        Each index gets timeout seconds (also passed to the cluster, which then returns
+        the hits it found in time), and all together get deadline seconds; indices that
+        have not answered by then are left out.  Returns a FederatedResult, whose
+        responded, timed_out, and failed list the zot_ids in each state.
+        '''
+        body = dict(query_builder(qstring), timeout='%dms' % int(timeout * 1000))
+        def search(zot_id):
+            '''Search one zot index'''
+            request = search_request(zot_index_name(zot_id), self.doc_type,
+                                     tenant_query(body, zot_id) if self.shared else body, 0, size)
+            request[2]['request_timeout'] = timeout
+            with self.measure('federated'):
+                return self.perform_request(*request)
+
+        top_hits = TopHits(size)
+        responded, timed_out, failed = [], [], []
+        executor = ThreadPoolExecutor(max_workers=max(min(workers, len(zot_ids)), 1))
+        try:
+            futures = [(executor.submit(search, zot_id), zot_id) for zot_id in zot_ids]
+            done, _ = wait([future for future, _ in futures], timeout=deadline)
+            for future, zot_id in futures:
+                if future not in done:
+                    timed_out.append(zot_id)
+                    continue
+                try:
+                    results = future.result()
+                except ConnectionTimeout:
+                    timed_out.append(zot_id)
+                    continue
+                except TransportError as ex:
+                    report_search_error(ex, 'ElasticsearchClient.search_federated')
+                    failed.append(zot_id)
+                    continue
+                top_hits.add(federated_hits(zot_id, results))
+                (timed_out if results.get('timed_out') else responded).append(zot_id)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return FederatedResult(top_hits.best(), responded, timed_out, failed)
 
     def create_index(self, index_name=None, type_mappings=None):
         '''Create an index (self.index_name by default)'''
         if index_name is None:
             index_name = self.index_name
         try:
-            result = create_index(self.client, index_name, type_mappings)
+            result = self.perform_request(*create_index_request(index_name, type_mappings))
             return result['acknowledged'] and result['shards_acknowledged']
         except TransportError as ex:
-            # ignore index_already_exists_exception
-            if "index_already_exists_exception" in ex.error:
-                print("ElasticsearchClient.create_index: Ignoring index_already_exists_exception")
-            else:
-                print("ElasticsearchClient.create_index: exception:", ex)
+            report_create_index_error(ex)
+        finally:
+            # Searches racing the request may have cached results from before it
+            self.invalidate_cache(index_name)
         return False
 
     def delete_index(self, index_name=None, **kwargs):
@@ -356,46 +1309,369 @@ class ElasticsearchClient:
         if index_name is None:
             index_name = self.index_name
         try:
-            result = self.client.indices.delete(index=index_name, **kwargs)
+            result = self.perform_request(*delete_index_request(index_name, **kwargs))
             return result['acknowledged']
         except TransportError as ex:
-            # ignore index_already_exists_exception
-            if "index_not_found_exception" in ex.error:
-                print("ElasticsearchClient.create_index: Ignoring index_not_found_exception")
-            else:
-                print("ElasticsearchClient.create_index: exception:", ex)
+            report_delete_index_error(ex)
+        finally:
+            # Searches racing the request may have cached results from before it
+            self.invalidate_cache(index_name)
         return False
 
-    def index_all_docs(self, zot_id=None, index_name=None, docs=None, **kwargs):
+    def send_bulk_chunk(self, chunk, throttle=None, max_retries=BULK_MAX_RETRIES):
+        '''
+        Send one chunk of serialized bulk actions, retrying items the cluster rejects
+        with 429 (and whole-request 429s) after an adaptive backoff delay.
+        Returns a BulkResult.
+        '''
+        if throttle is None:
+            throttle = BulkThrottle()
+        indexed, failed = 0, 0
+        for _ in range(max_retries + 1):
+            throttle.wait()
+            try:
+                with self.measure('bulk') as call:
+                    build_start = time.perf_counter()
+                    body = b''.join(chunk)
+                    if call is not None:
+                        call.since('build', build_start)
+                    result = measured_call(self.client.bulk, body=body)
+                chunk_result, rejected = parse_bulk_response(result)
+                indexed += chunk_result.indexed
+                failed += chunk_result.failed
+                chunk = [chunk[pos] for pos in rejected]
+            except TransportError as ex:
+                if ex.status_code != 429:
+                    print("ElasticsearchClient.send_bulk_chunk: bulk chunk of %d failed: %s"
+                          % (len(chunk), ex))
+                    return BulkResult(indexed, failed + len(chunk))
+            if not chunk:
+                throttle.accept()
+                return BulkResult(indexed, failed)
+            throttle.reject()
+        print("ElasticsearchClient.send_bulk_chunk: %d items still rejected after %d retries"
+              % (len(chunk), max_retries))
+        return BulkResult(indexed, failed + len(chunk))
+
+    def send_bulk_chunks(self, chunks, workers=1):
+        '''
+        Send chunks of serialized bulk actions using a pool of worker threads.
+        The chunks iterable is consumed through a bounded queue, so a fast producer
+        blocks instead of buffering the corpus in memory.  Returns a BulkResult.
+        A chunk whose sending raises an unexpected exception is reported and counted
+        as failed, and its worker goes on draining the queue.
+        '''
+        throttle = BulkThrottle()
+        if workers <= 1:
+            indexed, failed = 0, 0
+            for chunk in chunks:
+                chunk_result = self.send_bulk_chunk(chunk, throttle)
+                indexed += chunk_result.indexed
+                failed += chunk_result.failed
+            return BulkResult(indexed, failed)
+
+        chunk_queue = queue.Queue(maxsize=BULK_QUEUE_CHUNKS_PER_WORKER * workers)
+        totals = [0, 0]
+        totals_lock = threading.Lock()
+
+        def worker():
+            '''Send chunks from the queue until the None sentinel arrives'''
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    return
+                try:
+                    chunk_result = self.send_bulk_chunk(chunk, throttle)
+                except Exception as ex:
+                    print("ElasticsearchClient.send_bulk_chunks: bulk chunk of %d failed: %s: %s"
+                          % (len(chunk), type(ex).__name__, ex))
+                    chunk_result = BulkResult(0, len(chunk))
+                with totals_lock:
+                    totals[0] += chunk_result.indexed
+                    totals[1] += chunk_result.failed
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for chunk in chunks:
+                chunk_queue.put(chunk)
+        finally:
+            for _ in threads:
+                chunk_queue.put(None)
+            for thread in threads:
+                thread.join()
+        if throttle.rejections:
+            print("ElasticsearchClient.send_bulk_chunks: backed off after %d rejections"
+                  % throttle.rejections)
+        return BulkResult(totals[0], totals[1])
+
+    @contextmanager
+    def bulk_load_settings(self, index_name=None, max_num_segments=None):
+        '''
+        Context manager for bulk loads: disables refresh and replicas on the index,
+        then restores the original values (even if the load fails partway), force-merges
+        down to max_num_segments if the load succeeded, and refreshes the index once.
+        '''
+        if index_name is None:
+            index_name = self.index_name
+        settings = self.client.indices.get_settings(
+            index=index_name, name=['index.%s' % key for key in BULK_LOAD_SETTINGS])
+        # The response is keyed by the concrete index, not by an alias such as zot<ID>
+        index_settings = next(iter(settings.values()), {}).get('settings', {}).get('index', {})
+        # Settings left at their defaults are absent, and restored by setting them to None
+        original = {key : index_settings.get(key) for key in BULK_LOAD_SETTINGS}
+        self.client.indices.put_settings(index=index_name, body={'index' : BULK_LOAD_SETTINGS})
+        loaded = False
+        try:
+            yield
+            loaded = True
+        finally:
+            try:
+                self.client.indices.put_settings(index=index_name, body={'index' : original})
+                if loaded and max_num_segments:
+                    self.client.indices.forcemerge(index=index_name,
+                                                   max_num_segments=max_num_segments)
+                self.client.indices.refresh(index=index_name)
+            except TransportError as ex:
+                print("ElasticsearchClient.bulk_load_settings: failed to restore %s to %s: %s"
+                      % (index_name, original, ex))
+
+    def index_all_docs(self, zot_id=None, index_name=None, docs=None,
+                       max_docs=BULK_MAX_DOCS, max_bytes=BULK_MAX_BYTES, workers=1,
+                       bulk_load=False, max_num_segments=None, shared=None):
         '''
         Creates or updates the index for zot_id by indexing all the specifed docs.
-        NOTE: if you change the indexing scheme, old indices should be deleted,
-        not updated in place.  Inconsistent indices may cause strange search results.
+        Docs may be any iterable (e.g. a generator); their entries are serialized lazily
+        and sent in _bulk chunks bounded by max_docs actions and max_bytes bytes,
+        by up to workers concurrent threads.
+        If bulk_load is set, refresh and replication are turned off during the load
+        (see bulk_load_settings), and max_num_segments may request a force-merge.
+        If shared (by default self.shared), entries are tagged with zot_id and routed by it,
+        and a missing index is created as a tenant alias (see ensure_tenant_alias).
+        bulk_load is ignored when shared, since it would change the settings of the whole
+        shared index, which other tenants are searching.
+        Returns a BulkResult with the numbers of entries indexed and failed (none, if the
+        index could not be checked or created).
+        NOTE: if you change the indexing scheme, old indices should be replaced (see
+        rebuild_index), not updated in place.  Inconsistent indices may cause strange
+        search results.
         '''
         if zot_id is None:
             zot_id = self.zot_id
         if index_name is None:
             index_name = self.index_name
         if docs is None:
-            docs = []
-        if not docs:
             print("==== index_all_doc: Nothing to index! ====")
-            return False
+            return BulkResult(0, 0)
+        if shared is None:
+            shared = self.shared
+        if shared and bulk_load:
+            print("==== index_all_doc: ignoring bulk_load for shared index %s ====" % index_name)
+            bulk_load = False
         try:
-            self.create_index(index_name)
-            entry_hashes = []
-            for doc in docs:
-                entry_hashes += make_entry_hashes(index_name, doc)
-            result = self.client.bulk(body=entry_hashes)
-            pdb.set_trace()
-            return result['acknowledged']
+            if not self.client.indices.exists(index=index_name):
+                if shared and index_name == zot_index_name(zot_id):
+                    self.ensure_tenant_alias(zot_id)
+                else:
+                    self.create_index(index_name)
         except TransportError as ex:
-            # ignore index_already_exists_exception
-            if "index_not_found_exception" in ex.error:
-                print("ElasticsearchClient.create_index: Ignoring index_not_found_exception")
+            print("ElasticsearchClient.index_all_docs: cannot check or create %s: %s" % (index_name, ex))
+            return BulkResult(0, 0)
+        tenant = zot_id if shared else None
+        actions = (action for doc in docs
+                   for action in make_entry_hashes(index_name, doc, self.doc_type, tenant))
+        chunks = chunk_bulk_lines(bulk_action_lines(actions, self.serializer), max_docs, max_bytes)
+        try:
+            if bulk_load:
+                with self.bulk_load_settings(index_name, max_num_segments):
+                    result = self.send_bulk_chunks(chunks, workers)
             else:
-                print("ElasticsearchClient.create_index: exception:", ex)
-        return False
+                result = self.send_bulk_chunks(chunks, workers)
+        finally:
+            self.invalidate_cache(index_name)
+        if result.indexed + result.failed == 0:
+            print("==== index_all_doc: Nothing to index! ====")
+        return result
+
+
+    def scroll_hits(self, index_name, slice_id=0, slices=1, page_size=EXPORT_PAGE_SIZE,
+                    scroll=EXPORT_SCROLL):
+        '''
+        Lazily yield every hit of an index (or of one of slices slices of it) from a scroll,
+        holding one page in memory.  The scroll is cleared when the generator is closed.
+        '''
+        body = {'query' : {'match_all' : {}}, 'sort' : ['_doc'],
+                '_source' : ['content', 'kb_document_id']}
+        if slices > 1:
+            body['slice'] = {'id' : slice_id, 'max' : slices}
+        scroll_id = None
+        try:
+            results = self.client.search(index=index_name, body=body, scroll=scroll, size=page_size)
+            while True:
+                scroll_id = results.get('_scroll_id')
+                hits = results['hits']['hits']
+                if not hits:
+                    break
+                yield from hits
+                results = self.client.scroll(scroll_id=scroll_id, scroll=scroll)
+        finally:
+            if scroll_id:
+                self.client.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
+    def export_slice(self, index_name, path, slice_id, slices, page_size=EXPORT_PAGE_SIZE,
+                     scroll=EXPORT_SCROLL):
+        '''Write one slice of a scroll over an index to a file.  Returns the number of hits written'''
+        exported = 0
+        with open_ndjson(path, 'wt') as out:
+            for hit in self.scroll_hits(index_name, slice_id, slices, page_size, scroll):
+                out.write(export_line(hit))
+                exported += 1
+        return exported
+
+    def export_index(self, path, index_name=None, slices=4, page_size=EXPORT_PAGE_SIZE):
+        '''
+        Export every entry of an index (self.index_name by default) to JSON lines files,
+        gzip-compressed if path ends with .gz, using one thread per scroll slice.  Each
+        slice streams to its own file (see slice_path), holding only one page of hits in
+        memory.  The files can be indexed again with read_docs_jsonl and index_all_docs.
+        Returns an ExportResult.
+        '''
+        if index_name is None:
+            index_name = self.index_name
+        paths = [slice_path(path, slice_id, slices) for slice_id in range(max(slices, 1))]
+        beg_time = time.time()
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            futures = [executor.submit(self.export_slice, index_name, slice_file, slice_id,
+                                       len(paths), page_size)
+                       for slice_id, slice_file in enumerate(paths)]
+            exported = sum(future.result() for future in futures)
+        secs = max(time.time() - beg_time, 1e-6)
+        print("Exported %d entries from %s to %d files in %.1f seconds (%.1f docs/sec)"
+              % (exported, index_name, len(paths), secs, exported / secs))
+        return ExportResult(exported, secs, paths)
+
+    def index_versions(self, alias=None):
+        '''
+        Get the physical versions of an aliased index as a sorted list of
+        (version, index_name, is_aliased) tuples.
+        '''
+        if alias is None:
+            alias = self.index_name
+        try:
+            indices = self.client.indices.get_alias(index=versioned_index_name(alias, '*'))
+        except NotFoundError:
+            return []
+        versions = []
+        for index_name, info in indices.items():
+            version = index_version(alias, index_name)
+            if version is not None:
+                versions.append((version, index_name, alias in info.get('aliases', {})))
+        return sorted(versions)
+
+    def swap_alias(self, new_index, alias=None, add_action=None):
+        '''
+        Atomically point alias at new_index and away from any other index.
+        A legacy concrete index with the alias's own name is removed in the same action.
+        Pass add_action to add the alias with a filter and routing (see tenant_alias_action).
+        '''
+        if alias is None:
+            alias = self.index_name
+        actions = [{'remove' : {'index' : index_name, 'alias' : alias}}
+                   for _, index_name, is_aliased in self.index_versions(alias)
+                   if is_aliased and index_name != new_index]
+        if self.client.indices.exists(index=alias) and not self.client.indices.exists_alias(name=alias):
+            actions.append({'remove_index' : {'index' : alias}})
+        actions.append(add_action if add_action else {'add' : {'index' : new_index, 'alias' : alias}})
+        result = self.client.indices.update_aliases(body={'actions' : actions})
+        self.invalidate_cache(alias)
+        return result['acknowledged']
+
+    def rebuild_index(self, docs, alias=None, keep=1, max_failed=0, bulk_load=True, **kwargs):
+        '''
+        Rebuild an aliased index with zero downtime: index all docs into a new version
+        (e.g. zot7777777_v3), atomically swap the alias to it, and delete all but the
+        keep most recent previous versions.  Searches through the alias keep seeing the
+        old version until the new one is complete.  If more than max_failed entries fail,
+        the new version is deleted and the alias is left alone.  With no docs, nothing is
+        rebuilt, since swapping to an empty version would empty the live index.
+        Extra kwargs are passed to index_all_docs.  Returns a BulkResult.
+        '''
+        if alias is None:
+            alias = self.index_name
+        if docs is None:
+            print("ElasticsearchClient.rebuild_index: no docs to rebuild %s from; leaving it alone" % alias)
+            return BulkResult(0, 0)
+        versions = self.index_versions(alias)
+        new_version = versions[-1][0] + 1 if versions else 1
+        new_index = versioned_index_name(alias, new_version)
+        print("ElasticsearchClient.rebuild_index: building %s for alias %s" % (new_index, alias))
+        result = self.index_all_docs(index_name=new_index, docs=docs, bulk_load=bulk_load, **kwargs)
+        if result.indexed == 0 or result.failed > max_failed:
+            print("ElasticsearchClient.rebuild_index: abandoning %s (%d indexed, %d failed)"
+                  % (new_index, result.indexed, result.failed))
+            self.delete_index(new_index)
+            return result
+        self.swap_alias(new_index, alias)
+        old_versions = [index_name for _, index_name, _ in versions]
+        for index_name in old_versions[:max(len(old_versions) - keep, 0)]:
+            self.delete_index(index_name)
+        return result
+
+    def ensure_tenant_alias(self, zot_id=None):
+        '''Create a tenant's shared index (if missing) and its filtered, routed zot<ID> alias'''
+        if zot_id is None:
+            zot_id = self.zot_id
+        shared_index = shared_index_name(zot_id)
+        if not self.client.indices.exists(index=shared_index):
+            self.create_index(shared_index)
+        if not self.client.indices.exists_alias(index=shared_index, name=zot_index_name(zot_id)):
+            self.client.indices.update_aliases(body={'actions' : [tenant_alias_action(zot_id, shared_index)]})
+
+    def migrate_tenant(self, zot_id, page_size=EXPORT_PAGE_SIZE, max_failed=0, **kwargs):
+        '''
+        Move one tenant from its own index (or aliased index versions) into its shared index:
+        scroll its entries into the shared index with its zot_id and routing, then atomically
+        replace zot<ID> with a filtered, routed alias into the shared index, and delete the
+        old indices.  If more than max_failed entries fail, the copied entries are deleted
+        and the old index is left alone.  Extra kwargs (e.g. workers) are passed to
+        index_all_docs.  Returns a BulkResult.
+        '''
+        alias = zot_index_name(zot_id)
+        shared_index = shared_index_name(zot_id)
+        if not self.client.indices.exists(index=alias):
+            print("ElasticsearchClient.migrate_tenant: no index %s" % alias)
+            return BulkResult(0, 0)
+        if self.client.indices.exists_alias(index=shared_index, name=alias):
+            print("ElasticsearchClient.migrate_tenant: %s is already in %s" % (alias, shared_index))
+            return BulkResult(0, 0)
+        if not self.client.indices.exists(index=shared_index):
+            self.create_index(shared_index)
+        old_versions = [index_name for _, index_name, is_aliased in self.index_versions(alias) if is_aliased]
+        docs = (export_doc(hit) for hit in self.scroll_hits(alias, page_size=page_size))
+        result = self.index_all_docs(zot_id, shared_index, docs, shared=True, **kwargs)
+        if result.failed > max_failed:
+            print("ElasticsearchClient.migrate_tenant: abandoning %s (%d indexed, %d failed)"
+                  % (alias, result.indexed, result.failed))
+            self.client.delete_by_query(index=shared_index, body={'query' : tenant_filter(zot_id)},
+                                        routing=tenant_routing(zot_id), conflicts='proceed')
+            return result
+        self.client.indices.refresh(index=shared_index)
+        self.swap_alias(shared_index, alias, tenant_alias_action(zot_id, shared_index))
+        for index_name in old_versions:
+            self.delete_index(index_name)
+        return result
+
+    def migrate_tenants(self, zot_ids, **kwargs):
+        '''Migrate each tenant in turn (see migrate_tenant).  Returns the total BulkResult'''
+        indexed, failed = 0, 0
+        for zot_id in zot_ids:
+            print("ElasticsearchClient.migrate_tenants: %s -> %s"
+                  % (zot_index_name(zot_id), shared_index_name(zot_id)))
+            result = self.migrate_tenant(zot_id, **kwargs)
+            indexed += result.indexed
+            failed += result.failed
+        return BulkResult(indexed, failed)
 
 
 ###############################################################################
@@ -411,14 +1687,68 @@ def do_es_command(es_client, dummy_index, args):
         es_client.delete_index(index_name)
     elif args.elastic:
         es_client.show_info()
-    elif args.index_all:
+    elif args.export:
+        name = args.name if args.name else es_client.index_name
+        print("======> export_index(%s, %s, slices=%d)" % (args.export, name, args.slices))
+        es_client.export_index(args.export, name, slices=args.slices)
+    elif args.migrate:
+        print("======> migrate_tenants(%s, workers=%d)" % (args.migrate, args.workers))
+        result = es_client.migrate_tenants(args.migrate, workers=args.workers)
+        print("Migrated %d entries, %d failed" % (result.indexed, result.failed))
+    elif args.index_all or args.rebuild:
         zoid = args.zoid if args.zoid else es_client.zot_id
         name = args.name if args.name else es_client.index_name
-        print("======> index_all_docs(%d, %s)" % (zoid, name))
-        es_client.index_all_docs(zoid, name)
+        docs = read_docs_jsonl(args.docs) if args.docs else None
+        beg_time = time.time()
+        if args.rebuild:
+            print("======> rebuild_index(%s, keep=%d, workers=%d)" % (name, args.keep, args.workers))
+            result = es_client.rebuild_index(docs, name, keep=args.keep, workers=args.workers,
+                                             max_num_segments=args.merge)
+        else:
+            print("======> index_all_docs(%d, %s, workers=%d)" % (zoid, name, args.workers))
+            result = es_client.index_all_docs(zoid, name, docs, workers=args.workers,
+                                              bulk_load=args.bulk_load, max_num_segments=args.merge)
+        secs = max(time.time() - beg_time, 1e-6)
+        print("Indexed %d entries, %d failed in %.1f seconds (%.1f docs/sec)"
+              % (result.indexed, result.failed, secs, (result.indexed + result.failed) / secs))
+    elif args.suggest:
+        print("======> suggest(%s, %s)" % (es_client.index_name, args.query))
+        for suggestion in es_client.suggest(args.query, size=args.size):
+            print('%7.3f\t%s\t%s' % (suggestion.score, truncate(suggestion.text), suggestion.entry_id))
+    elif args.profile is not None:
+        qstrings = [args.query]
+        if args.profile:
+            with open(args.profile, encoding='utf-8') as queries_file:
+                qstrings = [line.strip() for line in queries_file if line.strip()]
+        print("======> profile_queries(%s, %d queries, %s)" % (es_client.index_name, len(qstrings), args.type))
+        aggregator = es_client.profile_queries(qstrings, QUERY_BUILDERS[args.type], args.size,
+                                               verbose=1 if len(qstrings) == 1 else 0)
+        aggregator.report()
+    elif args.federate:
+        print("======> search_federated(%s, %s, %s)" % (args.federate, args.query, args.type))
+        result = es_client.search_federated(args.federate, args.query, args.size, QUERY_BUILDERS[args.type])
+        for hit in result.hits:
+            print('%8.4f\t%7.3f\t%s\t%36s\t%36s' % (hit.norm_score, hit.hit_score, zot_index_name(hit.zot_id),
+                                                    hit.doc_id, hit.entry_id))
+        print("%d indices responded, %d timed out %s, %d failed %s"
+              % (len(result.responded), len(result.timed_out), result.timed_out,
+                 len(result.failed), result.failed))
+    elif args.compare:
+        print("======> compare_query_builders(%s, %s)" % (args.query, args.compare))
+        compare_query_builders(es_client, args.query, args.compare)
+    elif args.lean:
+        print("======> search_index(%s, %s, %s, lean)" % (es_client.index_name, args.query, args.type))
+        results = es_client.search_index(args.query, offset=args.offset, max_size=args.size,
+                                         query_builder=QUERY_BUILDERS[args.type], lean=True)
+        es_results, max_score, _ = extract_scores_and_ids(es_client.index_name, args.query, results,
+                                                          args.min_score, compact=True)
+        for result in es_results:
+            print('%7.3f\t%8.4f\t%36s\t%36s' % (result.hit_score, result.hit_score / (1.0 + max_score),
+                                                result.doc_id, result.entry_id))
     else:
-        print("======> search_index(%s, %s)" % (es_client.index_name, args.query))
-        results = es_client.search_index(args.query, offset=args.offset, max_size=args.size)
+        print("======> search_index(%s, %s, %s)" % (es_client.index_name, args.query, args.type))
+        results = es_client.search_index(args.query, offset=args.offset, max_size=args.size,
+                                         query_builder=QUERY_BUILDERS[args.type])
         print_hits(results, min_score=args.min_score)
 
 
@@ -431,24 +1761,63 @@ def main():
     parser.add_argument('query', type=str, nargs='?', default='IT', help='query string for search')
     parser.add_argument('-boto', action='store_false',
                         help='Use ENV variables instead of reading AWS credentials from file (boto)')
+    parser.add_argument('-bulk_load', action='store_true',
+                        help='Disable refresh and replicas while running -index_all')
+    parser.add_argument('-compare', metavar='TYPE', type=str, nargs='+', choices=sorted(QUERY_BUILDERS),
+                        help='Benchmark query types (e.g. wildcard_query substring_query) on the query')
+    parser.add_argument('-compress', action='store_true',
+                        help='gzip request bodies and responses')
     parser.add_argument('-create_index', metavar='NAME', type=str, nargs='?', const=dummy_index, help='create named index')
     parser.add_argument('-delete_index', metavar='NAME', type=str, nargs='?', const=dummy_index, help='delete named index')
     parser.add_argument('-describe', action='store_true', help='Describe available ES clients')
     parser.add_argument('-dir', action='store_true', help='Show directory of client methods')
+    parser.add_argument('-docs', metavar='FILE', type=str, nargs='+',
+                        help='JSON lines files (maybe .gz) of kb_documents for -index_all')
     parser.add_argument('-domains', action='store_true', help='List available ES domains (boto)')
     parser.add_argument('-elastic', '-V', action='store_true', help='Show Elasticsearch config info')
+    parser.add_argument('-export', metavar='PATH', type=str,
+                        help='Export the named index to JSON lines files (.gz to compress)')
+    parser.add_argument('-federate', metavar='ID', type=int, nargs='+',
+                        help='Search the indices of all these IDs at once and merge the hits')
     parser.add_argument('-index_all', action='store_true', help='Index all docs for ID (const: %d, default: %d)'
                         % (const_zoid, default_zoid))
+    parser.add_argument('-json', type=str, choices=JSON_LIBRARIES, default=None,
+                        help='JSON library for requests and responses (default: fastest installed)')
+    parser.add_argument('-keep', metavar='N', type=int, nargs='?', const=1, default=1,
+                        help='Previous index versions to keep after -rebuild (default: 1)')
+    parser.add_argument('-lean', action='store_true',
+                        help='Search for scores and ids only, without _source')
+    parser.add_argument('-merge', metavar='SEGMENTS', type=int, nargs='?', const=1, default=None,
+                        help='Force-merge to SEGMENTS after a -bulk_load (const: 1)')
+    parser.add_argument('-metrics', metavar='FORMAT', type=str, nargs='?', const='json',
+                        choices=['json', 'prometheus'],
+                        help='Measure request phases and print them as json (const) or prometheus')
+    parser.add_argument('-migrate', metavar='ID', type=int, nargs='+',
+                        help='Move the per-zot indices of these IDs into shared indices')
     parser.add_argument('-min_score', metavar='MIN', type=float, nargs='?', const=1.0, default=0.0,
                         help='Minimum score for result hits (default: 0.0)')
     parser.add_argument('-name', type=str, nargs='?', const=const_name, default=default_name, help='index name to use')
     parser.add_argument('-offset', type=int, nargs='?', const=1, default=0,
                         help='Offset into results list (default: 0)')
+    parser.add_argument('-profile', metavar='QUERIES', type=str, nargs='?', const='', default=None,
+                        help='Profile the search (or each line of file QUERIES) and report the hottest clauses')
+    parser.add_argument('-rebuild', action='store_true',
+                        help='Rebuild the aliased index from -docs into a new version, then swap')
+    parser.add_argument('-resilient', action='store_true',
+                        help='Retry with backoff, circuit-break, and hedge slow searches')
+    parser.add_argument('-shared', action='store_true',
+                        help='Tenancy mode where zot_ids share indices (see -migrate)')
     parser.add_argument('-size', type=int, nargs='?', const=5, default=6,
                         help='Maximum number of results (default: 6)')
-    parser.add_argument('-type', type=str, nargs='?', default='most_fields_query', help='query type for search')
+    parser.add_argument('-slices', metavar='N', type=int, nargs='?', const=4, default=4,
+                        help='Parallel scroll slices for -export (default: 4)')
+    parser.add_argument('-suggest', action='store_true', help='Get type-ahead suggestions for the query')
+    parser.add_argument('-type', type=str, nargs='?', default='most_fields_query', choices=sorted(QUERY_BUILDERS),
+                        help='query type for search')
     parser.add_argument('-verbose', type=int, nargs='?', const=1, default=1,
                         help='Verbosity of output (default: 1)')
+    parser.add_argument('-workers', metavar='N', type=int, nargs='?', const=4, default=1,
+                        help='Concurrent bulk senders for -index_all (const: 4, default: 1)')
     parser.add_argument('-zoid', metavar='ID', type=int, nargs='?', const=const_zoid, default=default_zoid,
                         help='Zoroastrian ID (const: %d, default: %d)' % (const_zoid, default_zoid))
     args = parser.parse_args()
@@ -460,11 +1829,18 @@ def main():
     if args.domains:
         try_aws_es_service_client(args)
 
-    beg_time = time.time()
-    es_client = ElasticsearchClient(args.zoid, args.boto)
+    beg_time = time.perf_counter()
+    metrics = RequestMetrics() if args.metrics else None
+    resilience = ResilientTransport(hedge=True) if args.resilient else None
+    client = get_elasticsearch_client(args.boto, max_retries=0 if args.resilient else 3,
+                                      http_compress=args.compress, serializer=get_serializer(args.json))
+    es_client = ElasticsearchClient(args.zoid, args.boto, client=client, metrics=metrics,
+                                    shared=args.shared, resilience=resilience)
     do_es_command(es_client, dummy_index, args)
-    end_time = time.time()
-    print("Elapsed time: %d seconds" % (end_time - beg_time))
+    end_time = time.perf_counter()
+    if metrics is not None:
+        print(metrics.to_prometheus() if args.metrics == 'prometheus' else metrics.to_json())
+    print("Elapsed time: %.3f seconds" % (end_time - beg_time))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+'''Benchmarks for esaws.py against a local Elasticsearch stand-in'''
+
+import argparse
+import contextlib
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from esaws import ElasticsearchClient, get_elasticsearch_client, most_fields_query
+from esaws import extract_scores_and_ids, lean_search_body, print_hits
+from escodec import JSON_LIBRARIES, get_serializer
+from esresilience import ResilientTransport
+from estransport import AwsCredentials, CredentialCache
+
+
+###############################################################################
+# Synthetic corpora
+
+WORDS = ('account adjust agent alarm answer apply backup balance battery billing block boot '
+         'browser cable cancel card cache change charge check clear client cloud code config '
+         'connect contract copy credit data delete device disk display domain download driver '
+         'email enable error export fail file filter firewall folder format forward install '
+         'invoice issue key laptop license limit link login mail memory message migrate modem '
+         'monitor network order outage password payment phone plan policy port power print '
+         'profile proxy quota receipt refund remote reset restore router scan screen search '
+         'server service setting signal slow software storage subscription support sync '
+         'ticket timeout transfer update upgrade upload user verify virus volume wifi window').split()
+
+def synthetic_text(rng, num_words):
+    '''Random sentence of num_words words from WORDS'''
+    return ' '.join(rng.choice(WORDS) for _ in range(num_words)).capitalize() + '.'
+
+def synthetic_docs(num_docs, entries_per_doc=5, words_per_entry=40, seed=1):
+    '''Generate reproducible kb_documents (as read by read_docs_jsonl)'''
+    rng = random.Random(seed)
+    for doc_num in range(num_docs):
+        yield {'id' : 'doc-%d' % doc_num,
+               'entries' : [{'id' : 'doc-%d-%d' % (doc_num, entry_num),
+                             'content' : synthetic_text(rng, words_per_entry)}
+                            for entry_num in range(entries_per_doc)]}
+
+def synthetic_queries(num_queries, max_words=4, seed=2):
+    '''Random query strings of 1 to max_words words'''
+    rng = random.Random(seed)
+    return [synthetic_text(rng, rng.randint(1, max_words)).rstrip('.') for _ in range(num_queries)]
+
+
+###############################################################################
+# Stand-in server: answers the subset of the ES 6 API that esaws.py uses
+# (info, index create/exists/delete/settings, _bulk, _search, suggest, _msearch, scroll)
+# with realistically sized responses after a configurable latency.
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    '''
+    Threaded local HTTP server standing in for an Elasticsearch cluster.
+    Each request sleeps latency seconds (plus up to jitter more) before responding.
+    Searches return num_hits hits with content of words_per_hit words, and scrolls
+    return scroll_hits hits in all.
+    To inject faults, a fraction error_rate of requests fail with error_status, and
+    a fraction slow_rate take slow_latency seconds longer; set down to fail them all.
+    '''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.002, jitter=0.0, num_hits=10, words_per_hit=40,
+                 scroll_hits=10000, seed=3, error_rate=0.0, error_status=503, slow_rate=0.0,
+                 slow_latency=0.25):
+        super(FakeElasticsearch, self).__init__(('127.0.0.1', port), FakeElasticsearchHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.down = False
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.words_per_hit = words_per_hit
+        self.scroll_hits = scroll_hits
+        rng = random.Random(seed)
+        self.hits = [self.make_hit(rng, num) for num in range(max(num_hits, scroll_hits, 1))]
+        self.num_hits = num_hits
+        self.scrolls = {}
+        self.scroll_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.thread = None
+
+    def make_hit(self, rng, num):
+        '''Make one hit, with a score decreasing with num'''
+        return {'_index' : 'zot0', '_type' : 'kb_document', '_id' : 'entry-%d' % num,
+                '_score' : 10.0 / (1 + num),
+                '_source' : {'content' : synthetic_text(rng, self.words_per_hit),
+                             'kb_document_id' : 'doc-%d' % (num // 5),
+                             'kb_entry_id' : 'entry-%d' % num}}
+
+    @property
+    def port(self):
+        '''The port the server listens on'''
+        return self.server_address[1]
+
+    def start(self):
+        '''Serve on a daemon thread.  Returns self'''
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving and close the socket'''
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle_error(self, request, client_address):
+        '''Ignore clients that hang up (e.g. after a timeout) before their response is sent'''
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super(FakeElasticsearch, self).handle_error(request, client_address)
+
+    def delay(self):
+        '''Sleep for the configured latency, or longer for an injected slow request'''
+        seconds = self.latency + random.uniform(0.0, self.jitter)
+        if self.slow_rate and random.random() < self.slow_rate:
+            seconds += self.slow_latency
+        if seconds > 0.0:
+            time.sleep(seconds)
+
+    def inject_error(self):
+        '''Status of an injected error for this request, or None'''
+        if self.down or (self.error_rate and random.random() < self.error_rate):
+            with self.lock:
+                self.errors += 1
+            return self.error_status
+        return None
+
+    def search_response(self, index_name, size, offset=0, hits=None):
+        '''Search response with up to size hits'''
+        hits = self.hits[offset:offset + min(size, self.num_hits)] if hits is None else hits
+        return {'took' : 3, 'timed_out' : False,
+                '_shards' : {'total' : 5, 'successful' : 5, 'skipped' : 0, 'failed' : 0},
+                'hits' : {'total' : max(self.num_hits, len(hits)),
+                          'max_score' : hits[0]['_score'] if hits else None,
+                          'hits' : [dict(hit, _index=index_name) for hit in hits]}}
+
+    def shape_response(self, response, body):
+        '''
+        Apply a search body's stored_fields (hits get fields instead of _source) and
+        _source: false to a search response
+        '''
+        stored_fields = body.get('stored_fields')
+        if stored_fields is not None or body.get('_source') is False:
+            hits = []
+            for hit in response['hits']['hits']:
+                source = hit['_source']
+                hit = {key : val for key, val in hit.items() if key != '_source'}
+                if stored_fields:
+                    hit['fields'] = {name : [source[name]] for name in stored_fields if name in source}
+                hits.append(hit)
+            response['hits']['hits'] = hits
+        return response
+
+    def search_after_page(self, index_name, size, search_after=None):
+        '''Page of hits sorted by (_score, kb_entry_id), after the hit with the search_after sort values'''
+        offset = int(search_after[-1].rsplit('-', 1)[1]) + 1 if search_after else 0
+        hits = [dict(hit, sort=[hit['_score'], hit['_source']['kb_entry_id']])
+                for hit in self.hits[offset:min(offset + size, self.scroll_hits)]]
+        return self.search_response(index_name, size, hits=hits)
+
+    def suggest_response(self, index_name, suggest):
+        '''Completion suggester response with options for each named suggestion'''
+        response = self.search_response(index_name, 0, hits=[])
+        response['suggest'] = {}
+        for name, spec in suggest.items():
+            size = spec.get('completion', {}).get('size', 5)
+            options = [{'text' : hit['_source']['content'], '_index' : index_name,
+                        '_type' : hit['_type'], '_id' : hit['_id'], '_score' : hit['_score'],
+                        '_source' : {'kb_document_id' : hit['_source']['kb_document_id']}}
+                       for hit in self.hits[:size]]
+            prefix = spec.get('prefix', '')
+            response['suggest'][name] = [{'text' : prefix, 'offset' : 0, 'length' : len(prefix),
+                                          'options' : options}]
+        return response
+
+    def scroll_page(self, scroll_id, size=None):
+        '''Next page of a scroll, or an empty page when it is exhausted'''
+        with self.lock:
+            index_name, offset, end, page_size = self.scrolls[scroll_id]
+            size = page_size if size is None else size
+            hits = self.hits[offset:min(offset + size, end)]
+            self.scrolls[scroll_id] = (index_name, offset + len(hits), end, size)
+        response = self.search_response(index_name, size, hits=hits)
+        response['_scroll_id'] = scroll_id
+        return response
+
+    def start_scroll(self, index_name, size, body):
+        '''Start a scroll over scroll_hits hits (or one slice of them)'''
+        beg, end = 0, self.scroll_hits
+        if body and 'slice' in body:
+            slice_id, slices = body['slice']['id'], body['slice']['max']
+            beg, end = slice_id * end // slices, (slice_id + 1) * end // slices
+        with self.lock:
+            scroll_id = 'scroll-%d' % next(self.scroll_ids)
+            self.scrolls[scroll_id] = (index_name, beg, end, size)
+        return self.scroll_page(scroll_id)
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    '''Routes one request to the FakeElasticsearch API subset'''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        '''Disable Nagle's algorithm, which delays small responses on kept-alive connections'''
+        super(FakeElasticsearchHandler, self).setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, response=None):
+        '''Send a JSON response (or no body, for HEAD), gzipped if the client accepts it'''
+        data = json.dumps(response).encode('utf-8') if response is not None else b''
+        self.send_response(status)
+        self.send_header('content-type', 'application/json; charset=UTF-8')
+        if data and 'gzip' in self.headers.get('accept-encoding', ''):
+            data = gzip.compress(data, 3, mtime=0)
+            self.send_header('content-encoding', 'gzip')
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+            with self.server.lock:
+                self.server.bytes_out += len(data)
+
+    def read_body(self):
+        '''Read the request body as bytes, decompressing it if it is gzipped'''
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with self.server.lock:
+            self.server.bytes_in += len(body)
+        if self.headers.get('content-encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def do_request(self):
+        '''Dispatch on method and path'''
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        url = urlsplit(self.path)
+        params = {key : vals[-1] for key, vals in parse_qs(url.query).items()}
+        body = self.read_body()
+        server.delay()
+        parts = [part for part in url.path.split('/') if part]
+        endpoint = next((part for part in parts if part.startswith('_')), None)
+        index_name = parts[0] if parts and not parts[0].startswith('_') else 'zot0'
+        error_status = server.inject_error()
+
+        if error_status is not None:
+            error_type = 'es_rejected_execution_exception' if error_status == 429 else 'unavailable'
+            self.send_json(error_status, {'error' : {'type' : error_type, 'reason' : 'injected fault'},
+                                          'status' : error_status})
+        elif not parts:
+            self.send_json(200, {'name' : 'fake', 'cluster_name' : 'esbench',
+                                 'version' : {'number' : '6.8.0'}, 'tagline' : 'You Know, for Search'})
+        elif endpoint == '_bulk':
+            self.send_json(200, bulk_response(body))
+        elif endpoint == '_msearch':
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            responses = []
+            for query in lines[1::2]:
+                response = server.search_response(index_name, query.get('size', 10), query.get('from', 0))
+                responses.append(dict(server.shape_response(response, query), status=200))
+            self.send_json(200, {'took' : 3, 'responses' : responses})
+        elif endpoint == '_search' and 'scroll' in parts:
+            if self.command == 'DELETE':
+                self.send_json(200, {'succeeded' : True, 'num_freed' : 1})
+            else:
+                scroll_body = json.loads(body) if body else {}
+                scroll_id = scroll_body.get('scroll_id', params.get('scroll_id'))
+                self.send_json(200, server.scroll_page(scroll_id))
+        elif endpoint == '_search':
+            search_body = json.loads(body) if body else {}
+            size = int(params.get('size', search_body.get('size', 10)))
+            if 'scroll' in params:
+                self.send_json(200, server.start_scroll(index_name, size, search_body))
+            elif 'sort' in search_body:
+                self.send_json(200, server.search_after_page(index_name, size,
+                                                             search_body.get('search_after')))
+            elif 'suggest' in search_body:
+                self.send_json(200, server.suggest_response(index_name, search_body['suggest']))
+            else:
+                self.send_json(200, server.shape_response(
+                    server.search_response(index_name, size, int(params.get('from', 0))), search_body))
+        elif endpoint == '_settings':
+            self.send_json(200, {index_name : {'settings' : {'index' : {}}}}
+                           if self.command == 'GET' else {'acknowledged' : True})
+        elif endpoint in ('_refresh', '_forcemerge', '_flush'):
+            self.send_json(200, {'_shards' : {'total' : 5, 'successful' : 5, 'failed' : 0}})
+        elif endpoint is None and self.command == 'HEAD':
+            self.send_json(200)
+        elif endpoint is None and self.command in ('PUT', 'DELETE'):
+            self.send_json(200, {'acknowledged' : True, 'shards_acknowledged' : True,
+                                 'index' : index_name})
+        else:
+            self.send_json(400, {'error' : {'type' : 'illegal_argument_exception',
+                                            'reason' : 'unsupported: %s %s' % (self.command, url.path)},
+                                 'status' : 400})
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_request
+
+
+def bulk_response(body):
+    '''Response to a _bulk request, with every action succeeding'''
+    items = []
+    lines = body.splitlines()
+    idx = 0
+    while idx < len(lines):
+        if not lines[idx].strip():
+            idx += 1
+            continue
+        action = json.loads(lines[idx])
+        op_type, meta = next(iter(action.items()))
+        items.append({op_type : {'_index' : meta.get('_index'), '_type' : meta.get('_type'),
+                                 '_id' : meta.get('_id'), '_version' : 1, 'result' : 'created',
+                                 'status' : 201}})
+        idx += 1 if op_type == 'delete' else 2
+    return {'took' : 5, 'errors' : False, 'items' : items}
+
+
+###############################################################################
+# Measurements
+
+def percentile(sorted_samples, pct):
+    '''The pct percentile (nearest rank) of sorted samples'''
+    if not sorted_samples:
+        return 0.0
+    rank = max(math.ceil(pct * len(sorted_samples) / 100.0) - 1, 0)
+    return sorted_samples[min(rank, len(sorted_samples) - 1)]
+
+# ru_maxrss is the peak of the whole process so far, so it depends on what ran before.
+# On Linux, the peak (VmHWM) can be reset to the current RSS before each benchmark,
+# which then reports its own peak, and how far that is above where it started.
+
+def peak_rss_mb():
+    '''Peak resident set size of this process since it started (or reset_peak_rss), in MB'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError):
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+def current_rss_mb():
+    '''Resident set size of this process now, in MB, or None where /proc is missing'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def reset_peak_rss():
+    '''
+    Reset the peak RSS of this process to its current RSS (Linux only).
+    Returns the current RSS in MB, or None if the peak could not be reset.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return None
+    return current_rss_mb()
+
+@contextlib.contextmanager
+def measuring_rss(summary):
+    '''
+    Context manager running one benchmark, then setting its summary's peak_rss_mb and
+    rss_growth_mb (the peak less the RSS at its start; None if the peak was not reset).
+    Yields summary, a dict to update with the benchmark's summary.
+    '''
+    start_rss = reset_peak_rss()
+    yield summary
+    summary['peak_rss_mb'] = peak_rss_mb()
+    summary['rss_growth_mb'] = max(summary['peak_rss_mb'] - start_rss, 0.0) if start_rss is not None else None
+
+def summarize(name, latencies, seconds, operations=None):
+    '''Summary dict of a benchmark: throughput, latency percentiles (ms), and peak RSS'''
+    latencies = sorted(latencies)
+    operations = len(latencies) if operations is None else operations
+    return {
+        'name' : name,
+        'operations' : operations,
+        'seconds' : seconds,
+        'throughput' : operations / max(seconds, 1e-9),
+        'mean_ms' : 1000.0 * sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms' : 1000.0 * percentile(latencies, 50),
+        'p95_ms' : 1000.0 * percentile(latencies, 95),
+        'p99_ms' : 1000.0 * percentile(latencies, 99),
+        'peak_rss_mb' : peak_rss_mb(),
+    }
+
+def timed_calls(func, args_list, threads=1):
+    '''Call func(*args) for each args, on up to threads threads.  Returns (latencies, seconds)'''
+    latencies = []
+    lock = threading.Lock()
+    args_iter = iter(args_list)
+
+    def worker():
+        '''Time calls until the args run out'''
+        local = []
+        while True:
+            with lock:
+                args = next(args_iter, None)
+            if args is None:
+                break
+            beg = time.perf_counter()
+            func(*args)
+            local.append(time.perf_counter() - beg)
+        with lock:
+            latencies.extend(local)
+
+    beg_time = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(max(threads, 1))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, time.perf_counter() - beg_time
+
+
+###############################################################################
+# Benchmarks: each takes an ElasticsearchClient connected to the stand-in and the
+# parsed args, and returns a summary dict.
+
+def bench_search(es_client, args):
+    '''ElasticsearchClient.search_index with most_fields_query, uncached'''
+    queries = synthetic_queries(args.searches)
+    latencies, secs = timed_calls(
+        lambda qstring: es_client.search_index(qstring, max_size=args.hits,
+                                               query_builder=most_fields_query, verbose=0),
+        [(query,) for query in queries], args.threads)
+    return summarize('search_index', latencies, secs)
+
+def bench_retrieve(es_client, args):
+    '''search_index and extract_scores_and_ids, uncached (lean and compact with -lean)'''
+    def retrieve(qstring):
+        '''Search and decode the hits'''
+        results = es_client.search_index(qstring, max_size=args.hits, query_builder=most_fields_query,
+                                         verbose=0, lean=args.lean)
+        return extract_scores_and_ids(es_client.index_name, qstring, results, 0.0, args.lean)
+    latencies, secs = timed_calls(retrieve, [(query,) for query in synthetic_queries(args.searches)],
+                                  args.threads)
+    return summarize('retrieve', latencies, secs)
+
+def bench_index(es_client, args):
+    '''ElasticsearchClient.index_all_docs of a synthetic corpus (throughput in entries/sec)'''
+    docs = synthetic_docs(args.docs, args.entries, args.words)
+    beg_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = es_client.index_all_docs(docs=docs, workers=args.threads)
+    secs = time.perf_counter() - beg_time
+    return summarize('index_all_docs', [], secs, result.indexed + result.failed)
+
+def bench_export(es_client, args):
+    '''ElasticsearchClient.export_index over sliced scrolls (throughput in entries/sec)'''
+    out_dir = tempfile.mkdtemp(prefix='esbench')
+    try:
+        beg_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = es_client.export_index(os.path.join(out_dir, 'export.ndjson'),
+                                            slices=args.threads, page_size=args.page_size)
+        secs = time.perf_counter() - beg_time
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return summarize('export_index', [], secs, result.exported)
+
+def canned_response(server, args):
+    '''A search response from the stand-in, as a lean search gets it with -lean'''
+    results = server.search_response('zot0', args.hits)
+    if args.lean:
+        results = server.shape_response(results, lean_search_body({}))
+    return results
+
+def bench_extract(server, args):
+    '''extract_scores_and_ids on canned responses (no I/O)'''
+    results = canned_response(server, args)
+    latencies, secs = timed_calls(extract_scores_and_ids,
+                                  [('zot0', 'query', results, 0.0, args.lean)] * args.repeat)
+    return summarize('extract_scores_and_ids', latencies, secs)
+
+def bench_decode(server, args):
+    '''Parsing canned response bytes and extract_scores_and_ids (no I/O)'''
+    serializer = get_serializer(args.json)
+    data = json.dumps(canned_response(server, args)).encode('utf-8')
+    def decode():
+        '''Parse and extract'''
+        return extract_scores_and_ids('zot0', 'query', serializer.loads(data), 0.0, args.lean)
+    latencies, secs = timed_calls(decode, [()] * args.repeat)
+    summary = summarize('decode', latencies, secs)
+    summary['response_bytes'] = len(data)
+    return summary
+
+def bench_print_hits(server, args):
+    '''print_hits on canned responses, writing to a discarded buffer'''
+    results = server.search_response('zot0', args.hits)
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies, secs = timed_calls(print_hits, [(results,)] * args.repeat)
+    return summarize('print_hits', latencies, secs)
+
+CLIENT_BENCHMARKS = {'search' : bench_search, 'retrieve' : bench_retrieve, 'index' : bench_index,
+                     'export' : bench_export}
+LOCAL_BENCHMARKS = {'extract' : bench_extract, 'decode' : bench_decode, 'print_hits' : bench_print_hits}
+BENCHMARKS = sorted(list(CLIENT_BENCHMARKS) + list(LOCAL_BENCHMARKS))
+
+
+def bench_client(server, maxsize=10, cache=None, resilience=None, http_compress=False,
+                 serializer=None):
+    '''ElasticsearchClient for the stand-in, signing with fixed dummy credentials'''
+    credentials = CredentialCache(lambda: (AwsCredentials('AKIDBENCH', 'bench-secret', None), None))
+    client = get_elasticsearch_client(maxsize=maxsize, hostname='127.0.0.1', port=server.port,
+                                      use_ssl=False, credentials=credentials,
+                                      max_retries=0 if resilience is not None else 3,
+                                      http_compress=http_compress, serializer=serializer)
+    return ElasticsearchClient(0, doc_type='kb_document', cache=cache, client=client,
+                               resilience=resilience)
+
+def run_benchmarks(names, args):
+    '''Run the named benchmarks against a fresh stand-in.  Returns a list of summaries'''
+    summaries = []
+    with FakeElasticsearch(latency=args.latency, jitter=args.jitter, num_hits=args.hits,
+                           words_per_hit=args.words, scroll_hits=args.scroll_hits,
+                           error_rate=args.error_rate, slow_rate=args.slow_rate,
+                           slow_latency=args.slow_latency) as server:
+        resilience = ResilientTransport(hedge=True) if args.resilient else None
+        es_client = bench_client(server, maxsize=max(args.threads, 1), resilience=resilience,
+                                 http_compress=args.compress, serializer=get_serializer(args.json))
+        for name in names:
+            with measuring_rss({}) as summary:
+                if name in CLIENT_BENCHMARKS:
+                    bytes_in, bytes_out = server.bytes_in, server.bytes_out
+                    summary.update(CLIENT_BENCHMARKS[name](es_client, args))
+                    summary['sent_mb'] = (server.bytes_in - bytes_in) / (1024.0 * 1024.0)
+                    summary['received_mb'] = (server.bytes_out - bytes_out) / (1024.0 * 1024.0)
+                else:
+                    summary.update(LOCAL_BENCHMARKS[name](server, args))
+            print_summary(summary)
+            summaries.append(summary)
+        if server.errors:
+            print("Injected %d errors in %d requests" % (server.errors, server.requests))
+        if resilience is not None:
+            print("Resilience stats:", resilience.stats())
+            resilience.close()
+    return summaries
+
+
+###############################################################################
+# Reports and comparison with saved results
+
+# Metrics where bigger is better; for all others (latencies, memory) smaller is better
+HIGHER_IS_BETTER = ('throughput',)
+COMPARED_METRICS = ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'rss_growth_mb')
+# Changes in memory smaller than this are allocator noise, however large relatively
+RSS_NOISE_MB = 2.0
+
+def print_summary(summary):
+    '''Print one benchmark summary on one line (with the bytes on the wire, if counted)'''
+    line = ('%-24s %9d ops %8.2f s %12.1f ops/s  p50 %8.3f  p95 %8.3f  p99 %8.3f ms  rss %7.1f MB'
+            % (summary['name'], summary['operations'], summary['seconds'], summary['throughput'],
+               summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['peak_rss_mb']))
+    if summary.get('rss_growth_mb') is not None:
+        line += ' (+%.1f)' % summary['rss_growth_mb']
+    if 'response_bytes' in summary:
+        line += '  %d bytes/response' % summary['response_bytes']
+    if 'sent_mb' in summary:
+        line += '  wire %.2f MB out %.2f MB in' % (summary['sent_mb'], summary['received_mb'])
+    print(line)
+
+def save_results(path, summaries, args):
+    '''Save summaries and the settings that produced them as JSON'''
+    with open(path, 'w') as out:
+        json.dump({'time' : time.time(), 'settings' : vars(args), 'results' : summaries},
+                  out, indent=2, sort_keys=True)
+
+def compare_results(summaries, baseline_path, tolerance=0.1):
+    '''
+    Print each metric's change from a saved baseline, marking changes for the worse by
+    more than tolerance (a fraction) as regressions.  Returns the number of regressions.
+    '''
+    with open(baseline_path) as baseline_file:
+        baseline = {summary['name'] : summary for summary in json.load(baseline_file)['results']}
+    regressions = 0
+    for summary in summaries:
+        old = baseline.get(summary['name'])
+        if old is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if summary.get(metric) is None or old.get(metric) is None:
+                continue
+            if metric.endswith('_ms') and not old[metric]:
+                continue
+            change = (summary[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            regressed = worse > tolerance
+            if metric.endswith('_mb'):
+                regressed = summary[metric] - old[metric] > max(tolerance * old[metric], RSS_NOISE_MB)
+            regressions += regressed
+            print('%-24s %-12s %12.3f -> %12.3f  %+7.1f%%%s'
+                  % (summary['name'], metric, old[metric], summary[metric], 100.0 * change,
+                     '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    '''Run benchmarks, optionally saving results or comparing them with saved ones'''
+    parser = argparse.ArgumentParser(description="Benchmark esaws.py against a local ES stand-in")
+    parser.add_argument('benchmarks', type=str, nargs='*', default=BENCHMARKS,
+                        help='benchmarks to run (default: all of %s)' % ', '.join(BENCHMARKS))
+    parser.add_argument('-compare', metavar='FILE', type=str, help='Compare with results saved in FILE')
+    parser.add_argument('-compress', action='store_true', help='gzip request bodies and responses')
+    parser.add_argument('-docs', type=int, default=2000, help='Synthetic docs to index (default: 2000)')
+    parser.add_argument('-entries', type=int, default=5, help='Entries per doc (default: 5)')
+    parser.add_argument('-error_rate', type=float, default=0.0,
+                        help='Fraction of requests the stand-in fails with 503 (default: 0)')
+    parser.add_argument('-hits', type=int, default=10, help='Hits per search response (default: 10)')
+    parser.add_argument('-jitter', type=float, default=0.0, help='Extra random server latency (seconds)')
+    parser.add_argument('-json', type=str, choices=JSON_LIBRARIES, default=None,
+                        help='JSON library for the client (default: fastest installed)')
+    parser.add_argument('-latency', type=float, default=0.002, help='Server latency (default: 0.002 seconds)')
+    parser.add_argument('-lean', action='store_true',
+                        help='Lean searches and compact hit decoding (retrieve, extract, decode)')
+    parser.add_argument('-page_size', type=int, default=1000, help='Scroll page size for export')
+    parser.add_argument('-repeat', type=int, default=20000, help='Calls for the local benchmarks')
+    parser.add_argument('-resilient', action='store_true',
+                        help='Send requests through a ResilientTransport with hedged reads')
+    parser.add_argument('-save', metavar='FILE', type=str, help='Save results as JSON to FILE')
+    parser.add_argument('-scroll_hits', type=int, default=20000, help='Hits to export (default: 20000)')
+    parser.add_argument('-searches', type=int, default=2000, help='Searches to run (default: 2000)')
+    parser.add_argument('-slow_latency', type=float, default=0.25,
+                        help='Extra latency of slow requests (default: 0.25 seconds)')
+    parser.add_argument('-slow_rate', type=float, default=0.0,
+                        help='Fraction of requests the stand-in slows down (default: 0)')
+    parser.add_argument('-threads', type=int, default=4, help='Client threads (default: 4)')
+    parser.add_argument('-tolerance', type=float, default=0.1,
+                        help='Fractional change counted as a regression (default: 0.1)')
+    parser.add_argument('-words', type=int, default=40, help='Words per entry or hit (default: 40)')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+
+    summaries = run_benchmarks(args.benchmarks, args)
+    if args.save:
+        save_results(args.save, summaries, args)
+    if args.compare:
+        regressions = compare_results(summaries, args.compare, args.tolerance)
+        print("%d regressions beyond %.0f%%" % (regressions, 100.0 * args.tolerance))
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
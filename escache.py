@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+'''In-process caching and coalescing of Elasticsearch search results'''
+
+import asyncio
+from collections import OrderedDict
+import functools
+import hashlib
+import json
+import threading
+import time
+
+
+def canonical_key(index_name, body, offset=0, max_size=10):
+    '''Hash of a search that is the same for equal bodies, whatever their key order'''
+    canonical = json.dumps([index_name, body, offset, max_size], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class SearchCache:
+    '''
+    Thread-safe LRU cache of search results with a time-to-live.  Keys include a per-index
+    generation, so invalidating an index makes all of its cached results unreachable at once
+    (they are then evicted as least recently used).  Cached results are shared between
+    callers and must be treated as read-only.
+    '''
+
+    def __init__(self, max_entries=1024, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, index_name, body, offset=0, max_size=10):
+        '''Get the cache key for a search of the current generation of an index'''
+        return (index_name, self.generations.get(index_name, 0),
+                canonical_key(index_name, body, offset, max_size))
+
+    def get(self, key):
+        '''Get the cached results for a key, or None if missing or expired'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, results = entry
+                if expires > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return results
+                del self.entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, results):
+        '''Cache results for a key, evicting the least recently used entries if full'''
+        if results is None:
+            return
+        with self.lock:
+            if key[1] != self.generations.get(key[0], 0):
+                return  # the index changed while the search was in flight
+            self.entries[key] = (time.time() + self.ttl, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, index_name):
+        '''Forget all results cached for an index (or alias), e.g. after it is modified'''
+        with self.lock:
+            self.generations[index_name] = self.generations.get(index_name, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        '''Forget all cached results'''
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''Get counters for sizing the cache'''
+        with self.lock:
+            return {
+                'entries' : len(self.entries),
+                'max_entries' : self.max_entries,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'invalidations' : self.invalidations,
+            }
+
+
+class _Call:
+    '''One in-flight call whose result is shared by every caller with the same key'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent calls from threads: while a call for a key is in
+    flight, other callers with the same key wait for it and share its result (or
+    exception) instead of making their own.  Shared results must be treated as read-only.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        '''Return func(*args, **kwargs), or the result of an identical call already in flight'''
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args, **kwargs)
+            except BaseException as ex:
+                call.error = ex
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        '''Get counts of calls executed and of calls coalesced into them'''
+        with self.lock:
+            return {'executed' : self.executed, 'coalesced' : self.coalesced,
+                    'in_flight' : len(self.calls)}
+
+
+class AsyncSingleFlight:
+    '''
+    SingleFlight for coroutines running in one event loop.  Each call runs as a task
+    of its own, so cancelling one of its callers (even the first) does not cancel it
+    for the others.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        '''Return await func(*args, **kwargs), or the result of an identical call already in flight'''
+        task = self.calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self.calls[key] = asyncio.ensure_future(func(*args, **kwargs))
+            task.add_done_callback(functools.partial(self._finished, key))
+            self.executed += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        '''Forget a finished call, marking its exception retrieved in case every caller was cancelled'''
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        '''Get counts of calls executed and of calls coalesced into them'''
+        return {'executed' : self.executed, 'coalesced' : self.coalesced,
+                'in_flight' : len(self.calls)}
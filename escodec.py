@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''JSON serializers for Elasticsearch payloads: orjson when it is installed, else the stdlib json'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+JSON_LIBRARIES = ('orjson', 'json')
+DEFAULT_JSON_LIBRARY = 'orjson' if orjson is not None else 'json'
+
+
+class StdlibJSONSerializer(JSONSerializer):
+    '''
+    The elasticsearch client's JSONSerializer (compact, non-ASCII kept as is), plus
+    dumps_bytes for building NDJSON bodies directly as UTF-8 bytes.
+    '''
+    library = 'json'
+
+    def dumps_bytes(self, data):
+        '''Serialize data to UTF-8 JSON bytes'''
+        try:
+            return json.dumps(data, default=self.default, ensure_ascii=False,
+                              separators=(',', ':')).encode('utf-8')
+        except (ValueError, TypeError) as ex:
+            raise SerializationError(data, ex)
+
+
+class OrjsonSerializer(JSONSerializer):
+    '''
+    Serializer using orjson, which encodes straight to UTF-8 bytes and parses several
+    times faster than the stdlib.  Types orjson does not know natively (e.g. Decimal)
+    go through the same default as JSONSerializer.
+    '''
+    library = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("OrjsonSerializer requires orjson (pip install orjson)")
+
+    def dumps_bytes(self, data):
+        '''Serialize data to UTF-8 JSON bytes'''
+        try:
+            return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError as ex:
+            raise SerializationError(data, ex)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        return self.dumps_bytes(data)
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as ex:
+            raise SerializationError(s, ex)
+
+
+SERIALIZERS = {'json' : StdlibJSONSerializer, 'orjson' : OrjsonSerializer}
+
+def get_serializer(library=None):
+    '''Get a serializer for the named JSON library (one of JSON_LIBRARIES), by default the fastest installed'''
+    return SERIALIZERS[library if library else DEFAULT_JSON_LIBRARY]()
+
+DEFAULT_SERIALIZER = get_serializer()
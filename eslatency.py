@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+'''
+Latency histograms with bounded relative error, in the style of HdrHistogram, and
+per-request instrumentation of ElasticsearchClient calls aggregated into them.
+'''
+
+from contextlib import contextmanager
+import contextvars
+import json
+import threading
+import time
+
+HISTOGRAM_SIGNIFICANT_BITS = 7
+SUMMARY_PERCENTILES = (50.0, 90.0, 95.0, 99.0, 99.9)
+
+
+class LatencyHistogram:
+    '''
+    Thread-safe histogram of latencies recorded in microseconds.  Buckets are linear
+    below 2**significant_bits and log-linear above, so every recorded value is known
+    to within 1 part in 2**(significant_bits - 1) (under 2% by default), whatever its
+    magnitude, in a sparse map of a few hundred buckets at most.
+    '''
+
+    def __init__(self, significant_bits=HISTOGRAM_SIGNIFICANT_BITS):
+        self.bits = significant_bits
+        self.sub_count = 1 << significant_bits
+        self.half_count = self.sub_count >> 1
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def bucket_index(self, value):
+        '''Index of the bucket for an integer value'''
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.bits
+        return (shift << (self.bits - 1)) + (value >> shift)
+
+    def bucket_range(self, index):
+        '''Lowest and highest values in the bucket with index'''
+        if index < self.sub_count:
+            return index, index
+        shift = index // self.half_count - 1
+        mantissa = index - shift * self.half_count
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds, count=1):
+        '''Record a latency given in seconds.  Returns the total count, including it'''
+        return self.record_micros(int(seconds * 1e6), count)
+
+    def record_micros(self, micros, count=1):
+        '''Record a latency given in (integer) microseconds.  Returns the total count, including it'''
+        micros = max(micros, 0)
+        index = self.bucket_index(micros)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + count
+            self.total += count
+            self.sum += micros * count
+            if self.min is None or micros < self.min:
+                self.min = micros
+            if micros > self.max:
+                self.max = micros
+            return self.total
+
+    def merge(self, other):
+        '''Add the counts of another histogram with the same significant_bits'''
+        with other.lock:
+            counts, total, total_sum = dict(other.counts), other.total, other.sum
+            other_min, other_max = other.min, other.max
+        with self.lock:
+            for index, count in counts.items():
+                self.counts[index] = self.counts.get(index, 0) + count
+            self.total += total
+            self.sum += total_sum
+            if other_min is not None and (self.min is None or other_min < self.min):
+                self.min = other_min
+            self.max = max(self.max, other_max)
+
+    def reset(self):
+        '''Forget all recorded values'''
+        with self.lock:
+            self.counts.clear()
+            self.total, self.sum, self.min, self.max = 0, 0, None, 0
+
+    def percentile(self, pct):
+        '''Value (microseconds) at or below which pct percent of recorded values fall'''
+        with self.lock:
+            if not self.total:
+                return 0
+            rank = max(int(pct / 100.0 * self.total + 0.5), 1)
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= rank:
+                    return min(self.bucket_range(index)[1], self.max)
+            return self.max
+
+    def mean(self):
+        '''Mean recorded value in microseconds'''
+        with self.lock:
+            return self.sum / self.total if self.total else 0.0
+
+    def summary(self, percentiles=SUMMARY_PERCENTILES):
+        '''Summary dict of count, min, mean, percentiles, and max, all in milliseconds'''
+        result = {'count' : self.total, 'min_ms' : (self.min or 0) / 1000.0,
+                  'mean_ms' : self.mean() / 1000.0, 'max_ms' : self.max / 1000.0}
+        for pct in percentiles:
+            result['p%s_ms' % ('%g' % pct).replace('.', '_')] = self.percentile(pct) / 1000.0
+        return result
+
+    def cumulative_buckets(self, bounds):
+        '''Counts of values <= each bound (microseconds), as for Prometheus histogram buckets'''
+        with self.lock:
+            items = sorted(self.counts.items())
+        cumulative, idx, seen = [], 0, 0
+        for bound in bounds:
+            while idx < len(items) and self.bucket_range(items[idx][0])[1] <= bound:
+                seen += items[idx][1]
+                idx += 1
+            cumulative.append(seen)
+        return cumulative
+
+    def print_bars(self, width=50):
+        '''Print a bar chart of counts in power-of-two millisecond ranges'''
+        with self.lock:
+            items = sorted(self.counts.items())
+        if not items:
+            return
+        ranges = {}
+        for index, count in items:
+            millis = self.bucket_range(index)[0] / 1000.0
+            upper = 1 << max(int(millis).bit_length(), 0)
+            ranges[upper] = ranges.get(upper, 0) + count
+        peak = max(ranges.values())
+        for upper in sorted(ranges):
+            count = ranges[upper]
+            print('  < %7d ms %9d %s' % (upper, count, '#' * max(int(width * count / peak), 1)))
+
+
+###############################################################################
+# Per-request instrumentation.  While a client call is being measured, its CallTimer
+# is the current one for the thread (or asyncio task), and each layer that handles the request (client,
+# transport wrapper, signed connection) adds its own phase times and sizes to it.
+# When metrics are disabled there is no current call, and each layer's only cost is
+# looking that up.
+
+PROMETHEUS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1.0, 2.5, 5.0, 10.0)
+
+# A context variable is per thread, like a threading.local, and also per asyncio task,
+# so that coroutines measured concurrently on one event loop keep their calls apart.
+_current = contextvars.ContextVar('current_call', default=None)
+
+def current_call():
+    '''Get the CallTimer being measured on this thread or task, or None'''
+    return _current.get()
+
+@contextmanager
+def measuring(call):
+    '''
+    Context manager making call (a CallTimer, or None) the current one for this thread
+    or task, e.g. on a worker thread sending part of a call measured on another thread.
+    '''
+    previous = _current.get()
+    _current.set(call)
+    try:
+        yield call
+    finally:
+        _current.set(previous)
+
+
+class CallTimer:
+    '''Phase times (seconds) and bytes sent and received for one measured call'''
+    __slots__ = ('operation', 'begun', 'phases', 'bytes_out', 'bytes_in', 'handed_off', 'received_at')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.begun = time.perf_counter()
+        self.phases = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.handed_off = None
+        self.received_at = None
+
+    def add(self, phase, seconds):
+        '''Add seconds to a phase (phases repeat, e.g. when a request is retried)'''
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def since(self, phase, beg_time):
+        '''Add the time since beg_time (from time.perf_counter) to a phase'''
+        self.add(phase, time.perf_counter() - beg_time)
+
+    def sending(self, body):
+        '''
+        Called by the connection as it starts a request: everything since the call was
+        handed to the transport was serialization.
+        '''
+        if self.handed_off is not None:
+            self.since('serialize', self.handed_off)
+            self.handed_off = None
+        self.bytes_out += len(body) if body else 0
+
+    def merge(self, other):
+        '''Add the phase times and bytes of another CallTimer (e.g. of a hedged attempt)'''
+        for phase, seconds in other.phases.items():
+            self.add(phase, seconds)
+        self.bytes_out += other.bytes_out
+        self.bytes_in += other.bytes_in
+
+    def received(self, data, beg_time, wire_bytes=None):
+        '''
+        Called by the connection once the response is read, with when it sent the request,
+        and the response's size on the wire if it differs from len(data) (compression).
+        '''
+        self.received_at = time.perf_counter()
+        self.add('roundtrip', self.received_at - beg_time)
+        self.bytes_in += int(wire_bytes) if wire_bytes is not None else len(data)
+
+
+def measured_call(func, *args, **kwargs):
+    '''
+    Return func(*args, **kwargs), a call that sends one request through an Elasticsearch
+    transport.  If a call is being measured, time the serialization before the connection
+    sends the request and the parsing after it reads the response, and record the
+    server's took.
+    '''
+    call = current_call()
+    if call is None:
+        return func(*args, **kwargs)
+    call.handed_off = time.perf_counter()
+    result = func(*args, **kwargs)
+    if call.received_at is not None:
+        call.since('parse', call.received_at)
+        call.received_at = None
+    if isinstance(result, dict) and 'took' in result:
+        call.add('server', result['took'] / 1000.0)
+    return result
+
+
+class RequestMetrics:
+    '''
+    Aggregates measured calls into a LatencyHistogram per operation and phase, with
+    counts of calls and bytes sent and received per operation.  The network phase is
+    the round trip less the server's took.  Export with to_json or to_prometheus.
+    '''
+
+    def __init__(self, prefix='esaws'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def call(self, operation):
+        '''Context manager measuring one call of operation; yields its CallTimer'''
+        call = CallTimer(operation)
+        try:
+            with measuring(call):
+                yield call
+        finally:
+            self.record(call)
+
+    def record(self, call):
+        '''Add a finished call to the histograms'''
+        phases = dict(call.phases)
+        phases['total'] = time.perf_counter() - call.begun
+        roundtrip = phases.pop('roundtrip', None)
+        if roundtrip is not None:
+            phases['network'] = max(roundtrip - phases.get('server', 0.0), 0.0)
+        with self.lock:
+            sizes = self.sizes.setdefault(call.operation, [0, 0, 0])
+            sizes[0] += 1
+            sizes[1] += call.bytes_out
+            sizes[2] += call.bytes_in
+            histograms = [self.histograms.setdefault((call.operation, phase), LatencyHistogram())
+                          for phase in phases]
+        for histogram, seconds in zip(histograms, phases.values()):
+            histogram.record(seconds)
+
+    def reset(self):
+        '''Forget all measurements'''
+        with self.lock:
+            self.histograms.clear()
+            self.sizes.clear()
+
+    def to_dict(self):
+        '''Summaries per operation: calls, bytes, and latency summary per phase (ms)'''
+        with self.lock:
+            histograms, sizes = dict(self.histograms), {op : list(val) for op, val in self.sizes.items()}
+        result = {}
+        for operation, (calls, bytes_out, bytes_in) in sizes.items():
+            result[operation] = {'calls' : calls, 'bytes_out' : bytes_out, 'bytes_in' : bytes_in,
+                                 'phases' : {}}
+        for (operation, phase), histogram in histograms.items():
+            result[operation]['phases'][phase] = histogram.summary()
+        return result
+
+    def to_json(self):
+        '''Summaries as a JSON string'''
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        '''Histograms and byte counters in the Prometheus text exposition format'''
+        with self.lock:
+            histograms, sizes = sorted(self.histograms.items()), sorted(self.sizes.items())
+        name = '%s_request_phase_seconds' % self.prefix
+        lines = ['# HELP %s Time per request phase.' % name, '# TYPE %s histogram' % name]
+        for (operation, phase), histogram in histograms:
+            labels = 'operation="%s",phase="%s"' % (operation, phase)
+            bounds = [int(bound * 1e6) for bound in PROMETHEUS_BUCKETS]
+            for bound, count in zip(PROMETHEUS_BUCKETS, histogram.cumulative_buckets(bounds)):
+                lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, histogram.total))
+            lines.append('%s_sum{%s} %.6f' % (name, labels, histogram.sum / 1e6))
+            lines.append('%s_count{%s} %d' % (name, labels, histogram.total))
+        for metric, pos, help_text in (('requests_total', 0, 'Measured calls.'),
+                                       ('sent_bytes_total', 1, 'Request body bytes sent.'),
+                                       ('received_bytes_total', 2, 'Response bytes received.')):
+            lines += ['# HELP %s_%s %s' % (self.prefix, metric, help_text),
+                      '# TYPE %s_%s counter' % (self.prefix, metric)]
+            lines += ['%s_%s{operation="%s"} %d' % (self.prefix, metric, operation, counts[pos])
+                      for operation, counts in sizes]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+'''
+Replay a log of recorded queries against a cluster (or a local stand-in) through
+ElasticsearchClient, open-loop, and report latency histograms per query type.
+
+A query log is JSON lines (maybe .gz), one search per line, e.g.:
+    {"timestamp": 1514764800.25, "index": "zot7777777", "query_type": "match_query",
+     "query": "reset my password", "from": 0, "size": 10}
+Either "query" (a query string, built with the named query_type from esaws.QUERY_BUILDERS)
+or "body" (a complete search body) is required; everything else is optional.
+'''
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import threading
+import time
+
+from esaws import ElasticsearchClient, QUERY_BUILDERS, open_ndjson, search_request
+from esbench import FakeElasticsearch, bench_client, synthetic_queries
+from eslatency import LatencyHistogram
+
+DEFAULT_QUERY_TYPE = 'most_fields_query'
+BODY_QUERY_TYPE = 'body'
+REPLAY_MAX_IN_FLIGHT = 10000
+
+ReplayQuery = namedtuple('ReplayQuery', 'offset query_type request')
+
+
+def read_query_log(paths):
+    '''Lazily read query log records from one or more JSON lines files'''
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with open_ndjson(path) as log_file:
+            for line in log_file:
+                if line.strip():
+                    yield json.loads(line)
+
+def replay_request(record, index_name, doc_type='kb_document'):
+    '''Get (query_type, search request) for one query log record'''
+    query_type = record.get('query_type', BODY_QUERY_TYPE if 'body' in record else DEFAULT_QUERY_TYPE)
+    body = record.get('body')
+    if body is None:
+        body = QUERY_BUILDERS[query_type](record['query'])
+    return query_type, search_request(record.get('index', index_name), doc_type, body,
+                                      record.get('from', 0), record.get('size', 10))
+
+def schedule_queries(records, index_name, doc_type='kb_document', qps=None, speedup=1.0,
+                     max_queries=None):
+    '''
+    Generate ReplayQuery tuples with offsets in seconds from the start of the replay:
+    evenly spaced at qps queries per second if given, else at the records' recorded
+    timestamps, compressed by speedup.
+    '''
+    first = None
+    for num, record in enumerate(records):
+        if max_queries is not None and num >= max_queries:
+            return
+        if qps:
+            offset = num / qps
+        else:
+            if 'timestamp' not in record:
+                raise ValueError("Record %d has no timestamp; replay it at a fixed -qps" % num)
+            if first is None:
+                first = record['timestamp']
+            offset = (record['timestamp'] - first) / speedup
+        query_type, request = replay_request(record, index_name, doc_type)
+        yield ReplayQuery(offset, query_type, request)
+
+
+class QueryReplayer:
+    '''
+    Open-loop load generator: each query is sent at its scheduled time, whether or not
+    earlier ones have finished, by a pool of concurrency threads.  Latency is measured
+    from the scheduled time, so queueing behind a slow cluster counts against it
+    instead of silently slowing the load (coordinated omission).
+    Queries scheduled during the first warmup seconds are sent but not measured.
+    Failed queries (often fast rejections, or slow timeouts) are measured in a separate
+    error histogram per query type, so that they do not skew the latencies of answers.
+    '''
+
+    def __init__(self, es_client, concurrency=8, warmup=0.0, max_in_flight=REPLAY_MAX_IN_FLIGHT):
+        self.es_client = es_client
+        self.concurrency = concurrency
+        self.warmup = warmup
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.histograms = {}
+        self.error_histograms = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.late = 0
+
+    def histograms_for(self, query_type):
+        '''Get the (latency, error latency) histograms for a query type, creating them on first use'''
+        with self.lock:
+            if query_type not in self.histograms:
+                self.histograms[query_type] = LatencyHistogram()
+                self.error_histograms[query_type] = LatencyHistogram()
+            return self.histograms[query_type], self.error_histograms[query_type]
+
+    def send(self, query, scheduled, measured):
+        '''Send one query and record its latency from the scheduled time, as an answer or an error'''
+        try:
+            try:
+                self.es_client.perform_request(*query.request)
+                error = None
+            except Exception as ex:
+                error = ex
+            if measured:
+                latency = time.perf_counter() - scheduled
+                answers, errors = self.histograms_for(query.query_type)
+                if error is None:
+                    answers.record(latency)
+                elif errors.record(latency) == 1:
+                    print("QueryReplayer.send: %s failed: %s: %s"
+                          % (query.query_type, type(error).__name__, error))
+        finally:
+            self.in_flight.release()
+
+    def run(self, queries):
+        '''Replay scheduled queries; returns the measured seconds (after warm-up)'''
+        beg_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for query in queries:
+                scheduled = beg_time + query.offset
+                delay = scheduled - time.perf_counter()
+                if delay > 0.0:
+                    time.sleep(delay)
+                elif delay < -0.001:
+                    self.late += 1
+                self.in_flight.acquire()
+                executor.submit(self.send, query, scheduled, query.offset >= self.warmup)
+                self.sent += 1
+        return max(time.perf_counter() - beg_time - self.warmup, 1e-9)
+
+    def report(self, seconds, verbose=1):
+        '''Print and return per-query-type summaries (latencies in milliseconds)'''
+        summaries = {}
+        print('%-20s %8s %6s %9s %9s %9s %9s %9s %9s %9s'
+              % ('query_type', 'count', 'errors', 'qps', 'p50', 'p90', 'p99', 'p99.9', 'max', 'err_p50'))
+        for query_type in sorted(self.histograms):
+            histogram = self.histograms[query_type]
+            summary = histogram.summary()
+            summary['error_latency'] = self.error_histograms[query_type].summary()
+            summary['errors'] = summary['error_latency']['count']
+            summary['qps'] = (summary['count'] + summary['errors']) / seconds
+            summaries[query_type] = summary
+            print('%-20s %8d %6d %9.1f %9.2f %9.2f %9.2f %9.2f %9.2f %9.2f'
+                  % (query_type, summary['count'], summary['errors'], summary['qps'],
+                     summary['p50_ms'], summary['p90_ms'], summary['p99_ms'], summary['p99_9_ms'],
+                     summary['max_ms'], summary['error_latency']['p50_ms']))
+            if verbose > 1:
+                histogram.print_bars()
+        if self.late:
+            print("%d of %d queries were sent late: add -concurrency or lower the rate"
+                  % (self.late, self.sent))
+        return summaries
+
+
+def write_synthetic_log(path, num_queries, qps=50.0, index_name=None, seed=4):
+    '''Write a query log of random queries of every query type, with Poisson arrival times'''
+    rng = random.Random(seed)
+    timestamp = time.time()
+    with open_ndjson(path, 'wt') as out:
+        for qstring in synthetic_queries(num_queries, seed=seed):
+            timestamp += rng.expovariate(qps)
+            record = {'timestamp' : timestamp, 'query_type' : rng.choice(sorted(QUERY_BUILDERS)),
+                      'query' : qstring, 'size' : 10}
+            if index_name:
+                record['index'] = index_name
+            out.write(json.dumps(record) + '\n')
+
+
+def main():
+    '''Replay a query log against the cluster or a local stand-in'''
+    parser = argparse.ArgumentParser(description="Open-loop replay of a query log through ElasticsearchClient")
+    parser.add_argument('logs', metavar='LOG', type=str, nargs='+', help='query log JSON lines files (maybe .gz)')
+    parser.add_argument('-boto', action='store_false',
+                        help='Use ENV variables instead of reading AWS credentials from file (boto)')
+    parser.add_argument('-concurrency', metavar='N', type=int, default=8, help='Sender threads (default: 8)')
+    parser.add_argument('-fake', metavar='LATENCY', type=float, nargs='?', const=0.005, default=None,
+                        help='Replay against a local stand-in with this latency (const: 0.005 seconds)')
+    parser.add_argument('-make_log', metavar='N', type=int,
+                        help='Write N synthetic queries to the (first) LOG file and exit')
+    parser.add_argument('-max_queries', metavar='N', type=int, help='Stop after N queries')
+    parser.add_argument('-qps', type=float, help='Fixed rate in queries/sec (default: recorded timing)')
+    parser.add_argument('-save', metavar='FILE', type=str, help='Save summaries as JSON to FILE')
+    parser.add_argument('-speedup', type=float, default=1.0, help='Compress recorded timing by this factor')
+    parser.add_argument('-verbose', type=int, nargs='?', const=2, default=1,
+                        help='Verbosity (const: 2, which prints histograms)')
+    parser.add_argument('-warmup', metavar='SECONDS', type=float, default=0.0,
+                        help='Send but do not measure queries in the first SECONDS')
+    parser.add_argument('-zoid', metavar='ID', type=int, default=7777777,
+                        help='Zoroastrian ID of the default index (default: 7777777)')
+    args = parser.parse_args()
+
+    if args.make_log:
+        write_synthetic_log(args.logs[0], args.make_log, args.qps or 50.0)
+        return
+    server = None
+    if args.fake is not None:
+        server = FakeElasticsearch(latency=args.fake).start()
+        es_client = bench_client(server, maxsize=args.concurrency)
+    else:
+        es_client = ElasticsearchClient(args.zoid, args.boto, maxsize=args.concurrency)
+    try:
+        replayer = QueryReplayer(es_client, args.concurrency, args.warmup)
+        queries = schedule_queries(read_query_log(args.logs), es_client.index_name, es_client.doc_type,
+                                   args.qps, args.speedup, args.max_queries)
+        seconds = replayer.run(queries)
+        summaries = replayer.report(seconds, args.verbose)
+    finally:
+        if server is not None:
+            server.stop()
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(summaries, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
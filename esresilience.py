@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+'''Retries with jittered backoff, a circuit breaker, and hedged reads for Elasticsearch requests'''
+
+from collections import deque
+from concurrent.futures import CancelledError, FIRST_COMPLETED, ThreadPoolExecutor, wait
+import random
+import threading
+import time
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+
+from eslatency import CallTimer, current_call, measuring
+
+RETRY_STATUSES = (429, 502, 503, 504)
+BREAKER_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+READ_ENDPOINTS = ('_search', '_msearch', '_count', '_mget', '_analyze')
+
+
+class CircuitOpenError(TransportError):
+    '''Raised instead of sending a request while the circuit breaker is open'''
+
+
+class RetryPolicy:
+    '''
+    Retry failed idempotent requests up to max_attempts times in all, after exponential
+    backoff with full jitter (a random delay up to base_delay * 2**retry, at most
+    max_delay), but never past a per-call deadline in seconds.  Connection errors,
+    timeouts, and responses with a status in statuses are retried.
+    '''
+
+    def __init__(self, max_attempts=4, base_delay=0.05, max_delay=2.0, deadline=10.0,
+                 statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.statuses = statuses
+
+    def backoff(self, retry):
+        '''Random delay before retry number retry (counting from 0)'''
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def should_retry(self, ex):
+        '''True if a failed request may succeed when sent again'''
+        if isinstance(ex, CircuitOpenError):
+            return False
+        return isinstance(ex, ESConnectionError) or ex.status_code in self.statuses
+
+
+class CircuitBreaker:
+    '''
+    Fails fast while the cluster is unhealthy: after failure_threshold consecutive
+    failures (connection errors, 5xx responses, or unexpected exceptions while sending),
+    the circuit opens and requests raise CircuitOpenError without being sent.  After
+    reset_timeout seconds, one trial request is let through (half open); its success
+    closes the circuit, and its failure reopens it.
+    Other responses, such as 404s, show the cluster is up, so they count as successes.
+    '''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0, statuses=BREAKER_STATUSES):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.statuses = statuses
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.opens = 0
+        self.short_circuits = 0
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        '''
+        Raise CircuitOpenError unless a request may be sent now.  Returns True if the
+        request is the half-open trial, whose slot must be released (see release_trial).
+        '''
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+                self.state, self.trial_in_flight = self.HALF_OPEN, False
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.short_circuits += 1
+        raise CircuitOpenError('N/A', 'circuit_open', 'Elasticsearch circuit breaker is open')
+
+    def release_trial(self):
+        '''Free the half-open trial slot, however the trial request ended'''
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_in_flight = False
+
+    def is_failure(self, ex):
+        '''True if an error means the cluster is unhealthy (anything but an error response)'''
+        if not isinstance(ex, TransportError) or isinstance(ex, ESConnectionError):
+            return True
+        return ex.status_code in self.statuses
+
+    def record_success(self):
+        '''Close the circuit after a response from a healthy cluster'''
+        with self.lock:
+            self.state, self.failures, self.trial_in_flight = self.CLOSED, 0, False
+
+    def record_failure(self):
+        '''Count a failure, opening the circuit at the threshold or after a failed trial'''
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opens += 1
+                self.state, self.opened_at, self.trial_in_flight = self.OPEN, time.monotonic(), False
+
+
+class LatencyWindow:
+    '''
+    Latencies of the last size successful requests, with a percentile that is
+    recomputed every refresh records (None until min_samples have been recorded).
+    '''
+
+    def __init__(self, size=1000, percentile=95.0, min_samples=50, refresh=50):
+        self.samples = deque(maxlen=size)
+        self.pct = percentile
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self.value = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        '''Add one latency'''
+        with self.lock:
+            self.samples.append(seconds)
+            self.pending += 1
+            if self.pending >= self.refresh and len(self.samples) >= self.min_samples:
+                ordered = sorted(self.samples)
+                self.value = ordered[min(int(len(ordered) * self.pct / 100.0), len(ordered) - 1)]
+                self.pending = 0
+
+    def percentile(self):
+        '''The latest computed percentile in seconds, or None'''
+        return self.value
+
+
+def is_read(method, path):
+    '''True for searches and other requests that only read'''
+    if path.endswith('/scroll'):
+        return False
+    return method in ('GET', 'HEAD') or any(part in READ_ENDPOINTS for part in path.split('/'))
+
+def is_idempotent(method, path):
+    '''True if sending a request twice has the same effect as sending it once'''
+    return method in IDEMPOTENT_METHODS or is_read(method, path)
+
+
+class ResilientTransport:
+    '''
+    Sends requests through a send function, such as ElasticsearchClient.send_request,
+    retrying idempotent ones per a RetryPolicy, guarded by a CircuitBreaker.  If hedge
+    is set, a read that takes longer than the hedge_percentile of recent read latencies
+    gets a duplicate request, and whichever answers first wins.  Hedging duplicates
+    about 5% of reads to cut the tail latency that one slow node causes.
+    The underlying transport should not retry on its own (see get_elasticsearch_client).
+    '''
+
+    def __init__(self, retry=None, breaker=None, hedge=False, hedge_percentile=95.0,
+                 hedge_workers=16, hedge_min_delay=0.005):
+        self.retry = retry if retry else RetryPolicy()
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.hedge = hedge
+        self.latencies = LatencyWindow(percentile=hedge_percentile)
+        self.hedge_min_delay = hedge_min_delay
+        self.executor = ThreadPoolExecutor(max_workers=hedge_workers) if hedge else None
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_cancelled = 0
+
+    def perform(self, send, method, path, params=None, body=None, headers=None, deadline=None):
+        '''
+        Return send(method, path, params, body, headers), retrying and hedging as configured,
+        within deadline seconds (by default the RetryPolicy's).  Each attempt's request_timeout
+        is cut to the time left.  Raises the last TransportError if all attempts fail.
+        '''
+        deadline_at = time.monotonic() + (deadline if deadline else self.retry.deadline)
+        retryable = is_idempotent(method, path)
+        hedged = self.hedge and is_read(method, path)
+        retry = 0
+        while True:
+            attempt_params = dict(params or {})
+            remaining = max(deadline_at - time.monotonic(), 0.001)
+            attempt_params['request_timeout'] = min(attempt_params.get('request_timeout', remaining), remaining)
+            try:
+                if hedged:
+                    return self.send_hedged(send, method, path, attempt_params, body, headers)
+                return self.send_once(send, method, path, attempt_params, body, headers)
+            except TransportError as ex:
+                if not retryable or retry + 1 >= self.retry.max_attempts or not self.retry.should_retry(ex):
+                    raise
+                delay = self.retry.backoff(retry)
+                if time.monotonic() + delay >= deadline_at:
+                    raise
+                retry += 1
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+
+    def send_once(self, send, method, path, params, body, headers):
+        '''Send one request through the circuit breaker, recording the latency of reads'''
+        trial = self.breaker.before_request()
+        start = time.perf_counter()
+        try:
+            # The transport pops request_timeout, so each send gets its own params
+            result = send(method, path, dict(params), body, headers)
+        except Exception as ex:
+            if self.breaker.is_failure(ex):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        finally:
+            if trial:
+                self.breaker.release_trial()
+        self.breaker.record_success()
+        if is_read(method, path):
+            self.latencies.record(time.perf_counter() - start)
+        return result
+
+    def send_attempt(self, won, parent, send, method, path, params, body, headers):
+        '''
+        send_once on an executor thread, unless another attempt at the same read has
+        already won (the won Event is set), in which case it raises CancelledError.
+        If the caller's call is measured (parent is its CallTimer), the attempt is measured
+        by a CallTimer of its own, so that concurrent attempts do not mix their phases.
+        Returns (result, CallTimer or None).
+        '''
+        if won.is_set():
+            with self.lock:
+                self.hedges_cancelled += 1
+            raise CancelledError()
+        call = CallTimer(parent.operation) if parent is not None else None
+        with measuring(call):
+            result = self.send_once(send, method, path, params, body, headers)
+        won.set()
+        return result, call
+
+    def send_hedged(self, send, method, path, params, body, headers):
+        '''
+        Send a read, and a duplicate if it is slower than the hedging percentile.
+        The winning attempt's phases and bytes are added to the caller's measured call.
+        A duplicate that has not been sent when the other attempt wins is cancelled.
+        '''
+        hedge_delay = self.latencies.percentile()
+        if hedge_delay is None:
+            return self.send_once(send, method, path, params, body, headers)
+        parent = current_call()
+        attempt = (self.send_attempt, threading.Event(), parent, send, method, path, params, body, headers)
+        primary = self.executor.submit(*attempt)
+        pending, error = {primary}, None
+        done, _ = wait(pending, timeout=max(hedge_delay, self.hedge_min_delay))
+        if not done:
+            with self.lock:
+                self.hedges += 1
+            backup = self.executor.submit(*attempt)
+            pending.add(backup)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    result, call = future.result()
+                    if future is not primary:
+                        with self.lock:
+                            self.hedge_wins += 1
+                    for loser in pending:
+                        if loser.cancel():
+                            with self.lock:
+                                self.hedges_cancelled += 1
+                    if call is not None:
+                        parent.merge(call)
+                    return result
+                error = future.exception()
+        raise error
+
+    def stats(self):
+        '''Get counters of retries, hedges, and circuit breaker activity'''
+        with self.lock:
+            stats = {'retries' : self.retries, 'hedges' : self.hedges, 'hedge_wins' : self.hedge_wins,
+                     'hedges_cancelled' : self.hedges_cancelled}
+        stats.update({'breaker_state' : self.breaker.state, 'breaker_opens' : self.breaker.opens,
+                      'short_circuits' : self.breaker.short_circuits,
+                      'hedge_delay_ms' : 1000.0 * (self.latencies.percentile() or 0.0)})
+        return stats
+
+    def close(self):
+        '''Stop the hedging threads'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
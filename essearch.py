@@ -4,28 +4,24 @@
 import time
 import os
 
-import boto3
-import botocore
 import requests
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
-from aws_requests_auth.boto_utils import AWSRequestsAuth
 
 
 # import requests
-import aws_requests_auth.aws_auth
 # import AWSRequestsAuth
 
 from elasticsearch import Connection
 from elasticsearch import Elasticsearch
 
-from elasticsearch import RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
 
 # from signer import ESConnection
 from urllib.parse import urlparse
 
 from boto.connection import AWSAuthConnection
 
+from estransport import AWSSignedConnection, AwsCredentials, CredentialCache
+from estransport import SigV4RequestsAuth, shared_credential_cache
+
 
 class ESConnection(AWSAuthConnection):
 
@@ -94,25 +90,30 @@ def test_aws_connection():
 
 class AwsEsClient:
 
-    def __init__(self, region='us-east-1', **kwargs):
-        '''create the Elasticsearch client'''
+    def __init__(self, region='us-east-1', maxsize=10, **kwargs):
+        '''create the Elasticsearch client, signing requests over pooled connections'''
         self.region = kwargs['region'] if 'region' in kwargs else os.environ.get('AWS_REGION')
         if self.region is None:
             self.region = region
 
         # Use host, not endpoint:
         # self.endpoint = kwargs['endpoint'] if 'endpoint' in kwargs else os.environ.get('AWS_ELASTICSEARCH_ENDPOINT')
-        access_key = kwargs['access_key'] if 'access_key' in kwargs else os.environ.get('AWS_ACCESS_KEY_ID')
-        secret_key = kwargs['secret_key'] if 'secret_key' in kwargs else os.environ.get('AWS_SECRET_ACCESS_KEY')
         hostname = kwargs['host'] if 'host' in kwargs else os.environ.get('AWS_ELASTICSEARCH_HOST')
-        aws_auth = AWS4Auth(access_key, secret_key, self.region, 'es')
+        if 'access_key' in kwargs or 'secret_key' in kwargs:
+            credentials = AwsCredentials(kwargs.get('access_key'), kwargs.get('secret_key'),
+                                         kwargs.get('session_token'))
+            credential_cache = CredentialCache(lambda: (credentials, None))
+        else:
+            credential_cache = shared_credential_cache(use_boto=False)
 
         self.es_client = Elasticsearch(
             hosts=[{'host': hostname, 'port': 443}],
-            http_auth=aws_auth,
+            region=self.region,
+            credentials=credential_cache,
+            maxsize=maxsize,
             use_ssl=True,
             verify_certs=True,
-            connection_class=RequestsHttpConnection
+            connection_class=AWSSignedConnection
         )
 
     def get_client(self):
@@ -121,13 +122,8 @@ class AwsEsClient:
 def boto_aws_es(use_boto=False):
     # let's talk to our AWS Elasticsearch cluster
     hostname = os.environ.get('AWS_ELASTICSEARCH_HOST')
-    if use_boto:
-        auth = BotoAWSRequestsAuth(aws_host=hostname, aws_region='us-east-1', aws_service='es')
-    else:
-        access_key = os.environ.get('AWS_ACCESS_KEY_ID')
-        secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-        print("AWSRequestsAuth access_key: ", access_key, "  secret_key: ", secret_key)
-        auth = AWSRequestsAuth(aws_access_key=access_key, aws_secret_access_key=secret_key, aws_host=hostname, aws_region='us-east-1', aws_service='es')
+    es_endpoint = 'https://%s/' % hostname
+    auth = SigV4RequestsAuth('us-east-1', shared_credential_cache(use_boto))
 
     print("AUTH: ", auth, "\n")
     response = requests.get(es_endpoint, auth=auth)
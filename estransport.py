@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+'''Pooled, AWS SigV4-signed transport for Elasticsearch clients'''
+
+from collections import namedtuple
+import datetime
+import gzip
+import hashlib
+import hmac
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, quote, urlsplit
+
+import boto3
+from requests.auth import AuthBase
+from elasticsearch import Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.exceptions import ConnectionTimeout, SSLError
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.exceptions import SSLError as UrllibSSLError
+from urllib3.util.retry import Retry
+
+from eslatency import current_call
+
+
+AwsCredentials = namedtuple('AwsCredentials', 'access_key secret_key token')
+
+CREDENTIALS_REFRESH_MARGIN = 300
+CREDENTIALS_RETRY_INTERVAL = 30
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 3
+
+def boto_credentials_provider():
+    '''
+    Resolve credentials through boto's provider chain (files, ENV, instance roles, STS).
+    Returns (AwsCredentials, expiry) with expiry in epoch seconds, or None if they never expire.
+    '''
+    boto_credentials = boto3.Session().get_credentials()
+    if boto_credentials is None:
+        raise ValueError("No AWS credentials in ~/.aws/credentials ?")
+    frozen = boto_credentials.get_frozen_credentials()
+    expiry_time = getattr(boto_credentials, '_expiry_time', None)
+    expiry = expiry_time.timestamp() if expiry_time else None
+    return AwsCredentials(frozen.access_key, frozen.secret_key, frozen.token), expiry
+
+def env_credentials_provider():
+    '''Read credentials exported to ENV.  Returns (AwsCredentials, None)'''
+    return AwsCredentials(os.environ.get('AWS_ACCESS_KEY_ID'),
+                          os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                          os.environ.get('AWS_SESSION_TOKEN')), None
+
+
+class CredentialCache:
+    '''
+    Holds the current AWS credentials and the SigV4 signers (with their signing keys)
+    derived from them.  Credentials that expire are refreshed refresh_margin seconds
+    ahead of expiry on a background thread, so current() never blocks on resolution.
+    The provider is any function returning (AwsCredentials, expiry_epoch_seconds_or_None).
+    '''
+
+    def __init__(self, provider, refresh_margin=CREDENTIALS_REFRESH_MARGIN,
+                 retry_interval=CREDENTIALS_RETRY_INTERVAL):
+        self.provider = provider
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.credentials, self.expiry = AwsCredentials(None, None, None), None
+        self.refreshes = 0
+        self.failures = 0
+        self.signers = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.refresh()
+
+    def current(self):
+        '''Get the current credentials without blocking'''
+        return self.credentials
+
+    def signer(self, region, service='es'):
+        '''Get the shared signer for region and service'''
+        with self.lock:
+            if (region, service) not in self.signers:
+                self.signers[(region, service)] = SigV4Signer(region, service)
+            return self.signers[(region, service)]
+
+    def refresh(self):
+        '''
+        Fetch credentials from the provider now.  Returns True on success.
+        Starts the background refresher the first time the credentials have an expiry.
+        '''
+        try:
+            credentials, expiry = self.provider()
+        except Exception as ex:
+            self.failures += 1
+            print("CredentialCache.refresh: credentials provider failed:", ex)
+            return False
+        self.credentials, self.expiry = credentials, expiry
+        self.refreshes += 1
+        if expiry is not None:
+            with self.lock:
+                if self.thread is None and not self.stopped:
+                    self.thread = threading.Thread(target=self._refresh_loop, daemon=True)
+                    self.thread.start()
+        return True
+
+    def seconds_until_refresh(self):
+        '''Seconds until credentials are due for refresh, or None if they never expire'''
+        if self.expiry is None:
+            return None
+        return max(self.expiry - self.refresh_margin - time.time(), 0.0)
+
+    def _refresh_loop(self):
+        '''Background thread: refresh ahead of each expiry, retrying failures'''
+        while not self.stopped:
+            delay = self.seconds_until_refresh()
+            if delay is None:
+                return
+            if self.wakeup.wait(delay):
+                self.wakeup.clear()
+                continue
+            if not self.refresh() or self.seconds_until_refresh() == 0.0:
+                # Failed, or the provider returned credentials already due for refresh
+                self.wakeup.wait(self.retry_interval)
+
+    def stop(self):
+        '''Stop the background refresher'''
+        self.stopped = True
+        self.wakeup.set()
+
+
+_SHARED_CACHES = {}
+_SHARED_CACHES_LOCK = threading.Lock()
+
+def shared_credential_cache(use_boto=True):
+    '''
+    Get the process-wide CredentialCache for credentials read through boto (use_boto)
+    or from ENV variables, creating it on first use.
+    '''
+    with _SHARED_CACHES_LOCK:
+        if use_boto not in _SHARED_CACHES:
+            provider = boto_credentials_provider if use_boto else env_credentials_provider
+            _SHARED_CACHES[use_boto] = CredentialCache(provider)
+        return _SHARED_CACHES[use_boto]
+
+
+def _hmac_sha256(key, msg):
+    '''HMAC-SHA256 digest of a str message'''
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+def _quote(string):
+    '''URI-encode a string as required by SigV4 canonical requests'''
+    return quote(string, safe='-_.~')
+
+def canonical_query(params):
+    '''Encode request params as the sorted query string SigV4 signs (and that is sent)'''
+    return '&'.join('%s=%s' % (_quote(str(key)), _quote(str(val)))
+                    for key, val in sorted((params or {}).items()))
+
+
+class SigV4Signer:
+    '''
+    Thread-safe AWS Signature Version 4 signer.  The derived signing key depends only on
+    the secret key, date, region, and service, so it is computed once and reused until
+    the date changes or the credentials rotate.
+    '''
+
+    def __init__(self, region, service='es'):
+        self.region = region
+        self.service = service
+        self.key_id = None
+        self.signing_key = None
+        self.lock = threading.Lock()
+
+    def get_signing_key(self, secret_key, datestamp):
+        '''Get the derived signing key for the credentials' secret and the date'''
+        key_id = (secret_key, datestamp)
+        with self.lock:
+            if key_id != self.key_id:
+                key = _hmac_sha256(('AWS4' + secret_key).encode('utf-8'), datestamp)
+                for part in (self.region, self.service, 'aws4_request'):
+                    key = _hmac_sha256(key, part)
+                self.key_id, self.signing_key = key_id, key
+            return self.signing_key
+
+    def sign(self, credentials, method, host, path, query, body, now=None):
+        '''
+        Get the headers (Authorization, x-amz-date, and maybe x-amz-security-token)
+        that sign one request.  The query must already be in canonical form.
+        '''
+        if now is None:
+            now = datetime.datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        datestamp = amz_date[:8]
+        headers = {'host' : host, 'x-amz-date' : amz_date}
+        if credentials.token:
+            headers['x-amz-security-token'] = credentials.token
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method,
+            quote(path, safe='/~'),
+            query,
+            ''.join('%s:%s\n' % (name, headers[name]) for name in sorted(headers)),
+            signed_headers,
+            hashlib.sha256(body or b'').hexdigest(),
+        ])
+        scope = '%s/%s/%s/aws4_request' % (datestamp, self.region, self.service)
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+        signing_key = self.get_signing_key(credentials.secret_key, datestamp)
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        del headers['host']
+        headers['authorization'] = ('AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s'
+                                    % (credentials.access_key, scope, signed_headers, signature))
+        return headers
+
+
+class AWSSignedConnection(Urllib3HttpConnection):
+    '''
+    Elasticsearch connection that signs each request with AWS SigV4 and sends it over
+    a thread-safe pool of up to maxsize persistent HTTP(S) connections.
+    Pass it as connection_class to Elasticsearch, along with region and credentials,
+    a CredentialCache (by default the shared one for boto credentials).
+    With http_compress, responses are requested gzipped, and request bodies of at least
+    compress_min_bytes are gzipped (at compress_level) before they are signed, since
+    SigV4 signs the payload as sent.
+    '''
+
+    def __init__(self, host='localhost', port=None, region='us-east-1', credentials=None,
+                 service='es', maxsize=10, compress_min_bytes=COMPRESS_MIN_BYTES,
+                 compress_level=COMPRESS_LEVEL, **kwargs):
+        super(AWSSignedConnection, self).__init__(host=host, port=port, maxsize=maxsize, **kwargs)
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        if credentials is None:
+            credentials = shared_credential_cache()
+        self.credentials = credentials
+        self.signer = credentials.signer(region, service)
+        self.host_header = host if port in (None, 80, 443) else '%s:%s' % (host, port)
+        self.stats_lock = threading.Lock()
+        self.num_requests = 0
+        self.in_use = 0
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(),
+                        headers=None):
+        '''Sign and send one request on a pooled connection'''
+        path = self.url_prefix + url
+        query = canonical_query(params)
+        url = '%s?%s' % (path, query) if query else path
+        full_url = self.host + url
+        compressed = self.http_compress and body and len(body) >= self.compress_min_bytes
+        if compressed:
+            body = gzip.compress(body, self.compress_level, mtime=0)
+
+        call = current_call()
+        if call is not None:
+            call.sending(body)
+        start = time.time()
+        with self.stats_lock:
+            self.num_requests += 1
+            self.in_use += 1
+        try:
+            kwargs = {'timeout' : timeout} if timeout else {}
+            request_headers = self.headers.copy()
+            request_headers.update(headers or ())
+            if compressed:
+                request_headers['content-encoding'] = 'gzip'
+            sign_start = time.perf_counter()
+            request_headers.update(self.signer.sign(self.credentials.current(), method, self.host_header,
+                                                    path, query, body))
+            send_start = time.perf_counter()
+            if call is not None:
+                call.add('sign', send_start - sign_start)
+            response = self.pool.urlopen(method, url, body, retries=Retry(False),
+                                         headers=request_headers, **kwargs)
+            duration = time.time() - start
+            if call is not None:
+                call.received(response.data, send_start, response.headers.get('content-length'))
+            raw_data = response.data.decode('utf-8', 'surrogatepass')
+        except Exception as ex:
+            self.log_request_fail(method, full_url, url, body, time.time() - start, exception=ex)
+            if isinstance(ex, UrllibSSLError):
+                raise SSLError('N/A', str(ex), ex)
+            if isinstance(ex, ReadTimeoutError):
+                raise ConnectionTimeout('TIMEOUT', str(ex), ex)
+            raise ESConnectionError('N/A', str(ex), ex)
+        finally:
+            with self.stats_lock:
+                self.in_use -= 1
+
+        if not 200 <= response.status < 300 and response.status not in ignore:
+            self.log_request_fail(method, full_url, url, body, duration, response.status, raw_data)
+            self._raise_error(response.status, raw_data)
+
+        self.log_request_success(method, full_url, url, body, response.status, raw_data, duration)
+        return response.status, response.headers, raw_data
+
+    def pool_stats(self):
+        '''
+        Get connection reuse statistics: requests served by an already open connection
+        (hits), requests that had to open a new one (misses), and open connections.
+        '''
+        with self.stats_lock:
+            num_requests, in_use = self.num_requests, self.in_use
+        misses = self.pool.num_connections
+        idle = sum(1 for conn in list(self.pool.pool.queue) if conn is not None) if self.pool.pool else 0
+        return {
+            'hits' : max(num_requests - misses, 0),
+            'misses' : misses,
+            'open_connections' : idle + in_use,
+            'maxsize' : self.pool.pool.maxsize if self.pool.pool else 0,
+        }
+
+
+class SigV4RequestsAuth(AuthBase):
+    '''requests auth that signs with AWS SigV4 using a CredentialCache'''
+
+    def __init__(self, region, credentials=None, service='es'):
+        if credentials is None:
+            credentials = shared_credential_cache()
+        self.credentials = credentials
+        self.signer = credentials.signer(region, service)
+
+    def __call__(self, request):
+        url = urlsplit(request.url)
+        query = '&'.join('%s=%s' % (_quote(key), _quote(val))
+                         for key, val in sorted(parse_qsl(url.query, keep_blank_values=True)))
+        body = request.body.encode('utf-8') if isinstance(request.body, str) else request.body
+        request.headers.update(self.signer.sign(self.credentials.current(), request.method,
+                                                url.netloc, url.path or '/', query, body))
+        return request
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 '''pyton translation of es_analyze.sh'''
 
+from collections import OrderedDict
 import json
 import pprint
+import threading
 import urllib
 
 import requests
@@ -14,9 +16,7 @@ PRETTY = "true"
 
 def json_text_bytes(text_to_analyze=DEFAULT_TEXT, encoding='utf-8'):
     '''no comma after the text'''
-    json_str = "{ \"text\": \"%s\" }" % text_to_analyze
-    json_byt = bytes(json_str, encoding=encoding)
-    return json_byt
+    return bytes(json.dumps({"text": text_to_analyze}), encoding=encoding)
 
 
 # NOTES: filters are applied in the order listed, so stemming exceptions (keywords)
@@ -25,23 +25,22 @@ def json_text_bytes(text_to_analyze=DEFAULT_TEXT, encoding='utf-8'):
 # NOTE: https://github.com/elastic/elasticsearch/issues/23943 explains why the following
 # line specifying an anonymous synonym filter is not yet supported:
 #                    {"type": "synonym", "synonyms" : ["ye, hte => the", "angry, furious, mad"]},
-def json_data_bytes(text=DEFAULT_TEXT, tokenizer="standard", explain=False, encoding='utf-8'):
-    '''data payload as JSON string'''
-    explain = "true" if explain else "false"
-    json_str = '''{
-        "tokenizer": "%s",
-        "filter": [ "lowercase", "asciifolding",
-                    {"type": "keyword_marker", "keywords": ["sleeping"]},
-                    {"type": "stemmer_override", "rules": [ "mice=>mouse", "were=>was"]},
-                    {"type": "stop", "stopwords": ["a", "is", "the", "was"]},
-                    "porter_stem"
+def chain_spec(tokenizer="standard"):
+    '''the analysis chain (tokenizer and filters) as a dict, shared with et_analyzer.py'''
+    return {
+        "tokenizer": tokenizer,
+        "filter": ["lowercase", "asciifolding",
+                   {"type": "keyword_marker", "keywords": ["sleeping"]},
+                   {"type": "stemmer_override", "rules": ["mice=>mouse", "were=>was"]},
+                   {"type": "stop", "stopwords": ["a", "is", "the", "was"]},
+                   "porter_stem"
                   ],
-        "text": "%s",
-        "explain": "%s"
     }
-    ''' % (tokenizer, text, explain)
-    json_byt = bytes(json_str, encoding=encoding)
-    return json_byt
+
+def json_data_bytes(text=DEFAULT_TEXT, tokenizer="standard", explain=False, encoding='utf-8'):
+    '''data payload as JSON string'''
+    payload = dict(chain_spec(tokenizer), text=text, explain=explain)
+    return bytes(json.dumps(payload), encoding=encoding)
 
 # # NOTE: if res_bye.decode('utf-8') fails below, the data may be compressed:
 #     response = opener.open(self.__url, data)
@@ -75,15 +74,136 @@ def requests_get_es(url_fmt=r"http://localhost:9200/_analyze?analyzer=english&te
     return got.json()
 
 
-def requests_post_es(payload=None, url=ANALYZER_URL, headers=None, verbose=0):
-    '''post analysis request to Elasticsearch and return JSON results as a dict'''
+def requests_post_es(payload=None, url=ANALYZER_URL, headers=None, verbose=0, session=None):
+    '''post analysis request to Elasticsearch (through session if given) and return JSON results as a dict'''
     headers = HEADERS if headers is None else headers
     payload = payload if payload else json_data_bytes()
-    results = requests.post(url=url, headers=headers, data=payload)
+    results = (session or requests).post(url=url, headers=headers, data=payload)
     if verbose:
         print("requests_post_es got results of type(%s): (%s)" % (type(results).__name__, results))
     return results.json()
 
+
+def utf16_len(text):
+    '''length of text in UTF-16 code units, as Elasticsearch (Java) counts offsets'''
+    return len(text.encode('utf-16-le')) // 2
+
+def split_array_tokens(texts, tokens):
+    '''
+    split the tokens _analyze returns for an array text payload into one list of token
+    strings per text.  Offsets run on across the texts, each starting one past the end
+    of the previous one, so start_offset tells which text a token came from.
+    '''
+    results = [[] for _ in texts]
+    ends, end = [], -1
+    for text in texts:
+        end += utf16_len(text) + 1
+        ends.append(end)
+    idx = 0
+    for token in tokens:
+        while idx < len(ends) - 1 and token['start_offset'] >= ends[idx]:
+            idx += 1
+        results[idx].append(token['token'])
+    return results
+
+
+ANALYZE_BATCH_SIZE = 100
+ANALYZE_BATCH_BYTES = 512 * 1024
+ANALYZE_CACHE_SIZE = 100000
+
+class BatchAnalyzeClient:
+    '''
+    Analyzes many texts with the cluster's _analyze, sending them in batches as array
+    text payloads over one persistent session, and memoizing the tokens for each
+    (chain spec, text) in an LRU cache of up to cache_size entries.
+    '''
+
+    def __init__(self, url=ANALYZER_URL, spec=None, batch_size=ANALYZE_BATCH_SIZE,
+                 batch_bytes=ANALYZE_BATCH_BYTES, cache_size=ANALYZE_CACHE_SIZE, session=None):
+        self.url = url
+        self.spec = chain_spec() if spec is None else spec
+        self.spec_key = json.dumps(self.spec, sort_keys=True)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.cache_size = cache_size
+        self.session = session if session else requests.Session()
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+    def close(self):
+        '''close the session and its pooled connections'''
+        self.session.close()
+
+    def cached(self, text):
+        '''get the memoized tokens for text, or None'''
+        key = (self.spec_key, text)
+        with self.lock:
+            tokens = self.cache.get(key)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return tokens
+
+    def memoize(self, text, tokens):
+        '''save the tokens for text, evicting the least recently used if full'''
+        with self.lock:
+            self.cache[(self.spec_key, text)] = tokens
+            self.cache.move_to_end((self.spec_key, text))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def batches(self, texts):
+        '''yield lists of texts, each within batch_size texts and about batch_bytes'''
+        batch, size = [], 0
+        for text in texts:
+            text_bytes = len(text.encode('utf-8'))
+            if batch and (len(batch) >= self.batch_size or size + text_bytes > self.batch_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(text)
+            size += text_bytes
+        if batch:
+            yield batch
+
+    def analyze_batch(self, texts):
+        '''analyze a batch of texts with one request, returning a list of token lists'''
+        payload = bytes(json.dumps(dict(self.spec, text=texts)), encoding='utf-8')
+        results = requests_post_es(payload=payload, url=self.url, session=self.session)
+        self.requests += 1
+        if 'tokens' not in results:
+            raise ValueError("_analyze failed: %s" % results.get('error', results))
+        return split_array_tokens(texts, results['tokens'])
+
+    def analyze_many(self, texts):
+        '''get the list of tokens for each text, analyzing only distinct uncached texts'''
+        texts = list(texts)
+        found = {}
+        for text in texts:
+            if text not in found:
+                found[text] = self.cached(text)
+        missing = [text for text, tokens in found.items() if tokens is None]
+        for batch in self.batches(missing):
+            for text, tokens in zip(batch, self.analyze_batch(batch)):
+                self.memoize(text, tokens)
+                found[text] = tokens
+        return [found[text] for text in texts]
+
+    def analyze(self, text):
+        '''get the list of tokens for one text'''
+        return self.analyze_many([text])[0]
+
+    def stats(self):
+        '''get cache and request counters'''
+        with self.lock:
+            return {'entries' : len(self.cache), 'hits' : self.hits, 'misses' : self.misses,
+                    'requests' : self.requests}
+
+
 def main(verbose=1):
     '''test driver'''
     open_res = urllib_request_urlopen_es(verbose=verbose)
@@ -98,6 +218,11 @@ def main(verbose=1):
     print("requests_post_es results:")
     pprint.pprint(post_res, compact=False)
     print()
+    batch_client = BatchAnalyzeClient()
+    texts = [DEFAULT_TEXT, 'She said "Ye Olde" twice', DEFAULT_TEXT]
+    print("BatchAnalyzeClient.analyze_many results:")
+    pprint.pprint(batch_client.analyze_many(texts), compact=False)
+    print(batch_client.stats())
 
 if __name__ == '__main__':
     main()
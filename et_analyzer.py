@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+'''
+In-process translation of the et_analyze.py (es_analyze.sh) _analyze filter chain:
+the same chain spec (tokenizer and filters) yields the same tokens, without HTTP.
+'''
+
+import argparse
+from functools import lru_cache
+import json
+import re
+import time
+import unicodedata
+
+import et_analyze
+
+
+###############################################################################
+# Porter stemmer, as in Lucene's PorterStemmer (a port of Martin Porter's C version,
+# including its departures for -bli and -logi).  Words of 1 or 2 letters are unchanged.
+
+def _cons(word, i):
+    '''True if word[i] is a consonant'''
+    char = word[i]
+    if char in 'aeiou':
+        return False
+    if char == 'y':
+        return i == 0 or not _cons(word, i - 1)
+    return True
+
+def _measure(word, j):
+    '''The number of VC sequences in word[:j+1]'''
+    count, i = 0, 0
+    while i <= j and _cons(word, i):
+        i += 1
+    while i <= j:
+        while i <= j and not _cons(word, i):
+            i += 1
+        if i > j:
+            break
+        while i <= j and _cons(word, i):
+            i += 1
+        count += 1
+    return count
+
+def _vowel_in_stem(word, j):
+    '''True if word[:j+1] contains a vowel'''
+    return any(not _cons(word, i) for i in range(j + 1))
+
+def _double_cons(word, j):
+    '''True if word[j-1:j+1] is a double consonant'''
+    return j >= 1 and word[j] == word[j - 1] and _cons(word, j)
+
+def _cvc(word, i):
+    '''True if word[i-2:i+1] is consonant-vowel-consonant, with the last not w, x, or y'''
+    if i < 2 or not _cons(word, i) or _cons(word, i - 1) or not _cons(word, i - 2):
+        return False
+    return word[i] not in 'wxy'
+
+def _replace_if_measured(word, suffix, replacement, min_measure=0):
+    '''Replace suffix if the stem before it has measure > min_measure.  Returns (word, matched)'''
+    if not word.endswith(suffix):
+        return word, False
+    stem = word[:len(word) - len(suffix)]
+    if _measure(stem, len(stem) - 1) > min_measure:
+        return stem + replacement, True
+    return word, True
+
+_STEP2 = [('ational', 'ate'), ('tional', 'tion'), ('enci', 'ence'), ('anci', 'ance'),
+          ('izer', 'ize'), ('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'),
+          ('ousli', 'ous'), ('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate'),
+          ('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous'),
+          ('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble'), ('logi', 'log')]
+_STEP3 = [('icate', 'ic'), ('ative', ''), ('alize', 'al'), ('iciti', 'ic'), ('ical', 'ic'),
+          ('ful', ''), ('ness', '')]
+_STEP4 = ['al', 'ance', 'ence', 'er', 'ic', 'able', 'ible', 'ant', 'ement', 'ment', 'ent',
+          'ion', 'ou', 'ism', 'ate', 'iti', 'ous', 'ive', 'ize']
+
+def _step2_suffixes(table):
+    '''Group (suffix, replacement) pairs by the penultimate letter, as the C version switches'''
+    groups = {}
+    for suffix, replacement in table:
+        groups.setdefault(suffix[-2], []).append((suffix, replacement))
+    return groups
+
+_STEP2_BY_PENULT = _step2_suffixes(_STEP2)
+_STEP4_BY_PENULT = {}
+for _suffix in _STEP4:
+    _STEP4_BY_PENULT.setdefault(_suffix[-2], []).append(_suffix)
+
+def porter_stem(word):
+    '''Stem one lowercase word with the Porter algorithm'''
+    if len(word) <= 2:
+        return word
+    # Step 1ab: plurals and -ed or -ing
+    if word.endswith('s'):
+        if word.endswith('sses'):
+            word = word[:-2]
+        elif word.endswith('ies'):
+            word = word[:-2]
+        elif word[-2] != 's':
+            word = word[:-1]
+    if word.endswith('eed'):
+        if _measure(word, len(word) - 4) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ('ed', 'ing'):
+            stem = word[:len(word) - len(suffix)]
+            if word.endswith(suffix) and _vowel_in_stem(stem, len(stem) - 1):
+                word = stem
+                if word.endswith(('at', 'bl', 'iz')):
+                    word += 'e'
+                elif _double_cons(word, len(word) - 1):
+                    if word[-1] not in 'lsz':
+                        word = word[:-1]
+                elif _measure(word, len(word) - 1) == 1 and _cvc(word, len(word) - 1):
+                    word += 'e'
+                break
+    if len(word) <= 1:
+        return word
+    # Step 1c: y -> i if there is another vowel in the stem
+    if word.endswith('y') and _vowel_in_stem(word, len(word) - 2):
+        word = word[:-1] + 'i'
+    # Step 2: double suffixes -> single ones
+    for suffix, replacement in _STEP2_BY_PENULT.get(word[-2], ()):
+        word, matched = _replace_if_measured(word, suffix, replacement)
+        if matched:
+            break
+    # Step 3: -ic-, -full, -ness, etc.
+    for suffix, replacement in _STEP3:
+        if suffix[-1] == word[-1]:
+            word, matched = _replace_if_measured(word, suffix, replacement)
+            if matched:
+                break
+    # Step 4: -ant, -ence, etc. in context <c>vcvc<v>
+    for suffix in _STEP4_BY_PENULT.get(word[-2], ()):
+        if word.endswith(suffix):
+            stem = word[:len(word) - len(suffix)]
+            if suffix == 'ion' and not stem.endswith(('s', 't')):
+                continue
+            if _measure(stem, len(stem) - 1) > 1:
+                word = stem
+            break
+    # Step 5: remove a final -e, and -ll -> -l, if m() > 1
+    if word.endswith('e'):
+        measure = _measure(word, len(word) - 1)
+        if measure > 1 or measure == 1 and not _cvc(word, len(word) - 2):
+            word = word[:-1]
+    if word.endswith('ll') and _measure(word, len(word) - 1) > 1:
+        word = word[:-1]
+    return word
+
+
+###############################################################################
+# Tokenizers: each maps text to a list of token strings.
+
+_IDEOGRAPHIC = '぀-ゟ㐀-䶿一-鿿豈-﫿'
+_WORD = r'[^\W%s]' % _IDEOGRAPHIC
+_LETTER = r'[^\W\d_%s]' % _IDEOGRAPHIC
+# Approximates Unicode word segmentation (UAX #29), as used by the standard tokenizer:
+# ideographs are single tokens, and letters (or digits) joined by mid-word punctuation stay together.
+_STANDARD_TOKEN = re.compile(
+    r"[{ideo}]|{word}+(?:(?:(?<={letter})[.'’:·](?={letter})|(?<=\d)[.,;'’](?=\d)){word}+)*"
+    .format(ideo=_IDEOGRAPHIC, word=_WORD, letter=_LETTER))
+STANDARD_MAX_TOKEN_LENGTH = 255
+
+def standard_tokenizer(text):
+    '''Split text into words, as ES's standard tokenizer does (approximately)'''
+    tokens = []
+    for token in _STANDARD_TOKEN.findall(text):
+        while len(token) > STANDARD_MAX_TOKEN_LENGTH:
+            tokens.append(token[:STANDARD_MAX_TOKEN_LENGTH])
+            token = token[STANDARD_MAX_TOKEN_LENGTH:]
+        tokens.append(token)
+    return tokens
+
+TOKENIZERS = {
+    'standard' : standard_tokenizer,
+    'whitespace' : str.split,
+    'letter' : re.compile(r'[^\W\d_]+').findall,
+    'keyword' : lambda text: [text],
+}
+
+
+###############################################################################
+# Token filters: each is compiled from its spec into a function taking (term, is_keyword)
+# and returning (term, is_keyword), or None to remove the token.
+
+_FOLDINGS = {'ß' : 'ss', 'æ' : 'ae', 'Æ' : 'AE', 'ø' : 'o', 'Ø' : 'O', 'œ' : 'oe', 'Œ' : 'OE',
+             'đ' : 'd', 'Đ' : 'D', 'ł' : 'l', 'Ł' : 'L', 'þ' : 'th', 'Þ' : 'TH', 'ð' : 'd',
+             'Ð' : 'D', 'ı' : 'i', '’' : "'", '‘' : "'"}
+
+@lru_cache(maxsize=4096)
+def ascii_fold(term):
+    '''Fold accented and other non-ASCII characters to their ASCII equivalents, if any'''
+    if term.isascii():
+        return term
+    folded = []
+    for char in term:
+        if char.isascii():
+            folded.append(char)
+        elif char in _FOLDINGS:
+            folded.append(_FOLDINGS[char])
+        else:
+            decomposed = ''.join(part for part in unicodedata.normalize('NFKD', char)
+                                 if not unicodedata.combining(part))
+            folded.append(decomposed if decomposed.isascii() and decomposed else char)
+    return ''.join(folded)
+
+ENGLISH_STOPWORDS = ['a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+                     'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the',
+                     'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will', 'with']
+
+def _word_set(words, ignore_case):
+    '''Set of words, lowercased if ignore_case'''
+    if words == '_english_':
+        words = ENGLISH_STOPWORDS
+    return frozenset(word.lower() for word in words) if ignore_case else frozenset(words)
+
+def _keyword_marker(spec):
+    '''Mark listed words as keywords, which stemmers leave alone'''
+    ignore_case = spec.get('ignore_case', False)
+    keywords = _word_set(spec.get('keywords', []), ignore_case)
+    def keyword_marker(term, is_keyword):
+        return term, is_keyword or (term.lower() if ignore_case else term) in keywords
+    return keyword_marker
+
+def _stemmer_override(spec):
+    '''Replace words by the rules "from, ... => to", marking the results as keywords'''
+    overrides = {}
+    for rule in spec.get('rules', []):
+        sources, _, target = rule.partition('=>')
+        for source in sources.split(','):
+            overrides[source.strip()] = target.strip()
+    def stemmer_override(term, is_keyword):
+        if not is_keyword and term in overrides:
+            return overrides[term], True
+        return term, is_keyword
+    return stemmer_override
+
+def _stop(spec):
+    '''Remove stop words (leaving a gap in positions)'''
+    ignore_case = spec.get('ignore_case', False)
+    stopwords = _word_set(spec.get('stopwords', '_english_'), ignore_case)
+    def stop(term, is_keyword):
+        return None if (term.lower() if ignore_case else term) in stopwords else (term, is_keyword)
+    return stop
+
+def _simple_filter(func, skip_keywords=False):
+    '''Make a filter compiler for a filter that just maps each term'''
+    def compile_filter(_spec):
+        def term_filter(term, is_keyword):
+            return term if skip_keywords and is_keyword else func(term), is_keyword
+        return term_filter
+    return compile_filter
+
+FILTERS = {
+    'lowercase' : _simple_filter(str.lower),
+    'uppercase' : _simple_filter(str.upper),
+    'asciifolding' : _simple_filter(ascii_fold),
+    'porter_stem' : _simple_filter(porter_stem, skip_keywords=True),
+    'keyword_marker' : _keyword_marker,
+    'stemmer_override' : _stemmer_override,
+    'stop' : _stop,
+}
+
+
+###############################################################################
+# Compiled chains
+
+TOKEN_CACHE_SIZE = 65536
+
+class AnalyzerChain:
+    '''
+    A compiled tokenizer and filter chain.  Filters act on one token at a time, so the
+    result for each distinct token is computed once and memoized.
+    '''
+
+    def __init__(self, spec):
+        tokenizer = spec.get('tokenizer', 'standard')
+        if tokenizer not in TOKENIZERS:
+            raise ValueError("Unsupported tokenizer: %s" % tokenizer)
+        self.tokenizer = TOKENIZERS[tokenizer]
+        self.filters = []
+        for filter_spec in spec.get('filter', []):
+            if isinstance(filter_spec, str):
+                filter_spec = {'type' : filter_spec}
+            if filter_spec.get('type') not in FILTERS:
+                raise ValueError("Unsupported filter: %s" % filter_spec)
+            self.filters.append(FILTERS[filter_spec['type']](filter_spec))
+        self.filter_token = lru_cache(maxsize=TOKEN_CACHE_SIZE)(self._filter_token)
+
+    def _filter_token(self, term):
+        '''Run one token through the filters, returning None if it is removed'''
+        token = (term, False)
+        for token_filter in self.filters:
+            token = token_filter(*token)
+            if token is None:
+                return None
+        return token[0]
+
+    def analyze_positions(self, text):
+        '''Get (token, position) pairs; removed tokens leave gaps in positions'''
+        results = []
+        for position, term in enumerate(self.tokenizer(text)):
+            token = self.filter_token(term)
+            if token is not None:
+                results.append((token, position))
+        return results
+
+    def analyze(self, text):
+        '''Get the list of tokens for text'''
+        return [token for token, _ in self.analyze_positions(text)]
+
+
+def chain_key(spec):
+    '''Canonical string for a chain spec (ignoring any text in it)'''
+    return json.dumps({key : val for key, val in spec.items() if key not in ('text', 'explain')},
+                      sort_keys=True)
+
+@lru_cache(maxsize=64)
+def _compile_chain(key):
+    '''Compile the chain for a canonical spec string'''
+    return AnalyzerChain(json.loads(key))
+
+def compile_chain(spec=None):
+    '''Get the compiled (and cached) chain for a spec; by default et_analyze's chain'''
+    return _compile_chain(chain_key(et_analyze.chain_spec() if spec is None else spec))
+
+def analyze(text, spec=None):
+    '''Get the tokens for text from a chain spec, as ES's _analyze would, but in-process'''
+    return compile_chain(spec).analyze(text)
+
+
+###############################################################################
+# Verification against a cluster
+
+def cluster_positions(text, spec=None, url=et_analyze.ANALYZER_URL):
+    '''Get (token, position) pairs for text from the cluster's _analyze'''
+    spec = et_analyze.chain_spec() if spec is None else spec
+    results = et_analyze.requests_post_es(payload=json.dumps(dict(spec, text=text)).encode('utf-8'),
+                                          url=url)
+    return [(token['token'], token['position']) for token in results['tokens']]
+
+def verify(texts, spec=None, url=et_analyze.ANALYZER_URL, verbose=1):
+    '''
+    Diff the local analyzer against the cluster's _analyze for each text.
+    Prints each mismatch and returns the number of mismatched texts.
+    '''
+    chain = compile_chain(spec)
+    mismatches = 0
+    for text in texts:
+        local = chain.analyze_positions(text)
+        remote = cluster_positions(text, spec, url)
+        if local != remote:
+            mismatches += 1
+            if verbose > 0:
+                print("MISMATCH for: %s\n    local:   %s\n    cluster: %s" % (text, local, remote))
+    return mismatches
+
+def time_per_call(func, text, repeat):
+    '''Mean seconds per call of func(text)'''
+    beg_time = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return (time.perf_counter() - beg_time) / repeat
+
+def main():
+    '''Analyze texts locally, optionally verifying against and timing the cluster'''
+    parser = argparse.ArgumentParser(description="In-process version of the et_analyze.py chain")
+    parser.add_argument('texts', type=str, nargs='*', default=[et_analyze.DEFAULT_TEXT],
+                        help='texts to analyze')
+    parser.add_argument('-file', type=str, help='file of texts, one per line')
+    parser.add_argument('-url', type=str, default=et_analyze.ANALYZER_URL, help='_analyze URL')
+    parser.add_argument('-verify', action='store_true', help='Diff the local tokens against the cluster')
+    parser.add_argument('-repeat', type=int, default=1000, help='Repetitions for timing')
+    args = parser.parse_args()
+    texts = args.texts
+    if args.file:
+        with open(args.file, encoding='utf-8') as text_file:
+            texts = [line.rstrip('\n') for line in text_file if line.strip()]
+
+    for text in texts[:10]:
+        print("%s\n    %s" % (text, analyze(text)))
+    local_secs = time_per_call(analyze, texts[0], args.repeat)
+    print("Local: %.1f microseconds per text" % (1e6 * local_secs))
+    if args.verify:
+        mismatches = verify(texts, url=args.url)
+        print("%d of %d texts mismatched" % (mismatches, len(texts)))
+        remote_secs = time_per_call(lambda text: cluster_positions(text, url=args.url), texts[0],
+                                    min(args.repeat, 20))
+        print("Cluster: %.1f microseconds per text" % (1e6 * remote_secs))
+
+if __name__ == '__main__':
+    main()
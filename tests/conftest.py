@@ -0,0 +1,17 @@
+'''Shared fixtures: the modules live at the top of the repository'''
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from esbench import FakeElasticsearch  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    '''A local Elasticsearch stand-in with a small latency'''
+    with FakeElasticsearch(latency=0.001, num_hits=10, scroll_hits=250) as fake:
+        yield fake
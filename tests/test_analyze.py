@@ -0,0 +1,82 @@
+'''BatchAnalyzeClient of et_analyze.py, against a stub session'''
+import json
+import re
+
+import pytest
+
+from et_analyze import BatchAnalyzeClient, split_array_tokens, utf16_len
+
+
+class StubSession:
+    '''
+    Answers _analyze posts with a whitespace tokenizer, numbering offsets and positions
+    across an array text the way Elasticsearch does, and records each payload posted.
+    '''
+
+    def __init__(self):
+        self.payloads = []
+
+    def post(self, url, headers, data):
+        payload = json.loads(data)
+        self.payloads.append(payload)
+        texts = payload['text'] if isinstance(payload['text'], list) else [payload['text']]
+        tokens, offset, position = [], 0, 0
+        for text in texts:
+            for match in re.finditer(r'\S+', text):
+                tokens.append({'token' : match.group().lower(), 'position' : position,
+                               'start_offset' : offset + utf16_len(text[:match.start()]),
+                               'end_offset' : offset + utf16_len(text[:match.end()])})
+                position += 1
+            offset += utf16_len(text) + 1
+            position += 100
+        return StubResponse({'tokens' : tokens})
+
+    def close(self):
+        pass
+
+
+class StubResponse:
+    '''A response whose json() is canned'''
+
+    def __init__(self, results):
+        self.results = results
+
+    def json(self):
+        return self.results
+
+
+def test_split_array_tokens_by_offset():
+    texts = ['One two', '', 'three', '\U0001f600 four five']
+    tokens = StubSession().post(None, None, json.dumps({'text' : texts})).json()['tokens']
+    assert split_array_tokens(texts, tokens) == [
+        ['one', 'two'], [], ['three'], ['\U0001f600', 'four', 'five']]
+
+def test_split_array_tokens_of_texts_without_tokens():
+    assert split_array_tokens(['', ' ', ''], []) == [[], [], []]
+
+def test_analyze_many_batches_distinct_texts():
+    session = StubSession()
+    client = BatchAnalyzeClient(session=session, batch_size=2)
+    texts = ['Alpha beta', '', 'Alpha beta', 'Gamma', 'Delta  epsilon']
+    assert client.analyze_many(texts) == [
+        ['alpha', 'beta'], [], ['alpha', 'beta'], ['gamma'], ['delta', 'epsilon']]
+    assert [payload['text'] for payload in session.payloads] == [
+        ['Alpha beta', ''], ['Gamma', 'Delta  epsilon']]
+    assert session.payloads[0]['filter'] == client.spec['filter']
+    assert client.stats() == {'entries' : 4, 'hits' : 0, 'misses' : 4, 'requests' : 2}
+
+def test_analyze_many_memoizes_in_an_lru_cache():
+    session = StubSession()
+    client = BatchAnalyzeClient(session=session, cache_size=2)
+    client.analyze_many(['one', 'two'])
+    assert client.analyze('one') == ['one']
+    client.analyze('three')
+    assert client.stats() == {'entries' : 2, 'hits' : 1, 'misses' : 3, 'requests' : 2}
+    client.analyze_many(['one', 'two', 'three'])
+    assert [payload['text'] for payload in session.payloads] == [['one', 'two'], ['three'], ['two']]
+
+def test_analyze_batch_raises_on_errors():
+    session = StubSession()
+    session.post = lambda url, headers, data: StubResponse({'error' : 'bad chain'})
+    with pytest.raises(ValueError):
+        BatchAnalyzeClient(session=session).analyze('text')
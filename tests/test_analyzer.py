@@ -0,0 +1,56 @@
+'''The in-process analyzer of et_analyzer.py'''
+import json
+
+import pytest
+
+import et_analyze
+from et_analyzer import analyze, ascii_fold, chain_key, compile_chain, porter_stem
+from et_analyzer import standard_tokenizer, STANDARD_MAX_TOKEN_LENGTH
+
+
+# Examples from Porter's paper, "An algorithm for suffix stripping" (1980)
+@pytest.mark.parametrize('word, stem', [
+    ('caresses', 'caress'), ('ponies', 'poni'), ('ties', 'ti'), ('caress', 'caress'),
+    ('cats', 'cat'), ('feed', 'feed'), ('agreed', 'agre'), ('plastered', 'plaster'),
+    ('motoring', 'motor'), ('sing', 'sing'), ('conflated', 'conflat'), ('troubled', 'troubl'),
+    ('sized', 'size'), ('hopping', 'hop'), ('tanned', 'tan'), ('falling', 'fall'),
+    ('hissing', 'hiss'), ('fizzed', 'fizz'), ('failing', 'fail'), ('filing', 'file'),
+    ('happy', 'happi'), ('sky', 'sky'), ('relational', 'relat'), ('conditional', 'condit'),
+    ('rational', 'ration'), ('valenci', 'valenc'), ('digitizer', 'digit'),
+    ('generalization', 'gener'), ('oscillators', 'oscil'), ('adjustable', 'adjust'),
+])
+def test_porter_stem(word, stem):
+    assert porter_stem(word) == stem
+
+def test_standard_tokenizer_splits_words():
+    assert standard_tokenizer("Don't stop: U.S.A. 3.14 e-mail 東京 café_bar") == [
+        "Don't", 'stop', 'U.S.A', '3.14', 'e', 'mail', '東', '京', 'café_bar']
+
+def test_standard_tokenizer_splits_long_tokens():
+    tokens = standard_tokenizer('x' * (STANDARD_MAX_TOKEN_LENGTH + 10))
+    assert [len(token) for token in tokens] == [STANDARD_MAX_TOKEN_LENGTH, 10]
+
+def test_ascii_fold():
+    assert ascii_fold('Crème Brûlée straße Øre ﬁne') == 'Creme Brulee strasse Ore fine'
+    assert ascii_fold('plain') == 'plain'
+
+def test_stop_removes_english_stopwords_by_default():
+    assert analyze('The ponies and a cat', {'filter' : ['lowercase', 'stop']}) == ['ponies', 'cat']
+
+def test_default_chain_is_et_analyze_chain_spec():
+    assert compile_chain() is compile_chain(et_analyze.chain_spec())
+    payload = json.loads(et_analyze.json_data_bytes('any text'))
+    assert chain_key(payload) == chain_key(et_analyze.chain_spec())
+
+def test_chain_spec_filters_in_order():
+    # lowercase and fold, keep the keyword "sleeping", override then stop "were" (=> "was"),
+    # stem the rest, and leave gaps in positions for removed tokens
+    chain = compile_chain(et_analyze.chain_spec())
+    assert chain.analyze_positions('The mice were sleeping in the Café, relational ponies') == [
+        ('mouse', 1), ('sleeping', 3), ('in', 4), ('cafe', 6), ('relat', 7), ('poni', 8)]
+
+def test_unsupported_chains_are_refused():
+    with pytest.raises(ValueError):
+        compile_chain({'tokenizer' : 'pattern'})
+    with pytest.raises(ValueError):
+        compile_chain({'filter' : ['snowball']})
@@ -0,0 +1,74 @@
+'''AsyncElasticsearchClient against the local stand-in, and its parity with ElasticsearchClient'''
+import asyncio
+
+import pytest
+
+from esasync import AsyncAWSTransport, AsyncElasticsearchClient
+from esaws import CompactResults, most_fields_query
+from esbench import bench_client
+from escodec import get_serializer
+from eslatency import RequestMetrics
+from estransport import AwsCredentials, CredentialCache
+
+
+def async_client(server, **kwargs):
+    '''AsyncElasticsearchClient for the stand-in, as bench_client is for the sync client'''
+    credentials = CredentialCache(lambda: (AwsCredentials('AKIDBENCH', 'bench-secret', None), None))
+    transport = AsyncAWSTransport('127.0.0.1', server.port, credentials=credentials, use_ssl=False,
+                                  serializer=kwargs.pop('serializer', None))
+    return AsyncElasticsearchClient(0, doc_type='kb_document', transport=transport, **kwargs)
+
+def sent_requests(es_client):
+    '''Record the requests es_client sends, as (method, path, params, body) tuples'''
+    sent, perform_request = [], es_client.perform_request
+    def recording(method, path, params=None, body=None, headers=None):
+        sent.append((method, path, params, body))
+        return perform_request(method, path, params, body, headers)
+    es_client.perform_request = recording
+    return sent
+
+def run(coroutine_function, es_client):
+    '''Run coroutine_function(es_client) and close the client'''
+    async def main():
+        async with es_client:
+            return await coroutine_function(es_client)
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize('lean', [False, True])
+def test_searches_match_the_sync_client(server, lean):
+    sync_client = bench_client(server)
+    sync_client.shared = True
+    sync_sent = sent_requests(sync_client)
+    sync_client.search_index('alpha', verbose=0, lean=lean)
+    es_client = async_client(server, shared=True)
+    async_sent = sent_requests(es_client)
+    run(lambda client: client.search_index('alpha', lean=lean), es_client)
+    assert async_sent == sync_sent
+    assert 'filter' in async_sent[0][3]['query']['bool']
+    assert ('stored_fields' in async_sent[0][3]) == lean
+
+def test_lean_search_many_returns_compact_results(server):
+    queries = [most_fields_query(word) for word in ('alpha', 'beta', 'gamma')]
+    es_client = async_client(server, serializer=get_serializer('orjson'))
+    results = run(lambda client: client.search_many(queries, lean=True), es_client)
+    sync_results = bench_client(server, serializer=get_serializer('orjson')).search_many(queries, lean=True)
+    assert len(results) == 3
+    for (compact, max_score, sum_score), (sync_compact, sync_max, sync_sum) in zip(results, sync_results):
+        assert isinstance(compact, CompactResults)
+        assert len(compact) == 10
+        assert list(compact) == list(sync_compact)
+        assert (max_score, sum_score) == (sync_max, sync_sum)
+
+def test_async_calls_are_measured(server):
+    metrics = RequestMetrics()
+    es_client = async_client(server, metrics=metrics)
+    async def searches(client):
+        return await asyncio.gather(*[client.search_index(word) for word in ('alpha', 'beta', 'gamma')])
+    run(searches, es_client)
+    search = metrics.to_dict()['search']
+    assert search['calls'] == 3
+    assert search['bytes_out'] > 0 and search['bytes_in'] > 0
+    assert {'build', 'serialize', 'sign', 'network', 'parse', 'server', 'total'} <= set(search['phases'])
+    for phase in search['phases'].values():
+        assert phase['count'] == 3
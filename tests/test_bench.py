@@ -0,0 +1,41 @@
+'''Benchmark summaries and their comparison with saved results'''
+import json
+import sys
+
+import pytest
+
+from esbench import compare_results, measuring_rss, percentile, reset_peak_rss
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='needs /proc/self/clear_refs')
+def test_rss_growth_is_per_benchmark():
+    if reset_peak_rss() is None:
+        pytest.skip('cannot reset the peak RSS here')
+    with measuring_rss({}) as big:
+        data = bytearray(64 * 1024 * 1024)
+        data[::4096] = b'x' * len(data[::4096])
+        del data
+    with measuring_rss({}) as small:
+        data = bytearray(1024)
+    assert big['rss_growth_mb'] >= 60.0
+    assert small['rss_growth_mb'] < 10.0
+    assert small['peak_rss_mb'] < big['peak_rss_mb']
+
+def summary(name, **metrics):
+    '''A benchmark summary with the compared metrics'''
+    return dict({'name' : name, 'throughput' : 100.0, 'p50_ms' : 1.0, 'p95_ms' : 2.0, 'p99_ms' : 3.0,
+                 'rss_growth_mb' : 1.0}, **metrics)
+
+def test_small_memory_changes_are_not_regressions(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'results' : [summary('a'), summary('b'), summary('c', rss_growth_mb=None)]}))
+    summaries = [summary('a', rss_growth_mb=2.5), summary('b', rss_growth_mb=40.0), summary('c')]
+    assert compare_results(summaries, str(baseline)) == 1
+
+def test_percentile_is_the_nearest_rank():
+    samples = list(range(1, 101))
+    assert [percentile(samples, pct) for pct in range(0, 101)] == [1] + samples
+    assert percentile(samples, 99.9) == 100
+    assert percentile(samples, 0.5) == 1
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([], 50) == 0.0
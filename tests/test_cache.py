@@ -0,0 +1,30 @@
+'''SearchCache invalidation by the writes of ElasticsearchClient'''
+import pytest
+
+from escache import SearchCache
+from esbench import bench_client, synthetic_docs
+
+
+@pytest.mark.parametrize('write', [
+    lambda es_client: es_client.create_index(),
+    lambda es_client: es_client.delete_index(),
+    lambda es_client: es_client.index_all_docs(docs=synthetic_docs(2)),
+])
+def test_writes_invalidate_cached_searches(server, write):
+    es_client = bench_client(server, cache=SearchCache())
+    es_client.search_index('alpha', verbose=0)
+    es_client.search_index('alpha', verbose=0)
+    assert server.requests == 1
+    write(es_client)
+    requests = server.requests
+    es_client.search_index('alpha', verbose=0)
+    assert server.requests == requests + 1
+
+def test_failed_write_still_invalidates(server):
+    es_client = bench_client(server, cache=SearchCache())
+    es_client.search_index('alpha', verbose=0)
+    server.error_status, server.down = 400, True
+    assert not es_client.delete_index()
+    server.down = False
+    es_client.search_index('alpha', verbose=0)
+    assert server.requests == 3
@@ -0,0 +1,182 @@
+'''ElasticsearchClient against the local stand-in'''
+import json
+
+import pytest
+from elasticsearch.exceptions import TransportError
+
+from esaws import search_after_request
+from esbench import bench_client, synthetic_docs
+
+
+def test_search_after_sorts_on_the_entry_id_by_default():
+    _, _, _, body = search_after_request('zot0', 'kb_document', {'query' : {}}, 10)
+    assert body['sort'] == [{'_score' : 'desc'}, {'kb_entry_id' : 'asc'}]
+    _, _, _, body = search_after_request('zot0', 'kb_document', {'query' : {}}, 10, tiebreaker='_id')
+    assert body['sort'][-1] == {'_id' : 'asc'}
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_iter_hits_pages_through_every_hit(server, prefetch):
+    es_client = bench_client(server)
+    hits = list(es_client.iter_hits('alpha', page_size=100, prefetch=prefetch))
+    assert [hit['_id'] for hit in hits] == ['entry-%d' % num for num in range(250)]
+    assert server.requests == 3
+
+def test_iter_hits_stops_at_max_hits(server):
+    es_client = bench_client(server)
+    hits = list(es_client.iter_hits('alpha', page_size=100, max_hits=150))
+    assert len(hits) == 150
+    assert server.requests == 2
+
+def test_iter_hits_raises_when_a_page_fails(server):
+    es_client = bench_client(server)
+    server.error_status = 400
+    hits = es_client.iter_hits('alpha', page_size=100, prefetch=False)
+    next(hits)
+    server.down = True
+    with pytest.raises(TransportError):
+        for _ in hits:
+            pass
+
+def test_bulk_worker_errors_count_as_failed_chunks(server):
+    es_client = bench_client(server)
+    send_bulk_chunk = es_client.send_bulk_chunk
+    def flaky_send(chunk, throttle=None):
+        if chunk[0].startswith(b'bad'):
+            raise ValueError('unexpected')
+        return send_bulk_chunk(chunk, throttle)
+    es_client.send_bulk_chunk = flaky_send
+    action = b'{"index":{}}\n{"content":"x"}\n'
+    chunks = [[b'bad\n'] * 3] * 30 + [[action] * 2] * 10
+    result = es_client.send_bulk_chunks(iter(chunks), workers=2)
+    assert result == (20, 90)
+
+def test_bulk_load_restores_the_settings_read_through_an_alias(server):
+    es_client = bench_client(server)
+    put = []
+    es_client.client.indices.get_settings = lambda index, name: {'zot0_v2' : {'settings' : {'index' : {
+        'refresh_interval' : '5s', 'number_of_replicas' : '2'}}}}
+    es_client.client.indices.put_settings = lambda index, body: put.append((index, body))
+    with es_client.bulk_load_settings():
+        pass
+    assert put == [('zot0', {'index' : {'refresh_interval' : '-1', 'number_of_replicas' : 0}}),
+                   ('zot0', {'index' : {'refresh_interval' : '5s', 'number_of_replicas' : '2'}})]
+
+
+class FakeAliases:
+    '''
+    Stands in for the index and alias calls of client.indices, over a set of concrete
+    indices and a dict of alias -> set of indices, logging each call that changes them.
+    '''
+
+    def __init__(self, es_client, indices=(), aliases=None, log=None):
+        self.indices = set(indices)
+        self.aliases = {alias : set(targets) for alias, targets in (aliases or {}).items()}
+        self.log = [] if log is None else log
+        self.get_settings = lambda index, name: {}
+        self.put_settings = lambda index, body: self.log.append(('put_settings', index))
+        self.forcemerge = self.refresh = lambda index, **kwargs: None
+        create_index, delete_index = es_client.create_index, es_client.delete_index
+        def create(index_name=None, type_mappings=None):
+            self.log.append(('create', index_name))
+            self.indices.add(index_name)
+            return create_index(index_name, type_mappings)
+        def delete(index_name=None, **kwargs):
+            self.log.append(('delete', index_name))
+            self.indices.discard(index_name)
+            return delete_index(index_name, **kwargs)
+        es_client.create_index, es_client.delete_index = create, delete
+        es_client.client.indices = self
+
+    def exists(self, index):
+        return index in self.indices or index in self.aliases
+
+    def exists_alias(self, name, index=None):
+        return name in self.aliases and (index is None or index in self.aliases[name])
+
+    def get_alias(self, index):
+        prefix = index.rstrip('*')
+        return {name : {'aliases' : {alias : {} for alias, targets in self.aliases.items()
+                                     if name in targets}}
+                for name in self.indices if name.startswith(prefix)}
+
+    def update_aliases(self, body):
+        self.log.append(('update_aliases', body['actions']))
+        for action in body['actions']:
+            for kind, args in action.items():
+                if kind == 'add':
+                    self.aliases.setdefault(args['alias'], set()).add(args['index'])
+                elif kind == 'remove':
+                    self.aliases[args['alias']].discard(args['index'])
+                elif kind == 'remove_index':
+                    self.indices.discard(args['index'])
+        return {'acknowledged' : True}
+
+
+def test_ensure_tenant_alias_adds_a_filtered_routed_alias(server):
+    es_client = bench_client(server)
+    aliases = FakeAliases(es_client)
+    es_client.ensure_tenant_alias(13)
+    es_client.ensure_tenant_alias(13)
+    assert aliases.log == [
+        ('create', 'zots5'),
+        ('update_aliases', [{'add' : {'index' : 'zots5', 'alias' : 'zot13',
+                                      'filter' : {'term' : {'zot_id' : 13}}, 'routing' : '13'}}]),
+    ]
+
+def test_migrate_tenant_copies_then_switches_the_alias(server):
+    es_client = bench_client(server)
+    aliases = FakeAliases(es_client, ['zot13_v1', 'zots5'], {'zot13' : ['zot13_v1']})
+    actions = []
+    send_bulk_chunk = es_client.send_bulk_chunk
+    def copy(chunk, throttle=None):
+        if not actions:
+            aliases.log.append(('copy', None))
+        actions.extend(json.loads(line.split(b'\n')[0]) for line in chunk)
+        return send_bulk_chunk(chunk, throttle)
+    es_client.send_bulk_chunk = copy
+    result = es_client.migrate_tenant(13, bulk_load=True)
+    assert result == (250, 0)
+    assert all(action['index']['_index'] == 'zots5' and action['index']['_routing'] == '13'
+               for action in actions)
+    assert aliases.log == [
+        ('copy', None),
+        ('update_aliases', [{'remove' : {'index' : 'zot13_v1', 'alias' : 'zot13'}},
+                            {'add' : {'index' : 'zots5', 'alias' : 'zot13',
+                                      'filter' : {'term' : {'zot_id' : 13}}, 'routing' : '13'}}]),
+        ('delete', 'zot13_v1'),
+    ]
+    assert aliases.aliases == {'zot13' : {'zots5'}}
+
+def test_rebuild_index_swaps_the_alias_and_deletes_old_versions(server):
+    es_client = bench_client(server)
+    aliases = FakeAliases(es_client, ['zot0_v1', 'zot0_v2', 'zot0_v3'], {'zot0' : ['zot0_v3']})
+    assert es_client.rebuild_index(synthetic_docs(2), keep=1) == (10, 0)
+    assert [entry for entry in aliases.log if entry[0] != 'put_settings'] == [
+        ('create', 'zot0_v4'),
+        ('update_aliases', [{'remove' : {'index' : 'zot0_v3', 'alias' : 'zot0'}},
+                            {'add' : {'index' : 'zot0_v4', 'alias' : 'zot0'}}]),
+        ('delete', 'zot0_v1'),
+        ('delete', 'zot0_v2'),
+    ]
+    assert aliases.aliases == {'zot0' : {'zot0_v4'}}
+    assert aliases.indices == {'zot0_v3', 'zot0_v4'}
+
+def test_rebuild_index_replaces_a_legacy_index(server):
+    es_client = bench_client(server)
+    aliases = FakeAliases(es_client, ['zot0'])
+    assert es_client.rebuild_index(synthetic_docs(1), bulk_load=False) == (5, 0)
+    assert aliases.log[1:] == [('update_aliases', [{'remove_index' : {'index' : 'zot0'}},
+                                                   {'add' : {'index' : 'zot0_v1', 'alias' : 'zot0'}}])]
+    assert aliases.indices == {'zot0_v1'}
+
+def test_rebuild_index_without_docs_leaves_the_index_alone(server):
+    es_client = bench_client(server)
+    aliases = FakeAliases(es_client, ['zot0_v1'], {'zot0' : ['zot0_v1']})
+    assert es_client.rebuild_index(None) == (0, 0)
+    assert aliases.log == [] and server.requests == 0
+
+def test_index_all_docs_reports_an_unreachable_cluster(server, capsys):
+    es_client = bench_client(server)
+    server.error_status, server.down = 400, True
+    assert es_client.index_all_docs(docs=synthetic_docs(2)) == (0, 0)
+    assert 'ElasticsearchClient.index_all_docs: cannot check or create zot0' in capsys.readouterr().out
@@ -0,0 +1,38 @@
+'''The JSON serializers of escodec.py'''
+from datetime import date, datetime
+from decimal import Decimal
+import json
+
+import pytest
+from elasticsearch.exceptions import SerializationError
+
+from escodec import OrjsonSerializer, StdlibJSONSerializer
+
+pytest.importorskip('orjson')
+
+
+DATA = {'when' : datetime(2020, 1, 2, 3, 4, 5), 'day' : date(2020, 1, 2), 7 : 'seven',
+        'price' : Decimal('1.5'), 'text' : 'naïve café'}
+
+def test_orjson_matches_the_stdlib_serializer():
+    data = OrjsonSerializer().dumps_bytes(DATA)
+    assert isinstance(data, bytes)
+    assert json.loads(data) == json.loads(StdlibJSONSerializer().dumps_bytes(DATA)) == {
+        'when' : '2020-01-02T03:04:05', 'day' : '2020-01-02', '7' : 'seven', 'price' : 1.5,
+        'text' : 'naïve café'}
+
+def test_orjson_passes_strings_and_bytes_through():
+    serializer = OrjsonSerializer()
+    assert serializer.dumps('{"a":1}') == '{"a":1}'
+    assert serializer.dumps(b'{"a":1}\n') == b'{"a":1}\n'
+    assert serializer.dumps({'a' : 1}) == b'{"a":1}'
+
+def test_orjson_loads_bytes_and_str():
+    serializer = OrjsonSerializer()
+    assert serializer.loads(b'{"a":[1,"\\u00e9"]}') == serializer.loads('{"a":[1,"é"]}') == {'a' : [1, 'é']}
+    with pytest.raises(SerializationError):
+        serializer.loads(b'{"a":')
+
+def test_orjson_refuses_unknown_types():
+    with pytest.raises(SerializationError):
+        OrjsonSerializer().dumps_bytes({'a' : object()})
@@ -0,0 +1,49 @@
+'''Decoding search results into ESResult tuples and CompactResults'''
+from esaws import CompactResults, ESResult, extract_scores_and_ids
+
+
+def lean_hit(num, doc_id=True):
+    '''A hit as a lean search returns it'''
+    hit = {'_id' : 'entry-%d' % num, '_score' : 10.0 - num}
+    if doc_id:
+        hit['fields'] = {'kb_document_id' : ['doc-%d' % num]}
+    return hit
+
+def results_of(hits):
+    '''A search response with hits'''
+    return {'hits' : {'total' : len(hits), 'max_score' : 10.0, 'hits' : hits}}
+
+
+def test_compact_results_for_missing_or_failed_results():
+    for results in (None, {}, {'hits' : None}):
+        compact, max_score, sum_score = extract_scores_and_ids('zot0', 'q', results, 0.0, compact=True)
+        assert isinstance(compact, CompactResults)
+        assert len(compact) == 0 and list(compact) == []
+        assert (max_score, sum_score) == (0.0, 0.0)
+
+def test_compact_results_match_the_tuples():
+    hits = [dict(lean_hit(num), _source={'kb_document_id' : 'doc-%d' % num}) for num in range(5)]
+    compact, max_score, sum_score = extract_scores_and_ids('zot0', 'q', results_of(hits), 7.0, compact=True)
+    tuples = extract_scores_and_ids('zot0', 'q', results_of(hits), 7.0)
+    assert list(compact) == tuples[0] == [ESResult(10.0 - num, 'doc-%d' % num, 'entry-%d' % num)
+                                          for num in range(4)]
+    assert (max_score, sum_score) == tuples[1:]
+
+def test_malformed_hits_are_skipped_not_the_page():
+    hits = [lean_hit(0), lean_hit(1, doc_id=False), lean_hit(2), dict(lean_hit(3), _score=None)]
+    compact, max_score, sum_score = extract_scores_and_ids('zot0', 'q', results_of(hits), 0.0, compact=True)
+    assert list(compact) == [ESResult(10.0, 'doc-0', 'entry-0'), ESResult(8.0, 'doc-2', 'entry-2')]
+    assert (max_score, sum_score) == (10.0, 18.0)
+
+def test_malformed_hits_are_reported_only_when_skipped(capsys):
+    hits = [lean_hit(0), lean_hit(1)]
+    extract_scores_and_ids('zot0', 'q', results_of(hits), 0.0, compact=True)
+    extract_scores_and_ids('zot0', 'q', results_of(hits + [dict(lean_hit(2), _score=None)]), 0.0,
+                           compact=True)
+    assert capsys.readouterr().out == "extract_compact: skipped 1 malformed hits of 3\n"
+
+def test_compact_results_without_a_min_score():
+    hits = [lean_hit(0), dict(lean_hit(1), _score=-1.0), dict(lean_hit(2), _score=None)]
+    compact, _, sum_score = extract_scores_and_ids('zot0', 'q', results_of(hits), None, compact=True)
+    assert list(compact) == [ESResult(10.0, 'doc-0', 'entry-0'), ESResult(-1.0, 'doc-1', 'entry-1')]
+    assert sum_score == 9.0
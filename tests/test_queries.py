@@ -0,0 +1,11 @@
+'''Query builders'''
+from esaws import substring_query
+
+
+def test_short_substring_queries_are_folded_like_the_ngrams():
+    assert substring_query('Éa') == {'query' : {'prefix' : {'content.ngram' : 'ea'}}}
+    assert substring_query('Øl') == {'query' : {'prefix' : {'content.ngram' : 'ol'}}}
+    assert substring_query('ﬁ') == {'query' : {'prefix' : {'content.ngram' : 'fi'}}}
+
+def test_long_substring_queries_are_analyzed_by_the_cluster():
+    assert substring_query('Café') == {'query' : {'match_phrase' : {'content.ngram' : 'Café'}}}
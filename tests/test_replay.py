@@ -0,0 +1,36 @@
+'''Open-loop replay of query logs'''
+from esbench import bench_client
+from esreplay import QueryReplayer, schedule_queries
+
+
+def records(num):
+    '''Query log records for num searches'''
+    return [{'query' : 'alpha beta %d' % pos, 'query_type' : 'match_query'} for pos in range(num)]
+
+
+def test_errors_are_measured_apart_from_answers(server):
+    server.error_rate, server.error_status = 0.5, 400
+    es_client = bench_client(server)
+    replayer = QueryReplayer(es_client, concurrency=4)
+    seconds = replayer.run(schedule_queries(records(200), es_client.index_name, qps=2000.0))
+    summary = replayer.report(seconds)['match_query']
+    assert summary['count'] + summary['errors'] == 200
+    assert summary['errors'] == server.errors
+    assert 0 < summary['errors'] < 200
+    assert summary['error_latency']['count'] == summary['errors']
+
+class BrokenClient:
+    '''Raises something other than a TransportError'''
+    def perform_request(self, *request):
+        raise KeyError('hits')
+
+def test_unexpected_exceptions_are_counted():
+    replayer = QueryReplayer(BrokenClient(), concurrency=2)
+    seconds = replayer.run(schedule_queries(records(10), 'zot0', qps=1000.0))
+    summary = replayer.report(seconds)['match_query']
+    assert (summary['count'], summary['errors']) == (0, 10)
+
+def test_only_the_first_error_is_reported(capsys):
+    replayer = QueryReplayer(BrokenClient(), concurrency=8)
+    replayer.run(schedule_queries(records(200), 'zot0', qps=100000.0))
+    assert capsys.readouterr().out.count('QueryReplayer.send: match_query failed') == 1
@@ -0,0 +1,157 @@
+'''ResilientTransport against the fault-injecting stand-in and scripted send functions'''
+
+import threading
+import time
+
+import pytest
+from elasticsearch.exceptions import TransportError
+
+from esaws import most_fields_query
+from esbench import bench_client
+from eslatency import RequestMetrics
+from esresilience import CircuitBreaker, CircuitOpenError, ResilientTransport, RetryPolicy
+
+
+def resilient(max_attempts=3, threshold=100, reset_timeout=0.2, **kwargs):
+    '''ResilientTransport with short delays for tests'''
+    return ResilientTransport(retry=RetryPolicy(max_attempts=max_attempts, base_delay=0.001, deadline=5.0),
+                              breaker=CircuitBreaker(threshold, reset_timeout), **kwargs)
+
+def search(es_client):
+    '''Send one search through the client's perform_request'''
+    return es_client.perform_request('POST', '/zot0/kb_document/_search', body={'size' : 1})
+
+
+def test_retries_transient_errors_then_raises(server):
+    es_client = bench_client(server, resilience=resilient(max_attempts=3))
+    server.down = True
+    with pytest.raises(TransportError) as raised:
+        search(es_client)
+    assert raised.value.status_code == 503
+    assert server.requests == 3
+    assert es_client.resilience.retries == 2
+
+def test_retry_succeeds_after_transient_error():
+    calls = []
+    def send(method, path, params, body, headers):
+        calls.append(params['request_timeout'])
+        if len(calls) < 3:
+            raise TransportError(503, 'unavailable')
+        return {'took' : 1}
+    transport = resilient(max_attempts=4)
+    assert transport.perform(send, 'POST', '/zot0/_search', body={}) == {'took' : 1}
+    assert len(calls) == 3
+    assert all(0.0 < timeout <= 5.0 for timeout in calls)
+
+def test_non_idempotent_request_is_not_retried(server):
+    es_client = bench_client(server, resilience=resilient(max_attempts=3))
+    server.down = True
+    with pytest.raises(TransportError):
+        es_client.perform_request('POST', '/zot0/kb_document', body={'content' : 'x'})
+    assert server.requests == 1
+
+def test_breaker_opens_half_opens_and_closes(server):
+    es_client = bench_client(server, resilience=resilient(max_attempts=1, threshold=2))
+    breaker = es_client.resilience.breaker
+    server.down = True
+    for _ in range(2):
+        with pytest.raises(TransportError):
+            search(es_client)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        search(es_client)
+    assert server.requests == 2
+
+    # A failed trial reopens the circuit
+    time.sleep(0.25)
+    with pytest.raises(TransportError) as raised:
+        search(es_client)
+    assert not isinstance(raised.value, CircuitOpenError)
+    assert breaker.state == CircuitBreaker.OPEN and breaker.opens == 2
+
+    # A successful trial closes it
+    server.down = False
+    time.sleep(0.25)
+    assert search(es_client)['took'] == 3
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert search(es_client)['took'] == 3
+
+def test_breaker_counts_unexpected_errors_and_frees_the_trial():
+    transport = resilient(max_attempts=1, threshold=1, reset_timeout=0.05)
+    def fail(*args):
+        raise ValueError('bad response')
+    with pytest.raises(ValueError):
+        transport.perform(fail, 'POST', '/zot0/_search')
+    assert transport.breaker.state == CircuitBreaker.OPEN
+
+    class Interrupted(BaseException):
+        pass
+    def interrupt(*args):
+        raise Interrupted()
+    time.sleep(0.06)
+    with pytest.raises(Interrupted):
+        transport.perform(interrupt, 'POST', '/zot0/_search')
+    assert transport.breaker.state == CircuitBreaker.HALF_OPEN
+    assert not transport.breaker.trial_in_flight
+    assert transport.perform(lambda *args: {'took' : 1}, 'POST', '/zot0/_search') == {'took' : 1}
+    assert transport.breaker.state == CircuitBreaker.CLOSED
+
+
+def scripted_send(delays):
+    '''Send function whose n-th call sleeps delays[n] seconds and returns n'''
+    lock = threading.Lock()
+    calls = []
+    def send(method, path, params, body, headers):
+        with lock:
+            num = len(calls)
+            calls.append(num)
+        time.sleep(delays[num])
+        return num
+    return send, calls
+
+def test_hedged_backup_wins():
+    transport = resilient(hedge=True)
+    transport.latencies.value = 0.01
+    send, calls = scripted_send([0.5, 0.0])
+    beg_time = time.perf_counter()
+    assert transport.perform(send, 'POST', '/zot0/_search', body={}) == 1
+    assert time.perf_counter() - beg_time < 0.3
+    assert transport.hedges == 1 and transport.hedge_wins == 1
+    transport.close()
+
+def test_hedge_cancelled_when_primary_wins():
+    transport = resilient(hedge=True, hedge_workers=1)
+    transport.latencies.value = 0.01
+    send, calls = scripted_send([0.05, 0.0])
+    assert transport.perform(send, 'POST', '/zot0/_search', body={}) == 0
+    assert transport.hedges == 1 and transport.hedge_wins == 0
+    assert transport.hedges_cancelled == 1
+    assert calls == [0]
+    transport.close()
+
+def test_no_hedge_for_writes():
+    transport = resilient(hedge=True)
+    transport.latencies.value = 0.001
+    send, calls = scripted_send([0.05, 0.0])
+    assert transport.perform(send, 'PUT', '/zot0', body={}) == 0
+    assert transport.hedges == 0 and calls == [0]
+    transport.close()
+
+def test_hedged_reads_are_measured(server):
+    server.latency = 0.02
+    bytes_out, phases = {}, {}
+    for hedge in (False, True):
+        metrics = RequestMetrics()
+        resilience = resilient(hedge=hedge)
+        resilience.latencies.value = 0.001
+        es_client = bench_client(server, resilience=resilience)
+        es_client.metrics = metrics
+        for num in range(10):
+            es_client.search_index('query %d' % num, query_builder=most_fields_query, verbose=0)
+        search_metrics = metrics.to_dict()['search']
+        bytes_out[hedge] = search_metrics['bytes_out']
+        phases[hedge] = set(search_metrics['phases'])
+        resilience.close()
+    assert bytes_out[True] == bytes_out[False] > 0
+    assert phases[True] == phases[False]
+    assert {'sign', 'serialize', 'parse', 'network', 'server'} <= phases[True]
@@ -0,0 +1,78 @@
+'''SingleFlight coalescing, on threads and in an event loop'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+from escache import AsyncSingleFlight, SingleFlight
+from esbench import FakeElasticsearch, bench_client
+
+
+class Interrupted(BaseException):
+    '''Not an Exception, like KeyboardInterrupt'''
+
+
+def test_concurrent_identical_searches_are_coalesced():
+    with FakeElasticsearch(latency=0.2, num_hits=10) as server:
+        es_client = bench_client(server)
+        es_client.single_flight = SingleFlight()
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: es_client.search_index('alpha', verbose=0), range(5)))
+    assert server.requests == 1
+    assert all(result is results[0] for result in results)
+    assert es_client.single_flight.stats() == {'executed' : 1, 'coalesced' : 4, 'in_flight' : 0}
+
+def test_followers_get_any_exception_of_the_leader():
+    single_flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    def interrupted():
+        started.set()
+        release.wait(2.0)
+        raise Interrupted()
+    def call():
+        try:
+            single_flight.do('key', interrupted)
+        except Interrupted:
+            return 'interrupted'
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        leader = executor.submit(call)
+        started.wait(2.0)
+        followers = [executor.submit(call) for _ in range(2)]
+        while single_flight.stats()['coalesced'] < 2:
+            time.sleep(0.001)
+        release.set()
+        assert [future.result() for future in [leader] + followers] == ['interrupted'] * 3
+
+def test_cancelling_the_first_async_caller_does_not_cancel_the_others():
+    single_flight = AsyncSingleFlight()
+    calls = []
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'result'
+    async def main():
+        first = asyncio.ensure_future(single_flight.do('key', work))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(single_flight.do('key', work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+    assert asyncio.run(main()) == 'result'
+    assert calls == [1]
+    assert single_flight.stats() == {'executed' : 1, 'coalesced' : 1, 'in_flight' : 0}
+
+def test_async_exceptions_are_shared():
+    single_flight = AsyncSingleFlight()
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError('bad')
+    async def main():
+        return await asyncio.gather(*[single_flight.do('key', failing) for _ in range(3)],
+                                    return_exceptions=True)
+    errors = asyncio.run(main())
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert single_flight.stats()['executed'] == 1
@@ -0,0 +1,107 @@
+'''CredentialCache refreshing, with a fake credentials provider, and AWSSignedConnection compression'''
+import gzip
+import threading
+import time
+
+from esbench import bench_client, synthetic_docs
+from estransport import AwsCredentials, CredentialCache
+
+
+class FakeProvider:
+    '''Hands out numbered credentials expiring lifetime seconds after each call'''
+
+    def __init__(self, lifetime=None, failures=0):
+        self.lifetime = lifetime
+        self.failures = failures
+        self.calls = 0
+        self.called = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.called.set()
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('provider unavailable')
+        expiry = time.time() + self.lifetime if self.lifetime is not None else None
+        return AwsCredentials('key%d' % self.calls, 'secret', None), expiry
+
+def wait_for(predicate, timeout=2.0):
+    '''Poll predicate until it is true or timeout seconds pass'''
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_static_credentials_are_not_refreshed():
+    provider = FakeProvider()
+    cache = CredentialCache(provider, refresh_margin=0.1)
+    assert cache.current().access_key == 'key1'
+    assert cache.seconds_until_refresh() is None
+    assert cache.thread is None
+    time.sleep(0.05)
+    assert provider.calls == 1
+
+def test_refreshes_before_expiry():
+    provider = FakeProvider(lifetime=0.4)
+    cache = CredentialCache(provider, refresh_margin=0.3)
+    try:
+        assert cache.current().access_key == 'key1'
+        # Due 0.1s from now, well before the credentials expire at 0.4s
+        assert wait_for(lambda: cache.refreshes >= 2)
+        assert cache.current().access_key != 'key1'
+        assert cache.expiry > time.time()
+    finally:
+        cache.stop()
+
+def test_failed_refresh_is_retried_and_keeps_the_old_credentials():
+    provider = FakeProvider(lifetime=0.2)
+    cache = CredentialCache(provider, refresh_margin=0.15, retry_interval=0.05)
+    try:
+        provider.failures = 2
+        assert wait_for(lambda: cache.failures >= 1)
+        assert cache.current().access_key == 'key1'
+        assert wait_for(lambda: cache.refreshes >= 2)
+        assert cache.failures == 2
+        assert cache.current().access_key == 'key4'
+    finally:
+        cache.stop()
+
+def test_current_does_not_block_on_the_provider():
+    provider = FakeProvider(lifetime=0.2)
+    cache = CredentialCache(provider, refresh_margin=0.15)
+    release = threading.Event()
+    try:
+        def slow_provider():
+            release.wait(2.0)
+            return AwsCredentials('slow', 'secret', None), time.time() + 60
+        cache.provider = slow_provider
+        start = time.time()
+        time.sleep(0.1)
+        assert cache.current().access_key == 'key1'
+        assert time.time() - start < 0.5
+        release.set()
+        assert wait_for(lambda: cache.current().access_key == 'slow')
+    finally:
+        release.set()
+        cache.stop()
+
+
+def test_compressed_requests_round_trip(server):
+    es_client = bench_client(server, http_compress=True)
+    connection = es_client.client.transport.get_connection()
+    sent, urlopen = [], connection.pool.urlopen
+    def recording(method, url, body, **kwargs):
+        response = urlopen(method, url, body, **kwargs)
+        sent.append((url, kwargs['headers'], body, response.headers))
+        return response
+    connection.pool.urlopen = recording
+    assert es_client.index_all_docs(docs=synthetic_docs(20)) == (100, 0)
+    (_, index_headers, _, _), (url, headers, body, response_headers) = sent
+    assert 'content-encoding' not in index_headers
+    assert url == '/_bulk' and headers['content-encoding'] == 'gzip'
+    assert len(gzip.decompress(body).splitlines()) == 200
+    assert server.bytes_in == len(body)
+    assert response_headers['content-encoding'] == 'gzip'
+    status, headers, data = connection.perform_request('GET', '/zot0/_settings')
+    assert status == 200 and headers['content-encoding'] == 'gzip' and data.startswith('{')